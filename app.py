@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, request, jsonify, send_from_directory, send_file, g, Response
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import os
@@ -7,8 +7,12 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy.exc import IntegrityError
 import jwt
 import datetime
+import json
 import math
 import random
+import socket
+import time
+import uuid
 
 app = Flask(__name__)
 # 允许跨域访问（开发时使用宽松策略）
@@ -18,8 +22,17 @@ CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 from utils.helpers import (
     exp_for_level, apply_level_up, compute_battle_power, realm_coefficient_map,
     calc_strengthen_success, calc_forge_success,
-    roll_treasure_quality, generate_treasure_stats, awaken_success_rate
+    roll_treasure_quality, generate_treasure_stats, awaken_success_rate,
+    TTLCache, LRUCache, MAX_LEVEL, exp_needed, exp_cost, affordable_levels, batch_uniforms,
+    binomial_sample, skill_level_progress, lingzhi_growth,
+    LINGZHI_STAGES, lingzhi_stage_cutoffs, acupoint_cost, affordable_acupoint_levels,
+    elo_rating_change, GUARANTEED_DROP_THRESHOLD, simulate_guaranteed_drops
 )
+from utils.catalog import GameCatalog, MeridianTemplate
+from utils.scheduler import PeriodicScheduler
+from utils.chat import ChatHub
+from utils.teams import TeamRegistry, TeamEntry
+from utils.arena import ArenaMatchmaker, QueueEntry
 
 # 元素克制关系
 ELEMENT_RESTRAINTS = {
@@ -204,6 +217,182 @@ def calculate_combat_stats(character, weather='晴天'):
         'linggen': character.linggen
     }
 
+# 战斗属性快照字段（与 calculate_combat_stats 的返回值一致）
+COMBAT_STATS_FIELDS = (
+    'total_attack', 'total_defense', 'total_hp', 'total_speed',
+    'crit_rate', 'dodge_rate', 'hit_rate', 'crit_damage', 'penetration_rate', 'linggen'
+)
+
+def get_combat_stats(character, weather='晴天'):
+    """读取人物战斗属性快照，快照不存在时计算并保存
+
+    快照只在装备、法宝、功法、经脉、宠物、属性等变化时由 invalidate_combat_stats 删除，
+    因此每回合战斗只需一次查询，与人物拥有多少装备无关。
+    """
+    snapshot = CombatStats.query.filter_by(character_id=character.id, weather=weather).first()
+    if snapshot:
+        return {field: getattr(snapshot, field) for field in COMBAT_STATS_FIELDS}
+
+    stats = calculate_combat_stats(character, weather)
+    if stats is None:
+        return None
+    try:
+        with db.session.begin_nested():
+            db.session.add(CombatStats(character_id=character.id, weather=weather, **stats))
+    except IntegrityError:
+        pass  # 并发请求已写入同一快照
+    return stats
+
+def combat_stats_for(character_ids, weather='晴天'):
+    """批量读取多个人物的战斗属性快照（一次查询），缺失的快照逐个计算并保存"""
+    stats = {}
+    snapshots = CombatStats.query.filter(CombatStats.character_id.in_(character_ids), CombatStats.weather == weather)
+    for snapshot in snapshots:
+        stats[snapshot.character_id] = {field: getattr(snapshot, field) for field in COMBAT_STATS_FIELDS}
+    missing = [character_id for character_id in character_ids if character_id not in stats]
+    if missing:
+        for character in Character.query.filter(Character.id.in_(missing)):
+            computed = get_combat_stats(character, weather)
+            if computed is not None:
+                stats[character.id] = computed
+    return stats
+
+def invalidate_combat_stats(character_id):
+    """人物战斗相关数据变化后删除其全部天气下的属性快照，下次战斗时重新计算"""
+    CombatStats.query.filter_by(character_id=character_id).delete(synchronize_session=False)
+
+def refresh_battle_power(character_id):
+    """重新计算人物战力并写入战力排行榜（由调用方提交）"""
+    attr = CharacterAttribute.query.filter_by(character_id=character_id).first()
+    if not attr:
+        return None
+    power = compute_battle_power(attr,
+        Equipment.query.filter_by(character_id=character_id).all(),
+        Mantra.query.filter_by(character_id=character_id).all(),
+        Treasure.query.filter_by(character_id=character_id).all())
+
+    updated = Ranking.query.filter_by(character_id=character_id, type='battle_power').update(
+        {'score': power}, synchronize_session=False)
+    if not updated:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Ranking(character_id=character_id, type='battle_power', score=power))
+        except IntegrityError:
+            # 并发请求已插入该行，改为更新
+            Ranking.query.filter_by(character_id=character_id, type='battle_power').update(
+                {'score': power}, synchronize_session=False)
+    return power
+
+def refresh_character_stats(character_id):
+    """人物战斗相关数据变化后调用：清除战斗属性快照并刷新战力排行
+
+    晴天快照随即重新生成，离线竞技挑战只读取防守方的这份快照。
+    """
+    invalidate_combat_stats(character_id)
+    character = db.session.get(Character, character_id)
+    if character:
+        get_combat_stats(character)
+    refresh_battle_power(character_id)
+
+def rebuild_battle_power_rankings():
+    """全量重建战力排行榜，每类数据只查询一次"""
+    equipments, mantras, treasures = {}, {}, {}
+    for model, grouped in ((Equipment, equipments), (Mantra, mantras), (Treasure, treasures)):
+        for item in model.query.all():
+            grouped.setdefault(item.character_id, []).append(item)
+
+    Ranking.query.filter_by(type='battle_power').delete(synchronize_session=False)
+    rows = []
+    for attr in CharacterAttribute.query.all():
+        rows.append({
+            'character_id': attr.character_id,
+            'type': 'battle_power',
+            'score': compute_battle_power(attr,
+                equipments.get(attr.character_id),
+                mantras.get(attr.character_id),
+                treasures.get(attr.character_id)),
+            'rank': 0
+        })
+    if rows:
+        db.session.execute(db.insert(Ranking), rows)
+    db.session.commit()
+    return len(rows)
+
+# 批量制作（强化、锻造、炼丹、符文）单次请求的最大次数
+BATCH_CRAFT_MAX = 100
+
+def parse_batch_count(data, limit=BATCH_CRAFT_MAX):
+    """读取请求中的 count 参数（默认1，超过上限时截断），非法时返回 None"""
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return None
+    if count < 1:
+        return None
+    return min(count, limit)
+
+# 列表分页：默认每页条数及上限
+PAGE_SIZE_DEFAULT = 20
+PAGE_SIZE_MAX = 100
+
+def parse_pagination(args, default_per_page=PAGE_SIZE_DEFAULT, max_per_page=PAGE_SIZE_MAX):
+    """读取 page / per_page 查询参数，非法值回退为默认值，每页条数不超过上限"""
+    try:
+        page = max(1, int(args.get('page', 1)))
+    except (TypeError, ValueError):
+        page = 1
+    try:
+        per_page = min(max(1, int(args.get('per_page', default_per_page))), max_per_page)
+    except (TypeError, ValueError):
+        per_page = default_per_page
+    return page, per_page
+
+def wallet_debit(character_id, cost, resource_type='灵石', required=None):
+    """原子扣除资源：单条 UPDATE ... WHERE amount >= cost，按影响行数判断是否成功（由调用方提交）
+
+    并发请求同时扣款时不会出现丢失更新，也不会扣成负数。
+    required 为门槛余额：余额不低于 required 时才扣除 cost（如突破失败只扣一半，但需持有全额）。
+    """
+    required = max(cost, required or 0)
+    if required <= 0:
+        return True
+    result = db.session.execute(
+        db.update(Resource).where(
+            Resource.character_id == character_id,
+            Resource.type == resource_type,
+            Resource.amount >= required
+        ).values(amount=Resource.amount - cost).execution_options(synchronize_session='evaluate')
+    )
+    return result.rowcount > 0
+
+def wallet_balance(character_id, resource_type='灵石'):
+    """从数据库读取当前余额（g.wallet 是请求开始时的快照，扣款失败或并发扣款后不再准确）"""
+    amount = db.session.query(Resource.amount).filter_by(
+        character_id=character_id, type=resource_type
+    ).scalar()
+    return amount or 0
+
+def wallet_credit(character_id, amount, resource_type='灵石'):
+    """原子增加资源（由调用方提交）
+
+    先 UPDATE；资源行不存在时 INSERT，并发插入撞上 (character_id, type) 唯一索引时改回 UPDATE。
+    """
+    if amount <= 0:
+        return
+    credit = db.update(Resource).where(
+        Resource.character_id == character_id,
+        Resource.type == resource_type
+    ).values(amount=Resource.amount + amount).execution_options(synchronize_session='evaluate')
+    if db.session.execute(credit).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Resource).values(
+                character_id=character_id, type=resource_type, amount=amount
+            ))
+    except IntegrityError:
+        db.session.execute(credit)
+
 def calculate_damage(attacker_stats, defender_stats, weather='晴天', attacker_shentong=None):
     """计算伤害"""
     # 基础伤害 = 总攻击力
@@ -284,6 +473,46 @@ def shentong_trigger_rate(proficiency):
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///xianxia_dev.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 财富排行榜：各类资源折算为灵石的权重（未列出的资源按 1 计）及缓存秒数
+app.config['WEALTH_WEIGHTS'] = {
+    '灵石': 1.0,
+    '木材': 2.0,
+    '矿石': 3.0,
+    '冰晶': 5.0,
+    '灵植种子': 20.0,
+    '古董': 100.0,
+}
+app.config['WEALTH_RANKING_TTL'] = int(os.environ.get('WEALTH_RANKING_TTL', 30))
+# 宗门详情页头部信息缓存秒数
+app.config['SECT_HEADER_TTL'] = int(os.environ.get('SECT_HEADER_TTL', 10))
+# 宗门贡献流水汇总到宗门计数的间隔秒数
+app.config['SECT_CONTRIBUTION_FOLD_INTERVAL'] = int(os.environ.get('SECT_CONTRIBUTION_FOLD_INTERVAL', 10))
+# 好友邻接表缓存的人物数
+app.config['FRIEND_CACHE_SIZE'] = int(os.environ.get('FRIEND_CACHE_SIZE', 10000))
+# 好友邻接表缓存秒数（多进程部署时其他进程的加删好友最多延迟这么久可见）
+app.config['FRIEND_CACHE_TTL'] = int(os.environ.get('FRIEND_CACHE_TTL', 30))
+# 组队大厅：内存索引从数据库重建的最长间隔秒数（多进程部署时其他进程的改动最多延迟这么久可见）
+app.config['TEAM_REGISTRY_TTL'] = int(os.environ.get('TEAM_REGISTRY_TTL', 30))
+# 竞技场匹配：初始可接受积分差、每等待一秒放宽的积分差、最大积分差，及批量撮合间隔秒数
+app.config['ARENA_WINDOW_BASE'] = 50
+app.config['ARENA_WINDOW_GROWTH'] = 10
+app.config['ARENA_WINDOW_MAX'] = 400
+app.config['ARENA_MATCH_INTERVAL'] = int(os.environ.get('ARENA_MATCH_INTERVAL', 2))
+# 离线竞技防守战报邮件的汇总发送间隔秒数
+app.config['ARENA_DEFENSE_MAIL_INTERVAL'] = int(os.environ.get('ARENA_DEFENSE_MAIL_INTERVAL', 300))
+# 聊天：每个频道在内存中缓存的最近消息数、缓存从数据库同步的最长间隔秒数（其他进程发送的消息最多延迟这么久）、
+# 长轮询最长等待秒数、SSE 连接最长持续秒数（每个连接占用一个同步 worker，到时断开由客户端按 retry 自动重连续传）
+app.config['CHAT_BUFFER_SIZE'] = 200
+app.config['CHAT_SYNC_INTERVAL'] = float(os.environ.get('CHAT_SYNC_INTERVAL', 1.0))
+app.config['CHAT_POLL_TIMEOUT'] = 25
+app.config['CHAT_STREAM_MAX_SECONDS'] = int(os.environ.get('CHAT_STREAM_MAX_SECONDS', 25))
+app.config['CHAT_STREAM_RETRY_MS'] = 1000
+# 定时任务：ENABLE_SCHEDULER=1 时在 Web 进程内运行，否则用 scripts/worker.py 单独运行（docker-compose 的 worker 服务）
+app.config['SCHEDULER_ENABLED'] = os.environ.get('ENABLE_SCHEDULER', '0') == '1'
+# 灵田定时推进：间隔秒数、每次照顾值衰减量、每次变异概率相对基础变异概率的系数
+app.config['FARM_TICK_INTERVAL'] = int(os.environ.get('FARM_TICK_INTERVAL', 60))
+app.config['FARM_CARE_DECAY'] = 2
+app.config['FARM_TICK_MUTATION_SCALE'] = 0.1
 
 # 导入模型
 from models import *
@@ -410,30 +639,386 @@ def init_materials():
         db.session.commit()
         print("材料数据初始化完成")
 
-# 在应用启动时初始化数据
+def friendship_pair(character_id, friend_id):
+    """好友关系的有序对 (较小id, 较大id)"""
+    return (character_id, friend_id) if character_id <= friend_id else (friend_id, character_id)
+
+def normalize_friendships():
+    """旧数据的好友关系统一为有序对并去重（需在创建唯一索引之前执行）"""
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table(Friendship.__tablename__):
+        return
+    if 'uq_friendship_pair' in {i['name'] for i in inspector.get_indexes(Friendship.__tablename__)}:
+        return
+    kept = set()
+    for friendship in Friendship.query.order_by(Friendship.id).all():
+        pair = friendship_pair(friendship.character_id, friendship.friend_id)
+        if pair in kept or pair[0] == pair[1]:
+            db.session.delete(friendship)
+            continue
+        kept.add(pair)
+        friendship.character_id, friendship.friend_id = pair
+    db.session.commit()
+
+def normalize_wallets():
+    """旧数据中同一人物同类资源的多行合并到最早一行（需在创建唯一索引之前执行）"""
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table(Resource.__tablename__):
+        return
+    indexes = {i['name'] for i in inspector.get_indexes(Resource.__tablename__)}
+    if 'uq_resource_character_type' in indexes:
+        return
+    duplicates = db.session.query(
+        Resource.character_id, Resource.type, db.func.min(Resource.id), db.func.sum(Resource.amount)
+    ).filter(Resource.type.isnot(None))\
+        .group_by(Resource.character_id, Resource.type)\
+        .having(db.func.count(Resource.id) > 1).all()
+    for character_id, resource_type, keep_id, total in duplicates:
+        db.session.execute(
+            db.update(Resource).where(Resource.id == keep_id).values(amount=total)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            db.delete(Resource).where(
+                Resource.character_id == character_id,
+                Resource.type == resource_type,
+                Resource.id != keep_id
+            ).execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+    # 唯一索引已覆盖原来的普通索引
+    if 'ix_resource_character_type' in indexes:
+        db.Index('ix_resource_character_type', Resource.character_id, Resource.type).drop(db.engine)
+
+def normalize_guaranteed_drops():
+    """旧数据中同一人物同类保底的多个计数器合并为最早一行，保留最高的尝试次数（需在创建唯一索引之前执行）"""
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table(GuaranteedDrop.__tablename__):
+        return
+    if 'uq_guaranteed_drop_character_type' in {i['name'] for i in inspector.get_indexes(GuaranteedDrop.__tablename__)}:
+        return
+    duplicates = db.session.query(
+        GuaranteedDrop.character_id, GuaranteedDrop.drop_type,
+        db.func.min(GuaranteedDrop.id), db.func.max(GuaranteedDrop.attempts)
+    ).group_by(GuaranteedDrop.character_id, GuaranteedDrop.drop_type)\
+        .having(db.func.count(GuaranteedDrop.id) > 1).all()
+    for character_id, drop_type, keep_id, attempts in duplicates:
+        db.session.execute(
+            db.update(GuaranteedDrop).where(GuaranteedDrop.id == keep_id).values(attempts=attempts)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            db.delete(GuaranteedDrop).where(
+                GuaranteedDrop.character_id == character_id,
+                GuaranteedDrop.drop_type == drop_type,
+                GuaranteedDrop.id != keep_id
+            ).execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+
+def normalize_arenas():
+    """旧数据中同一人物的多条竞技场记录只保留最早一行（一直在用的那条），需在创建唯一索引之前执行"""
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table(Arena.__tablename__):
+        return
+    indexes = {i['name'] for i in inspector.get_indexes(Arena.__tablename__)}
+    if 'uq_arena_character' in indexes:
+        return
+    duplicates = db.session.query(Arena.character_id, db.func.min(Arena.id))\
+        .group_by(Arena.character_id).having(db.func.count(Arena.id) > 1).all()
+    for character_id, keep_id in duplicates:
+        db.session.execute(
+            db.delete(Arena).where(Arena.character_id == character_id, Arena.id != keep_id)
+            .execution_options(synchronize_session=False)
+        )
+    db.session.commit()
+    # 唯一索引已覆盖原来的普通索引
+    if 'ix_arena_character' in indexes:
+        db.Index('ix_arena_character', Arena.character_id).drop(db.engine)
+
+def upgrade_schema():
+    """为已存在的数据库补齐新增的列和索引（create_all 不会修改已存在的表），返回新增的 (表名, 列名) 集合"""
+    added_columns = set()
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                conn.execute(db.text(ddl))
+                added_columns.add((table.name, column.name))
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+    return added_columns
+
+def relax_mail_sender():
+    """旧数据库的 mail.sender_id 为 NOT NULL，放开为可空（系统邮件没有发件人）"""
+    inspector = db.inspect(db.engine)
+    if not inspector.has_table(Mail.__tablename__):
+        return
+    columns = {c['name']: c for c in inspector.get_columns(Mail.__tablename__)}
+    if columns['sender_id']['nullable']:
+        return
+    with db.engine.begin() as conn:
+        if conn.dialect.name in ('mysql', 'mariadb'):
+            conn.execute(db.text('ALTER TABLE mail MODIFY sender_id INTEGER NULL'))
+        elif conn.dialect.name == 'sqlite':
+            # SQLite 不能修改列约束，按新定义重建表后拷回数据
+            for index in inspector.get_indexes(Mail.__tablename__):
+                conn.execute(db.text(f'DROP INDEX {index["name"]}'))
+            conn.execute(db.text('ALTER TABLE mail RENAME TO mail_old'))
+            Mail.__table__.create(conn)
+            copied = ', '.join(c.name for c in Mail.__table__.columns if c.name in columns)
+            conn.execute(db.text(f'INSERT INTO mail ({copied}) SELECT {copied} FROM mail_old'))
+            conn.execute(db.text('DROP TABLE mail_old'))
+        else:
+            conn.execute(db.text('ALTER TABLE mail ALTER COLUMN sender_id DROP NOT NULL'))
+
+# 宗门成员数（旧数据库升级新增该列后回填一次）
+def init_sect_member_counts():
+    """按成员表重算所有宗门的成员数，一条 UPDATE"""
+    counted = db.select(db.func.count(SectMember.id))\
+        .where(SectMember.sect_id == Sect.id)\
+        .scalar_subquery()
+    db.session.execute(db.update(Sect).values(member_count=counted).execution_options(synchronize_session=False))
+    db.session.commit()
+
+def adjust_sect_member_count(sect_id, delta):
+    """原子地增减宗门成员数（不提交）"""
+    db.session.execute(
+        db.update(Sect).where(Sect.id == sect_id)
+        .values(member_count=Sect.member_count + delta)
+        .execution_options(synchronize_session=False)
+    )
+
+# 队伍成员数（旧数据库升级新增该列后回填一次）
+def init_team_member_counts():
+    """按成员表重算所有队伍的成员数，一条 UPDATE"""
+    counted = db.select(db.func.count(TeamMember.id))\
+        .where(TeamMember.team_id == Team.id)\
+        .scalar_subquery()
+    db.session.execute(db.update(Team).values(member_count=counted).execution_options(synchronize_session=False))
+    db.session.commit()
+
+def fold_sect_contributions(sect_id=None):
+    """把尚未汇总的贡献流水累加到宗门计数（不提交），sect_id 为空时汇总所有宗门
+
+    先用一条 UPDATE 给待汇总流水打上批次号，并发的汇总只会认领到各自的流水，不会重复累加。
+    """
+    batch = uuid.uuid4().hex
+    claim = db.update(SectContribution).where(SectContribution.fold_batch.is_(None))
+    if sect_id is not None:
+        claim = claim.where(SectContribution.sect_id == sect_id)
+    claimed = db.session.execute(
+        claim.values(fold_batch=batch).execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        return 0
+
+    totals = db.session.query(
+        SectContribution.sect_id,
+        db.func.sum(SectContribution.amount),
+        db.func.sum(SectContribution.prosperity),
+        db.func.sum(SectContribution.power)
+    ).filter(SectContribution.fold_batch == batch).group_by(SectContribution.sect_id).all()
+    for folded_sect_id, amount, prosperity, power in totals:
+        db.session.execute(
+            db.update(Sect).where(Sect.id == folded_sect_id)
+            .values(
+                contribution=Sect.contribution + amount,
+                prosperity=Sect.prosperity + prosperity,
+                power=Sect.power + power
+            )
+            .execution_options(synchronize_session=False)
+        )
+    return len(totals)
+
+def pending_sect_contributions(sect_ids):
+    """多个宗门尚未汇总的贡献流水合计，一次 GROUP BY 查询：{宗门id: (贡献值, 繁荣度, 实力值)}"""
+    if not sect_ids:
+        return {}
+    rows = db.session.query(
+        SectContribution.sect_id,
+        db.func.sum(SectContribution.amount),
+        db.func.sum(SectContribution.prosperity),
+        db.func.sum(SectContribution.power)
+    ).filter(SectContribution.sect_id.in_(sect_ids), SectContribution.fold_batch.is_(None))\
+        .group_by(SectContribution.sect_id)
+    return {sect_id: (int(amount or 0), int(prosperity or 0), int(power or 0))
+            for sect_id, amount, prosperity, power in rows}
+
+def pending_sect_contribution(sect_id):
+    """宗门尚未汇总的贡献流水合计：(贡献值, 繁荣度, 实力值)"""
+    return pending_sect_contributions([sect_id]).get(sect_id, (0, 0, 0))
+
+def run_sect_contribution_fold():
+    """定时任务：汇总所有宗门的贡献流水"""
+    folded = fold_sect_contributions()
+    db.session.commit()
+    return folded
+
+# 初始化战力排行榜（旧数据库升级后首次启动时全量计算）
+def init_battle_power_rankings():
+    """初始化战力排行榜"""
+    if Ranking.query.filter_by(type='battle_power').count() == 0 and Character.query.count() > 0:
+        count = rebuild_battle_power_rankings()
+        print(f"战力排行榜初始化完成，共{count}名人物")
+
+# 十二经脉+任督二脉数据（已在init_db.py中定义）
+MERIDIAN_DEFINITIONS = [
+    ("手太阴肺经", "十二经脉", 1.5),
+    ("手阳明大肠经", "十二经脉", 1.5),
+    ("足阳明胃经", "十二经脉", 1.5),
+    ("足太阴脾经", "十二经脉", 1.5),
+    ("手少阴心经", "十二经脉", 1.5),
+    ("手太阳小肠经", "十二经脉", 1.5),
+    ("足太阳膀胱经", "十二经脉", 1.5),
+    ("足少阴肾经", "十二经脉", 1.5),
+    ("手厥阴心包经", "十二经脉", 1.5),
+    ("手少阳三焦经", "十二经脉", 1.5),
+    ("足少阳胆经", "十二经脉", 1.5),
+    ("足厥阴肝经", "十二经脉", 1.5),
+    ("任脉", "任督二脉", 2.5),
+    ("督脉", "任督二脉", 2.5),
+]
+
+def load_meridian_templates():
+    """读取全局经脉模板（character_id 为空）及其穴位名，没有模板的经脉不复制"""
+    template_ids = {}
+    for m in Meridian.query.filter_by(character_id=None).order_by(Meridian.id):
+        template_ids.setdefault(m.name, m.id)
+    acupoints = {}
+    if template_ids:
+        rows = db.session.query(Acupoint.meridian_id, Acupoint.name)\
+            .filter(Acupoint.meridian_id.in_(list(template_ids.values())))\
+            .order_by(Acupoint.id)
+        for meridian_id, name in rows:
+            acupoints.setdefault(meridian_id, []).append(name)
+    return [
+        MeridianTemplate(name, meridian_type, coefficient, tuple(acupoints.get(template_ids[name], ())))
+        for name, meridian_type, coefficient in MERIDIAN_DEFINITIONS
+        if name in template_ids
+    ]
+
+# 静态数据目录（怪物、副本、境界、材料、经脉模板），启动时加载，运行期只读
+catalog = None
+
+def reload_catalog():
+    """从数据库重新加载静态数据目录，修改怪物/副本/境界/材料/经脉模板数据后需调用"""
+    global catalog
+    version = catalog.version + 1 if catalog else 1
+    catalog = GameCatalog.from_rows(
+        Monster.query.all(), Dungeon.query.all(), Realm.query.all(), Material.query.all(),
+        meridian_templates=load_meridian_templates(),
+        version=version
+    )
+    return catalog
+
+# 定时任务调度器，任务在应用上下文中执行
+scheduler = PeriodicScheduler()
+
+# 本进程在定时任务租约中的标识
+JOB_LEASE_OWNER = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+# 租约时长占任务间隔的比例，略短于间隔，持有者下个周期到点时租约已过期
+JOB_LEASE_FRACTION = 0.9
+
+def acquire_job_lease(name, seconds):
+    """抢占定时任务租约：租约不存在或已过期时占用 seconds 秒，返回是否抢到（会提交）"""
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=seconds)
+    acquired = db.session.execute(
+        db.update(JobLease).where(JobLease.name == name, JobLease.expires_at <= now)
+        .values(owner=JOB_LEASE_OWNER, expires_at=expires_at)
+        .execution_options(synchronize_session=False)
+    ).rowcount > 0
+    if not acquired and db.session.get(JobLease, name) is None:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(JobLease).values(name=name, owner=JOB_LEASE_OWNER, expires_at=expires_at))
+            acquired = True
+        except IntegrityError:
+            pass  # 其他进程同时创建了租约
+    db.session.commit()
+    return acquired
+
+def leased_job(name, interval, func):
+    """包装全局每周期只应执行一次的定时任务
+
+    多个 gunicorn worker 都开启 ENABLE_SCHEDULER、或同时运行 scripts/worker.py 时，
+    每个周期只有抢到数据库租约的进程执行，其余进程跳过（返回 None）。
+    """
+    def run():
+        with app.app_context():
+            if not acquire_job_lease(name, interval * JOB_LEASE_FRACTION):
+                return None
+            return func()
+    return run
+
+scheduler.register('sect_contribution_fold', app.config['SECT_CONTRIBUTION_FOLD_INTERVAL'],
+                   leased_job('sect_contribution_fold', app.config['SECT_CONTRIBUTION_FOLD_INTERVAL'],
+                              run_sect_contribution_fold))
+
+def migrate_database():
+    """升级已有数据库：合并旧版本留下的重复数据、补齐新增的列和索引并回填，返回新增的 (表名, 列名) 集合
+
+    含 ALTER TABLE 等 DDL，多个 Web 进程同时启动时会竞争执行，因此不在导入时运行，
+    而是部署时用 scripts/migrate.py 执行一次。
+    """
+    db.create_all()
+    normalize_friendships()
+    normalize_wallets()
+    normalize_guaranteed_drops()
+    normalize_arenas()
+    added_columns = upgrade_schema()
+    relax_mail_sender()
+    if (Sect.__tablename__, 'member_count') in added_columns:
+        init_sect_member_counts()
+    if (Team.__tablename__, 'member_count') in added_columns:
+        init_team_member_counts()
+    return added_columns
+
+# 在应用启动时初始化数据（表结构升级见 migrate_database）
 with app.app_context():
     db.create_all()
     init_realms()
     init_monsters()
     init_dungeons()
     init_materials()
+    init_battle_power_rankings()
+    reload_catalog()
 
 # JWT相关
-def encode_auth_token(user_id):
+def encode_auth_token(user_id, character_id=None):
     try:
         payload = {
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1),
             'iat': datetime.datetime.utcnow(),
             'sub': user_id
         }
+        # 多人物账号可在令牌中指定当前使用的人物
+        if character_id is not None:
+            payload['character_id'] = character_id
         return jwt.encode(payload, app.config.get('SECRET_KEY'), algorithm='HS256')
     except Exception as e:
         return e
 
 
+def decode_auth_claims(auth_token):
+    """解析令牌并返回全部声明，令牌无效时抛出 jwt.InvalidTokenError"""
+    return jwt.decode(auth_token, app.config.get('SECRET_KEY'), algorithms=['HS256'])
+
+
 def decode_auth_token(auth_token):
     try:
-        payload = jwt.decode(auth_token, app.config.get('SECRET_KEY'), algorithms=['HS256'])
+        payload = decode_auth_claims(auth_token)
         return payload['sub']
     except jwt.ExpiredSignatureError:
         return 'Signature expired. Please log in again.'
@@ -441,6 +1026,38 @@ def decode_auth_token(auth_token):
         return 'Invalid token. Please log in again.'
 
 
+def load_request_context(user_id, character_id=None):
+    """一次查询取出用户、当前人物、人物属性和灵石钱包，存入 flask.g
+
+    未指定人物时使用该账号最早创建的人物（与原先各接口的 filter_by(...).first() 一致）。
+    返回用户对象，用户不存在时返回 None。
+    """
+    character_join = Character.user_id == User.id
+    if character_id is not None:
+        character_join = db.and_(character_join, Character.id == character_id)
+
+    row = db.session.query(User, Character, CharacterAttribute, Resource).outerjoin(
+        Character, character_join
+    ).outerjoin(
+        CharacterAttribute, CharacterAttribute.character_id == Character.id
+    ).outerjoin(
+        Resource, db.and_(Resource.character_id == Character.id, Resource.type == '灵石')
+    ).filter(User.id == user_id).order_by(Character.id, Resource.id).first()
+
+    if row is None:
+        return None
+    user, g.character, g.attributes, g.wallet = row
+    g.character_explicit = character_id is not None
+    return user
+
+
+def latest_character(current_user):
+    """未显式指定人物时返回账号下最新创建的人物（人物信息、升级、突破接口沿用的规则）"""
+    if g.character_explicit:
+        return g.character
+    return Character.query.filter_by(user_id=current_user.id).order_by(Character.id.desc()).first()
+
+
 # 认证装饰器
 from functools import wraps
 
@@ -452,15 +1069,36 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
         try:
-            user_id = decode_auth_token(token)
-            current_user = db.session.get(User, user_id)
-        except:
+            claims = decode_auth_claims(token)
+        except Exception:
+            return jsonify({'message': 'Token is invalid!'}), 401
+
+        # 请求头优先于令牌中的人物声明
+        character_id = request.headers.get('X-Character-Id') or claims.get('character_id')
+        try:
+            character_id = int(character_id) if character_id is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid character id'}), 400
+
+        current_user = load_request_context(claims['sub'], character_id)
+        if current_user is None:
             return jsonify({'message': 'Token is invalid!'}), 401
         return f(current_user, *args, **kwargs)
 
     return decorated
 
 
+def character_required(f):
+    """需要当前人物的接口：账号下没有（或请求头指定的）人物时返回 404，须放在 token_required 之后"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if g.character is None:
+            return jsonify({'message': '角色不存在'}), 404
+        return f(*args, **kwargs)
+
+    return decorated
+
+
 # 用户注册
 @app.route('/register', methods=['POST'])
 def register():
@@ -511,7 +1149,7 @@ def login():
     user = User.query.filter_by(username=data['username']).first()
     if not user or not check_password_hash(user.password_hash, data['password']):
         return jsonify({'message': 'Invalid credentials'}), 401
-    token = encode_auth_token(user.id)
+    token = encode_auth_token(user.id, data.get('character_id'))
     return jsonify({'token': token}), 200
 
 
@@ -564,8 +1202,12 @@ def create_character(current_user):
     # 初始化灵石资源
     resource = Resource(character_id=new_char.id, type='灵石', amount=1000)
 
+    # 写入战力排行榜
+    ranking = Ranking(character_id=new_char.id, type='battle_power', score=compute_battle_power(attr))
+
     db.session.add(attr)
     db.session.add(resource)
+    db.session.add(ranking)
     db.session.commit()
     return jsonify({'message': 'Character created successfully!'}), 201
 
@@ -575,7 +1217,7 @@ def create_character(current_user):
 @token_required
 def get_character(current_user):
     # 返回当前用户最新创建的人物（按 id 倒序）以避免测试/多人物场景混淆
-    char = Character.query.filter_by(user_id=current_user.id).order_by(Character.id.desc()).first()
+    char = latest_character(current_user)
     if not char:
         return jsonify({'message': 'No character found'}), 404
     attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
@@ -602,11 +1244,13 @@ def get_character(current_user):
 @app.route('/character/levelup', methods=['POST'])
 @token_required
 def levelup_character(current_user):
+    """人物升级（max=true 时升到经验允许的最高等级，levels 指定最多升几级，均不越过境界关卡）"""
+    data = request.get_json(silent=True) or {}
     # 优先使用最新创建的人物；若该人物经验不足，则尝试查找同一账号下任何已有足够经验的人物
-    char = Character.query.filter_by(user_id=current_user.id).order_by(Character.id.desc()).first()
+    char = latest_character(current_user)
     if not char:
         return jsonify({'message': 'No character found'}), 404
-    needed = exp_for_level(char.level)
+    needed = exp_needed(char.level)
     if char.experience < needed:
         # 查找其他人物是否有足够经验（兼容测试中可能修改了旧人物的场景）
         alt = Character.query.filter(Character.user_id == current_user.id, Character.experience >= needed).order_by(Character.id.desc()).first()
@@ -619,21 +1263,39 @@ def levelup_character(current_user):
     if char.level % 10 == 0:
         return jsonify({'message': '需要境界突破才能继续升级', 'need_realm_breakthrough': True}), 400
 
+    # 本次最多可升级数：不超过下一个境界关卡
+    max_levels = 10 - char.level % 10
+    if not data.get('max'):
+        try:
+            max_levels = min(max_levels, max(1, int(data.get('levels', 1))))
+        except (TypeError, ValueError):
+            return jsonify({'message': 'Invalid levels'}), 400
+    levels = max(1, affordable_levels(char.level, char.experience, max_levels))
+
     attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
-    realm = Realm.query.filter_by(name=char.realm).first()
+    realm = catalog.realm(char.realm)
     realm_coeff = realm.coefficient if realm else 0.0
     # 扣除经验并升级
-    char.experience -= needed
-    incs = apply_level_up(char, attr, realm_coeff)
+    cost = exp_cost(char.level, levels)
+    char.experience -= cost
+    incs = apply_level_up(char, attr, realm_coeff, levels)
+    refresh_character_stats(char.id)
     db.session.commit()
-    return jsonify({'message': 'Level up successful!', 'increments': incs, 'new_level': char.level}), 200
+    return jsonify({
+        'message': 'Level up successful!',
+        'increments': incs,
+        'new_level': char.level,
+        'levels_gained': levels,
+        'exp_cost': cost,
+        'need_realm_breakthrough': char.level % 10 == 0
+    }), 200
 
 
 # 境界突破API
 @app.route('/character/realm_breakthrough', methods=['POST'])
 @token_required
 def realm_breakthrough(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).order_by(Character.id.desc()).first()
+    char = latest_character(current_user)
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -642,31 +1304,33 @@ def realm_breakthrough(current_user):
         return jsonify({'message': '等级不足，无法突破境界'}), 400
 
     # 获取当前境界和下一个境界
-    current_realm = Realm.query.filter_by(name=char.realm).first()
+    current_realm = catalog.realm(char.realm)
     if not current_realm:
         return jsonify({'message': '境界数据错误'}), 500
 
-    next_realm = Realm.query.filter(Realm.stage > current_realm.stage).order_by(Realm.stage).first()
+    next_realm = catalog.next_realm(current_realm.name)
     if not next_realm:
         return jsonify({'message': '已达到最高境界'}), 400
 
     # 检查资源要求（灵石消耗）
     breakthrough_cost = 1000 * (current_realm.stage + 1)  # 突破消耗随境界增加
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < breakthrough_cost:
-        return jsonify({'message': f'灵石不足，需要{breakthrough_cost}灵石', 'required_lingshi': breakthrough_cost}), 400
 
     # 境界突破逻辑
     data = request.get_json() or {}
     purity = data.get('purity', 0.5)  # 纯度系数，默认0.5
     success_rate = min(0.8, purity * 0.9 + 0.1)  # 成功率基于纯度，最低10%，最高80%
+    success = random.random() < success_rate
 
-    if random.random() < success_rate:
+    # 需持有全额灵石；成功扣全额，失败只扣一半
+    failure_cost = breakthrough_cost // 2
+    if not wallet_debit(char.id, breakthrough_cost if success else failure_cost, required=breakthrough_cost):
+        return jsonify({'message': f'灵石不足，需要{breakthrough_cost}灵石', 'required_lingshi': breakthrough_cost}), 400
+
+    if success:
         # 突破成功
         char.realm = next_realm.name
         char.level = 1  # 境界突破后等级重置为1
         char.experience = 0  # 经验清零
-        resource.amount -= breakthrough_cost
 
         # 境界突破属性提升
         attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
@@ -675,6 +1339,7 @@ def realm_breakthrough(current_user):
         attr.attack += realm_bonus * 2
         attr.defense += realm_bonus * 2
         attr.speed += realm_bonus
+        refresh_character_stats(char.id)
 
         db.session.commit()
         return jsonify({
@@ -690,8 +1355,6 @@ def realm_breakthrough(current_user):
         }), 200
     else:
         # 突破失败，消耗部分灵石
-        failure_cost = breakthrough_cost // 2
-        resource.amount -= failure_cost
         db.session.commit()
         return jsonify({
             'message': '境界突破失败',
@@ -704,10 +1367,10 @@ def realm_breakthrough(current_user):
 @app.route('/character/battle_power', methods=['GET'])
 @token_required
 def get_battle_power(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
-    attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+    attr = g.attributes
     equipments = Equipment.query.filter_by(character_id=char.id).all()
     mantras = Mantra.query.filter_by(character_id=char.id).all()
     treasures = Treasure.query.filter_by(character_id=char.id).all()
@@ -721,7 +1384,7 @@ def get_battle_power(current_user):
 @app.route('/equipment', methods=['GET'])
 @token_required
 def get_equipments(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -750,26 +1413,30 @@ def get_equipments(current_user):
     } for e in eqs]), 200
 
 
+# 装备栏位类型定义
+EQUIPMENT_SLOT_TYPES = {
+    1: '武器',
+    2: '头盔',
+    3: '项链',
+    4: '衣服',
+    5: '腰带',
+    6: '鞋子',
+    7: '耳环',
+    8: '戒指',
+    9: '手镯',
+    10: '护符'
+}
+EQUIPMENT_TYPE_SLOTS = {equip_type: slot for slot, equip_type in EQUIPMENT_SLOT_TYPES.items()}
+
+
 def init_equipment_slots(character_id):
     """初始化角色的10个装备栏位"""
-    # 装备栏位类型定义
-    slot_types = {
-        1: '武器',
-        2: '头盔',
-        3: '项链',
-        4: '衣服',
-        5: '腰带',
-        6: '鞋子',
-        7: '耳环',
-        8: '戒指',
-        9: '手镯',
-        10: '护符'
-    }
-
-    for slot, equip_type in slot_types.items():
+    created = False
+    for slot, equip_type in EQUIPMENT_SLOT_TYPES.items():
         # 检查是否已有该栏位的装备
         existing = Equipment.query.filter_by(character_id=character_id, slot=slot).first()
         if not existing:
+            created = True
             # 创建基础装备
             base_equipment = Equipment(
                 character_id=character_id,
@@ -782,13 +1449,16 @@ def init_equipment_slots(character_id):
             )
             db.session.add(base_equipment)
 
+    if created:
+        refresh_character_stats(character_id)
     db.session.commit()
 
 @app.route('/equipment/upgrade/<int:equip_id>', methods=['POST'])
 @token_required
+@character_required
 def upgrade_equipment(current_user, equip_id):
     equip = db.session.get(Equipment, equip_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not equip or equip.character_id != char.id:
         return jsonify({'message': 'Equipment not found'}), 404
 
@@ -809,14 +1479,12 @@ def upgrade_equipment(current_user, equip_id):
     lingshi_needed = int(exp_needed * 0.5)  # 灵石消耗为经验的一半
 
     # 检查资源
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < lingshi_needed:
+    if not wallet_debit(char.id, lingshi_needed):
         return jsonify({'message': f'Not enough ling shi, need {lingshi_needed}', 'required': lingshi_needed}), 400
 
     # 升级装备
     equip.level += 1
     equip.experience += exp_needed
-    resource.amount -= lingshi_needed
 
     # 根据装备类型更新属性
     if equip.type == '武器':
@@ -830,6 +1498,7 @@ def upgrade_equipment(current_user, equip_id):
     else:
         equip.attack_bonus += int(2 * multiplier)
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({
         'message': f'Equipment upgraded to level {equip.level}!',
@@ -841,9 +1510,10 @@ def upgrade_equipment(current_user, equip_id):
 
 @app.route('/equipment/strengthen/<int:equip_id>', methods=['POST'])
 @token_required
+@character_required
 def strengthen_equipment(current_user, equip_id):
     equip = db.session.get(Equipment, equip_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not equip or equip.character_id != char.id:
         return jsonify({'message': 'Equipment not found'}), 404
 
@@ -852,54 +1522,72 @@ def strengthen_equipment(current_user, equip_id):
         return jsonify({'message': 'Equipment has reached maximum strengthen level'}), 400
 
     # 消耗灵石（根据装备品质和强化次数计算）
-    data = request.get_json() or {}
+    data = request.get_json(silent=True) or {}
+    count = parse_batch_count(data, limit=20 - equip.strengthen_times)
+    if count is None:
+        return jsonify({'message': 'Invalid count'}), 400
     material_quality = float(data.get('material_quality_factor', 1.0))
     quality_multipliers = {'黄阶': 1.0, '玄阶': 1.5, '地阶': 2.0, '天阶': 3.0}
     quality_multiplier = quality_multipliers.get(equip.quality, 1.0)
     base_cost = 100
-    cost = int(base_cost * (equip.level + 1) * quality_multiplier * (1 + equip.strengthen_times * 0.1))
+    # 每次强化的消耗只取决于已强化次数，可一次算出全部消耗并只扣一次款
+    costs = [int(base_cost * (equip.level + 1) * quality_multiplier * (1 + t * 0.1))
+             for t in range(equip.strengthen_times, equip.strengthen_times + count)]
+    cost = sum(costs)
 
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < cost:
+    if not wallet_debit(char.id, cost):
         return jsonify({'message': f'Not enough ling shi, need {cost}', 'required': cost}), 400
 
-    # 计算成功率（使用衰减公式）
-    success_rate = calc_strengthen_success(equip.strengthen_times, material_quality_factor=material_quality)
+    # 计算成功率（使用衰减公式），所有随机数一次取出
+    rolls = batch_uniforms(count)
+    strengthen_bonus = int((5 + equip.level) * quality_multiplier * material_quality)
+    successes = 0
+    for roll in rolls:
+        success_rate = calc_strengthen_success(equip.strengthen_times, material_quality_factor=material_quality)
+        if roll < success_rate:
+            # 强化成功，提高属性
+            successes += 1
+            if equip.type == '武器':
+                equip.attack_bonus += strengthen_bonus
+            elif equip.type in ['头盔', '衣服']:
+                equip.defense_bonus += strengthen_bonus // 2
+                equip.hp_bonus += strengthen_bonus
+            else:
+                equip.attack_bonus += strengthen_bonus // 2
+        # 失败同样计入强化次数（可能导致装备损坏，但这里简化）
+        equip.strengthen_times += 1
 
-    resource.amount -= cost
-    if random.random() < success_rate:
-        # 强化成功，提高属性
-        strengthen_bonus = int((5 + equip.level) * quality_multiplier * material_quality)
-        if equip.type == '武器':
-            equip.attack_bonus += strengthen_bonus
-        elif equip.type in ['头盔', '衣服']:
-            equip.defense_bonus += strengthen_bonus // 2
-            equip.hp_bonus += strengthen_bonus
-        else:
-            equip.attack_bonus += strengthen_bonus // 2
+    if successes:
+        refresh_character_stats(char.id)
+    db.session.commit()
 
-        equip.strengthen_times += 1
-        db.session.commit()
+    if count > 1:
         return jsonify({
-            'message': f'强化成功！装备属性提升{strengthen_bonus}',
-            'success_rate': success_rate,
+            'message': f'强化{count}次，成功{successes}次',
+            'attempts': count,
+            'successes': successes,
+            'total_bonus': strengthen_bonus * successes,
             'strengthen_level': equip.strengthen_times,
             'cost': cost
         }), 200
-    else:
-        # 强化失败，记录失败次数（可能导致装备损坏，但这里简化）
-        equip.strengthen_times += 1
-        db.session.commit()
+    if successes:
         return jsonify({
-            'message': '强化失败',
+            'message': f'强化成功！装备属性提升{strengthen_bonus}',
             'success_rate': success_rate,
             'strengthen_level': equip.strengthen_times,
             'cost': cost
-        }), 400
+        }), 200
+    return jsonify({
+        'message': '强化失败',
+        'success_rate': success_rate,
+        'strengthen_level': equip.strengthen_times,
+        'cost': cost
+    }), 400
 
 
 @app.route('/rune/forge', methods=['POST'])
 @token_required
+@character_required
 def forge_rune(current_user):
     data = request.get_json() or {}
     name = data.get('name', '符文')
@@ -907,29 +1595,41 @@ def forge_rune(current_user):
     attr_type = data.get('attribute_type', 'attack')
     attr_value = int(data.get('attribute_value', 1))
     material_quality = float(data.get('material_quality_factor', 1.0))
+    count = parse_batch_count(data)
+    if count is None:
+        return jsonify({'message': 'Invalid count'}), 400
 
     # 简化成本
-    char = Character.query.filter_by(user_id=current_user.id).first()
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    cost = 200
-    if not resource or resource.amount < cost:
+    char = g.character
+    cost = 200 * count
+    if not wallet_debit(char.id, cost):
         return jsonify({'message': 'Not enough ling shi'}), 400
 
     success_rate = calc_forge_success(material_quality_factor=material_quality)
-    import random
-    resource.amount -= cost
-    if random.random() < success_rate:
-        rune = Rune(name=name, quality=quality, attribute_type=attr_type, attribute_value=attr_value, owner_id=char.id)
-        db.session.add(rune)
-        db.session.commit()
-        return jsonify({'message': 'Forge success', 'rune_id': rune.id, 'success_rate': success_rate}), 201
-    else:
-        db.session.commit()
-        return jsonify({'message': 'Forge failed', 'success_rate': success_rate}), 400
+    runes = [
+        Rune(name=name, quality=quality, attribute_type=attr_type, attribute_value=attr_value, owner_id=char.id)
+        for roll in batch_uniforms(count) if roll < success_rate
+    ]
+    db.session.add_all(runes)
+    db.session.commit()
+
+    if count > 1:
+        return jsonify({
+            'message': f'锻造{count}次，成功{len(runes)}次',
+            'attempts': count,
+            'successes': len(runes),
+            'rune_ids': [rune.id for rune in runes],
+            'success_rate': success_rate,
+            'cost': cost
+        }), 200
+    if runes:
+        return jsonify({'message': 'Forge success', 'rune_id': runes[0].id, 'success_rate': success_rate}), 201
+    return jsonify({'message': 'Forge failed', 'success_rate': success_rate}), 400
 
 
 @app.route('/rune/equip/equipment', methods=['POST'])
 @token_required
+@character_required
 def equip_rune_to_equipment(current_user):
     data = request.get_json() or {}
     rune_id = data.get('rune_id')
@@ -938,7 +1638,7 @@ def equip_rune_to_equipment(current_user):
     equip = db.session.get(Equipment, equip_id)
     if not rune or not equip:
         return jsonify({'message': 'Rune or Equipment not found'}), 404
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if rune.owner_id != char.id or equip.character_id != char.id:
         return jsonify({'message': 'Not your rune/equipment'}), 403
 
@@ -960,12 +1660,14 @@ def equip_rune_to_equipment(current_user):
         equip.attack_bonus += rune.attribute_value
 
     rune.equipment_id = equip.id
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': 'Rune equipped to equipment', 'equip_id': equip.id, 'rune_id': rune.id}), 200
 
 
 @app.route('/rune/equip/treasure', methods=['POST'])
 @token_required
+@character_required
 def equip_rune_to_treasure(current_user):
     data = request.get_json() or {}
     rune_id = data.get('rune_id')
@@ -974,7 +1676,7 @@ def equip_rune_to_treasure(current_user):
     tr = db.session.get(Treasure, treasure_id)
     if not rune or not tr:
         return jsonify({'message': 'Rune or Treasure not found'}), 404
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if rune.owner_id != char.id or tr.character_id != char.id:
         return jsonify({'message': 'Not your rune/treasure'}), 403
 
@@ -995,6 +1697,7 @@ def equip_rune_to_treasure(current_user):
         tr.attack_bonus += rune.attribute_value
 
     rune.treasure_id = tr.id
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': 'Rune equipped to treasure', 'treasure_id': tr.id, 'rune_id': rune.id}), 200
 
@@ -1003,7 +1706,7 @@ def equip_rune_to_treasure(current_user):
 @token_required
 def get_runes(current_user):
     """获取角色的符文列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1022,10 +1725,11 @@ def get_runes(current_user):
 
 @app.route('/equipment/unequip/<int:equip_id>', methods=['POST'])
 @token_required
+@character_required
 def unequip_equipment(current_user, equip_id):
     """卸下装备"""
     equip = db.session.get(Equipment, equip_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not equip or equip.character_id != char.id:
         return jsonify({'message': 'Equipment not found'}), 404
 
@@ -1033,16 +1737,18 @@ def unequip_equipment(current_user, equip_id):
         return jsonify({'message': 'Equipment already unequipped'}), 400
 
     equip.equipped = False
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': 'Equipment unequipped successfully'}), 200
 
 
 @app.route('/equipment/equip/<int:equip_id>', methods=['POST'])
 @token_required
+@character_required
 def equip_equipment(current_user, equip_id):
     """装备物品"""
     equip = db.session.get(Equipment, equip_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not equip or equip.character_id != char.id:
         return jsonify({'message': 'Equipment not found'}), 404
 
@@ -1060,35 +1766,36 @@ def equip_equipment(current_user, equip_id):
         existing_equipped.equipped = False
 
     equip.equipped = True
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': 'Equipment equipped successfully'}), 200
 
 
 @app.route('/treasure/upgrade/<int:treasure_id>', methods=['POST'])
 @token_required
+@character_required
 def upgrade_treasure(current_user, treasure_id):
     tr = db.session.get(Treasure, treasure_id)
     if not tr:
         return jsonify({'message': 'Treasure not found'}), 404
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if tr.character_id != char.id:
         return jsonify({'message': 'Not your treasure'}), 403
     # 简化升级逻辑：消耗灵石，提高等级和属性
     char = Character.query.filter_by(user_id=User.query.filter_by(username='').first().id).first() if False else Character.query.filter_by(user_id=tr.character_id).first()
-    resource = Resource.query.filter_by(character_id=tr.character_id, type='灵石').first()
     cost = 150 * (tr.level + 1)
-    if not resource or resource.amount < cost:
+    if not wallet_debit(tr.character_id, cost):
         return jsonify({'message': 'Not enough ling shi'}), 400
-    resource.amount -= cost
     tr.level += 1
     tr.attack_bonus += 10
+    refresh_character_stats(tr.character_id)
     db.session.commit()
     return jsonify({'message': 'Treasure upgraded', 'new_level': tr.level}), 200
 
 @app.route('/treasure', methods=['GET'])
 @token_required
 def get_treasures(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
     trs = Treasure.query.filter_by(character_id=char.id).all()
@@ -1102,22 +1809,28 @@ def get_treasures(current_user):
 
 @app.route('/treasure/forge', methods=['POST'])
 @token_required
+@character_required
 def forge_treasure(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     data = request.get_json()
     # 更完整的锻造流程：消耗灵石 -> 依据材料品质计算成功率 -> 成功则生成品质与属性
     material_quality = float(data.get('material_quality_factor', 1.0))
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    cost = int(800 * material_quality)
-    if not resource or resource.amount < cost:
+    count = parse_batch_count(data)
+    if count is None:
+        return jsonify({'message': 'Invalid count'}), 400
+    cost = int(800 * material_quality) * count
+    if not wallet_debit(char.id, cost):
         return jsonify({'message': 'Not enough ling shi', 'required': cost}), 400
 
     success_rate = calc_forge_success(material_quality_factor=material_quality)
-    if random.random() < success_rate:
+    new_treasures = []
+    for roll in batch_uniforms(count):
+        if roll >= success_rate:
+            continue  # 失败消耗材料
         quality = roll_treasure_quality(material_quality)
         stats = generate_treasure_stats(quality)
         name = data.get('name') or f"{quality}法宝"
-        new_treasure = Treasure(
+        new_treasures.append(Treasure(
             character_id=char.id,
             slot=int(data.get('slot', 1)),
             name=name,
@@ -1126,32 +1839,43 @@ def forge_treasure(current_user):
             defense_bonus=stats['defense_bonus'],
             hp_bonus=stats['hp_bonus'],
             rune_slots=stats.get('rune_slots', 1)
-        )
-        resource.amount -= cost
-        db.session.add(new_treasure)
-        db.session.commit()
+        ))
+
+    if new_treasures:
+        db.session.add_all(new_treasures)
+        refresh_character_stats(char.id)
+    db.session.commit()
+
+    treasures_data = [{
+        'id': t.id,
+        'name': t.name,
+        'quality': t.quality,
+        'attack_bonus': t.attack_bonus,
+        'defense_bonus': t.defense_bonus,
+        'hp_bonus': t.hp_bonus,
+        'rune_slots': t.rune_slots
+    } for t in new_treasures]
+
+    if count > 1:
+        return jsonify({
+            'message': f'锻造{count}次，成功{len(new_treasures)}次',
+            'attempts': count,
+            'successes': len(new_treasures),
+            'treasures': treasures_data,
+            'success_rate': success_rate,
+            'cost': cost
+        }), 200
+    if new_treasures:
         return jsonify({
             'message': 'Treasure forged successfully!',
-            'treasure': {
-                'id': new_treasure.id,
-                'name': new_treasure.name,
-                'quality': new_treasure.quality,
-                'attack_bonus': new_treasure.attack_bonus,
-                'defense_bonus': new_treasure.defense_bonus,
-                'hp_bonus': new_treasure.hp_bonus,
-                'rune_slots': new_treasure.rune_slots
-            }
+            'treasure': treasures_data[0]
         }), 201
-    else:
-        # 失败消耗材料
-        resource.amount -= cost
-        db.session.commit()
-        return jsonify({'message': 'Forging failed', 'success_rate': success_rate}), 400
+    return jsonify({'message': 'Forging failed', 'success_rate': success_rate}), 400
 
 @app.route('/mantra', methods=['GET'])
 @token_required
 def get_mantras(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1180,10 +1904,11 @@ def get_mantras(current_user):
 
 @app.route('/mantra/upgrade/<int:mantra_id>', methods=['POST'])
 @token_required
+@character_required
 def upgrade_mantra(current_user, mantra_id):
     """功法升级API"""
     mantra = db.session.get(Mantra, mantra_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not mantra or mantra.character_id != char.id:
         return jsonify({'message': 'Mantra not found'}), 404
 
@@ -1197,20 +1922,18 @@ def upgrade_mantra(current_user, mantra_id):
 
     costs = mantra_upgrade_cost(mantra.level, mantra.quality, char.wuxing, weather_bonus)
 
-    # 检查资源
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < costs['lingshi']:
-        return jsonify({'message': f'Not enough ling shi, need {costs["lingshi"]}', 'required': costs['lingshi']}), 400
-
     # 检查经验
     if char.experience < costs['experience']:
         return jsonify({'message': f'Not enough experience, need {costs["experience"]}', 'required': costs['experience']}), 400
 
+    # 检查并扣除灵石
+    if not wallet_debit(char.id, costs['lingshi']):
+        return jsonify({'message': f'Not enough ling shi, need {costs["lingshi"]}', 'required': costs['lingshi']}), 400
+
     # 升级功法
     mantra.level += 1
     mantra.experience += costs['experience']
     char.experience -= costs['experience']
-    resource.amount -= costs['lingshi']
 
     # 根据品质更新属性
     quality_multipliers = {'黄阶': 1.0, '玄阶': 1.5, '地阶': 2.0, '天阶': 3.0}
@@ -1223,6 +1946,7 @@ def upgrade_mantra(current_user, mantra_id):
     mantra.speed_bonus = int(level_bonus * 0.5)
     mantra.crit_rate_bonus = level_bonus * 0.005
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({
         'message': f'Mantra upgraded to level {mantra.level}!',
@@ -1236,10 +1960,11 @@ def upgrade_mantra(current_user, mantra_id):
 
 @app.route('/mantra/cultivate/<int:mantra_id>', methods=['POST'])
 @token_required
+@character_required
 def cultivate_mantra_api(current_user, mantra_id):
     """功法修炼API"""
     mantra = db.session.get(Mantra, mantra_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not mantra or mantra.character_id != char.id:
         return jsonify({'message': 'Mantra not found'}), 404
 
@@ -1274,10 +1999,11 @@ def cultivate_mantra_api(current_user, mantra_id):
 
 @app.route('/mantra/equip/<int:mantra_id>', methods=['POST'])
 @token_required
+@character_required
 def equip_mantra(current_user, mantra_id):
     """装备功法"""
     mantra = db.session.get(Mantra, mantra_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not mantra or mantra.character_id != char.id:
         return jsonify({'message': 'Mantra not found'}), 404
 
@@ -1296,16 +2022,18 @@ def equip_mantra(current_user, mantra_id):
     mantra.equipped = True
     mantra.slot = slot
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': f'Mantra equipped to slot {slot}'}), 200
 
 
 @app.route('/mantra/unequip/<int:mantra_id>', methods=['POST'])
 @token_required
+@character_required
 def unequip_mantra(current_user, mantra_id):
     """卸下功法"""
     mantra = db.session.get(Mantra, mantra_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not mantra or mantra.character_id != char.id:
         return jsonify({'message': 'Mantra not found'}), 404
 
@@ -1315,25 +2043,25 @@ def unequip_mantra(current_user, mantra_id):
     mantra.equipped = False
     mantra.slot = 0
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({'message': 'Mantra unequipped successfully'}), 200
 
 
 @app.route('/treasure/awaken/<int:treasure_id>', methods=['POST'])
 @token_required
+@character_required
 def awaken_treasure(current_user, treasure_id):
     tre = db.session.get(Treasure, treasure_id)
-    if not tre or tre.character_id != Character.query.filter_by(user_id=current_user.id).first().id:
+    if not tre or tre.character_id != g.character.id:
         return jsonify({'message': 'Treasure not found or not yours'}), 404
     data = request.get_json() or {}
     material_quality = float(data.get('material_quality_factor', 1.0))
-    resource = Resource.query.filter_by(character_id=tre.character_id, type='灵石').first()
     cost = int(1500 * material_quality)
-    if not resource or resource.amount < cost:
+    if not wallet_debit(tre.character_id, cost):
         return jsonify({'message': 'Not enough ling shi', 'required': cost}), 400
 
     rate = awaken_success_rate(tre.quality, material_quality_factor=material_quality)
-    resource.amount -= cost
     success = random.random() < rate
     if success:
         tre.awakened = True
@@ -1349,19 +2077,18 @@ def awaken_treasure(current_user, treasure_id):
 
 @app.route('/treasure/recast/<int:treasure_id>', methods=['POST'])
 @token_required
+@character_required
 def recast_treasure(current_user, treasure_id):
     tre = db.session.get(Treasure, treasure_id)
-    if not tre or tre.character_id != Character.query.filter_by(user_id=current_user.id).first().id:
+    if not tre or tre.character_id != g.character.id:
         return jsonify({'message': 'Treasure not found or not yours'}), 404
     data = request.get_json() or {}
     material_quality = float(data.get('material_quality_factor', 1.0))
-    resource = Resource.query.filter_by(character_id=tre.character_id, type='灵石').first()
     cost = int(1200 * (1 + tre.recast_times * 0.5) * material_quality)
-    if not resource or resource.amount < cost:
+    if not wallet_debit(tre.character_id, cost):
         return jsonify({'message': 'Not enough ling shi', 'required': cost}), 400
 
     success_rate = calc_forge_success(material_quality_factor=material_quality)
-    resource.amount -= cost
     tre.recast_times = (tre.recast_times or 0) + 1
     if random.random() < success_rate:
         stats = generate_treasure_stats(tre.quality)
@@ -1369,6 +2096,7 @@ def recast_treasure(current_user, treasure_id):
         tre.defense_bonus = stats['defense_bonus']
         tre.hp_bonus = stats['hp_bonus']
         tre.rune_slots = stats.get('rune_slots', tre.rune_slots)
+        refresh_character_stats(tre.character_id)
         db.session.commit()
         return jsonify({'message': 'Recast success', 'new_stats': {
             'attack_bonus': tre.attack_bonus,
@@ -1384,12 +2112,13 @@ def recast_treasure(current_user, treasure_id):
 
 @app.route('/treasure/estimate', methods=['POST'])
 @token_required
+@character_required
 def estimate_treasure(current_user):
     data = request.get_json() or {}
     treasure_id = data.get('treasure_id')
     material_quality = float(data.get('material_quality_factor', 1.0))
     tre = db.session.get(Treasure, treasure_id)
-    if not tre or tre.character_id != Character.query.filter_by(user_id=current_user.id).first().id:
+    if not tre or tre.character_id != g.character.id:
         return jsonify({'message': 'Treasure not found or not yours'}), 404
 
     awaken_rate = awaken_success_rate(tre.quality, material_quality_factor=material_quality)
@@ -1407,9 +2136,10 @@ def estimate_treasure(current_user):
 
 @app.route('/mantra/cultivate/<int:mantra_id>', methods=['POST'])
 @token_required
+@character_required
 def cultivate_mantra(current_user, mantra_id):
     mantra = db.session.get(Mantra, mantra_id)
-    if not mantra or mantra.character_id != Character.query.filter_by(user_id=current_user.id).first().id:
+    if not mantra or mantra.character_id != g.character.id:
         return jsonify({'message': 'Mantra not found'}), 404
     # 修炼逻辑
     exp_gain = 10  # 简化
@@ -1423,7 +2153,7 @@ def cultivate_mantra(current_user, mantra_id):
 @app.route('/shentong', methods=['GET'])
 @token_required
 def get_shentongs(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1446,10 +2176,11 @@ def get_shentongs(current_user):
 
 @app.route('/shentong/upgrade/<int:shentong_id>', methods=['POST'])
 @token_required
+@character_required
 def upgrade_shentong(current_user, shentong_id):
     """神通升级API"""
     shentong = db.session.get(Shentong, shentong_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not shentong or shentong.character_id != char.id:
         return jsonify({'message': 'Shentong not found'}), 404
 
@@ -1461,19 +2192,17 @@ def upgrade_shentong(current_user, shentong_id):
     exp_needed = shentong_exp_for_level(shentong.level)
     lingshi_needed = int(exp_needed * 0.8)  # 灵石消耗为经验的80%
 
-    # 检查资源
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < lingshi_needed:
-        return jsonify({'message': f'Not enough ling shi, need {lingshi_needed}', 'required': lingshi_needed}), 400
-
     if char.experience < exp_needed:
         return jsonify({'message': f'Not enough experience, need {exp_needed}', 'required': exp_needed}), 400
 
+    # 检查并扣除灵石
+    if not wallet_debit(char.id, lingshi_needed):
+        return jsonify({'message': f'Not enough ling shi, need {lingshi_needed}', 'required': lingshi_needed}), 400
+
     # 升级神通
     shentong.level += 1
     shentong.experience += exp_needed
     char.experience -= exp_needed
-    resource.amount -= lingshi_needed
 
     # 更新属性和触发概率
     shentong.damage_multiplier = 1.0 + (shentong.level - 1) * 0.1  # 每级增加10%伤害
@@ -1492,10 +2221,11 @@ def upgrade_shentong(current_user, shentong_id):
 
 @app.route('/shentong/equip/<int:shentong_id>', methods=['POST'])
 @token_required
+@character_required
 def equip_shentong(current_user, shentong_id):
     """装备神通"""
     shentong = db.session.get(Shentong, shentong_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not shentong or shentong.character_id != char.id:
         return jsonify({'message': 'Shentong not found'}), 404
 
@@ -1523,10 +2253,11 @@ def equip_shentong(current_user, shentong_id):
 
 @app.route('/shentong/unequip/<int:shentong_id>', methods=['POST'])
 @token_required
+@character_required
 def unequip_shentong(current_user, shentong_id):
     """卸下神通"""
     shentong = db.session.get(Shentong, shentong_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not shentong or shentong.character_id != char.id:
         return jsonify({'message': 'Shentong not found'}), 404
 
@@ -1542,10 +2273,11 @@ def unequip_shentong(current_user, shentong_id):
 
 @app.route('/shentong/cultivate/<int:shentong_id>', methods=['POST'])
 @token_required
+@character_required
 def cultivate_shentong(current_user, shentong_id):
     """神通修炼API"""
     shentong = db.session.get(Shentong, shentong_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not shentong or shentong.character_id != char.id:
         return jsonify({'message': 'Shentong not found'}), 404
 
@@ -1582,7 +2314,7 @@ def cultivate_shentong(current_user, shentong_id):
 @token_required
 def learn_mantra(current_user):
     """学习新功法"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1619,6 +2351,7 @@ def learn_mantra(current_user):
     new_mantra.crit_rate_bonus = 0.01 * multiplier
 
     db.session.add(new_mantra)
+    refresh_battle_power(char.id)
     db.session.commit()
 
     return jsonify({
@@ -1636,7 +2369,7 @@ def learn_mantra(current_user):
 @token_required
 def learn_shentong(current_user):
     """学习新神通"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1677,10 +2410,11 @@ def learn_shentong(current_user):
 
 @app.route('/mantra/delete/<int:mantra_id>', methods=['DELETE'])
 @token_required
+@character_required
 def delete_mantra(current_user, mantra_id):
     """删除功法（用于整理技能栏）"""
     mantra = db.session.get(Mantra, mantra_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not mantra or mantra.character_id != char.id:
         return jsonify({'message': 'Mantra not found'}), 404
 
@@ -1689,6 +2423,7 @@ def delete_mantra(current_user, mantra_id):
         return jsonify({'message': 'Cannot delete equipped mantra'}), 400
 
     db.session.delete(mantra)
+    refresh_character_stats(char.id)
     db.session.commit()
 
     return jsonify({'message': 'Mantra deleted successfully'}), 200
@@ -1696,10 +2431,11 @@ def delete_mantra(current_user, mantra_id):
 
 @app.route('/shentong/delete/<int:shentong_id>', methods=['DELETE'])
 @token_required
+@character_required
 def delete_shentong(current_user, shentong_id):
     """删除神通（用于整理技能栏）"""
     shentong = db.session.get(Shentong, shentong_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not shentong or shentong.character_id != char.id:
         return jsonify({'message': 'Shentong not found'}), 404
 
@@ -1715,7 +2451,7 @@ def delete_shentong(current_user, shentong_id):
 @app.route('/meridian', methods=['GET'])
 @token_required
 def get_meridians(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -1723,9 +2459,13 @@ def get_meridians(current_user):
     init_meridian_system(char.id)
 
     mers = Meridian.query.filter_by(character_id=char.id).all()
+    acupoints_by_meridian = {}
+    if mers:
+        for a in Acupoint.query.filter(Acupoint.meridian_id.in_([m.id for m in mers])).order_by(Acupoint.id):
+            acupoints_by_meridian.setdefault(a.meridian_id, []).append(a)
     meridians_data = []
     for m in mers:
-        acupoints = Acupoint.query.filter_by(meridian_id=m.id).all()
+        acupoints = acupoints_by_meridian.get(m.id, [])
         meridians_data.append({
             'id': m.id,
             'name': m.name,
@@ -1746,10 +2486,11 @@ def get_meridians(current_user):
 
 @app.route('/meridian/open/<int:meridian_id>', methods=['POST'])
 @token_required
+@character_required
 def open_meridian(current_user, meridian_id):
     """开启经脉"""
     meridian = db.session.get(Meridian, meridian_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not meridian or meridian.character_id != char.id:
         return jsonify({'message': 'Meridian not found'}), 404
 
@@ -1761,19 +2502,18 @@ def open_meridian(current_user, meridian_id):
     cost_multiplier = meridian.coefficient  # 任督二脉更难开启
     lingshi_cost = int(base_cost * cost_multiplier)
 
-    # 检查资源
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < lingshi_cost:
-        return jsonify({'message': f'Not enough ling shi, need {lingshi_cost}', 'required': lingshi_cost}), 400
-
     # 检查境界要求（至少筑基期）
     if char.realm in ['凡人期', '炼气期']:
         return jsonify({'message': '境界不足，无法开启经脉（需要筑基期以上）'}), 400
 
+    # 检查并扣除灵石
+    if not wallet_debit(char.id, lingshi_cost):
+        return jsonify({'message': f'Not enough ling shi, need {lingshi_cost}', 'required': lingshi_cost}), 400
+
     # 开启经脉
     meridian.is_open = True
-    resource.amount -= lingshi_cost
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({
         'message': f'成功开启{meridian.name}',
@@ -1783,67 +2523,55 @@ def open_meridian(current_user, meridian_id):
 
 
 def init_meridian_system(character_id):
-    """初始化角色的经脉系统"""
-    # 十二经脉+任督二脉数据（已在init_db.py中定义）
-    meridians_data = [
-        ("手太阴肺经", "十二经脉", 1.5),
-        ("手阳明大肠经", "十二经脉", 1.5),
-        ("足阳明胃经", "十二经脉", 1.5),
-        ("足太阴脾经", "十二经脉", 1.5),
-        ("手少阴心经", "十二经脉", 1.5),
-        ("手太阳小肠经", "十二经脉", 1.5),
-        ("足太阳膀胱经", "十二经脉", 1.5),
-        ("足少阴肾经", "十二经脉", 1.5),
-        ("手厥阴心包经", "十二经脉", 1.5),
-        ("手少阳三焦经", "十二经脉", 1.5),
-        ("足少阳胆经", "十二经脉", 1.5),
-        ("足厥阴肝经", "十二经脉", 1.5),
-        ("任脉", "任督二脉", 2.5),
-        ("督脉", "任督二脉", 2.5),
-    ]
+    """初始化角色的经脉系统：按目录中缓存的模板批量复制缺失的经脉和穴位，一次提交"""
+    templates = catalog.meridian_templates
+    if not templates:
+        # 目录加载时还没有模板（如启动后才执行 init_db.py 写入），重新加载一次
+        templates = reload_catalog().meridian_templates
+    existing = {name for (name,) in db.session.query(Meridian.name).filter_by(character_id=character_id)}
+    missing = [t for t in templates if t.name not in existing]
+    if not missing:
+        return 0
+
+    # 复制经脉
+    db.session.execute(db.insert(Meridian), [{
+        'character_id': character_id,
+        'name': t.name,
+        'type': t.type,
+        'coefficient': t.coefficient,
+        'is_open': False
+    } for t in missing])
+    meridian_ids = dict(
+        db.session.query(Meridian.name, Meridian.id)
+        .filter(Meridian.character_id == character_id, Meridian.name.in_([t.name for t in missing]))
+    )
 
-    for name, meridian_type, coefficient in meridians_data:
-        # 检查是否已存在
-        existing = Meridian.query.filter_by(character_id=character_id, name=name).first()
-        if not existing:
-            # 从全局模板复制经脉和穴位
-            template_meridian = Meridian.query.filter_by(character_id=None, name=name).first()
-            if template_meridian:
-                # 复制经脉
-                new_meridian = Meridian(
-                    character_id=character_id,
-                    name=name,
-                    type=meridian_type,
-                    coefficient=coefficient,
-                    is_open=False
-                )
-                db.session.add(new_meridian)
-                db.session.commit()
-
-                # 复制穴位
-                template_acupoints = Acupoint.query.filter_by(meridian_id=template_meridian.id).all()
-                for template_acupoint in template_acupoints:
-                    new_acupoint = Acupoint(
-                        meridian_id=new_meridian.id,
-                        name=template_acupoint.name,
-                        level=0,
-                        max_level=10,
-                        attribute_bonus=0
-                    )
-                    db.session.add(new_acupoint)
+    # 复制穴位
+    acupoint_rows = [{
+        'meridian_id': meridian_ids[t.name],
+        'name': acupoint_name,
+        'level': 0,
+        'max_level': 10,
+        'attribute_bonus': 0
+    } for t in missing for acupoint_name in t.acupoints]
+    if acupoint_rows:
+        db.session.execute(db.insert(Acupoint), acupoint_rows)
 
     db.session.commit()
+    return len(missing)
 
 @app.route('/acupoint/open/<int:acupoint_id>', methods=['POST'])
 @token_required
+@character_required
 def open_acupoint(current_user, acupoint_id):
-    """开启/升级穴位"""
+    """开启/升级穴位，levels 参数可一次升多级（超过上限时截断到满级）"""
+    data = request.get_json(silent=True) or {}
     acupoint = db.session.get(Acupoint, acupoint_id)
     if not acupoint:
         return jsonify({'message': 'Acupoint not found'}), 404
 
     meridian = db.session.get(Meridian, acupoint.meridian_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if meridian.character_id != char.id:
         return jsonify({'message': 'Not your acupoint'}), 403
 
@@ -1854,45 +2582,115 @@ def open_acupoint(current_user, acupoint_id):
     if acupoint.level >= acupoint.max_level:
         return jsonify({'message': 'Already max level'}), 400
 
-    # 消耗经验和灵石：基础*等级系数*经脉系数
-    base_cost = 50
-    exp_cost = int(base_cost * (acupoint.level + 1) * meridian.coefficient)
-    lingshi_cost = int(exp_cost * 0.5)  # 灵石消耗为经验的一半
+    try:
+        levels = int(request.args.get('levels', data.get('levels', 1)))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid levels'}), 400
+    if levels < 1:
+        return jsonify({'message': 'Invalid levels'}), 400
+    levels = min(levels, acupoint.max_level - acupoint.level)
 
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < lingshi_cost:
-        return jsonify({'message': f'Not enough ling shi, need {lingshi_cost}', 'required': lingshi_cost}), 400
+    # 消耗经验和灵石：每级 基础*等级系数*经脉系数，灵石为经验的一半，按等差数列求和
+    exp_needed_total, lingshi_cost = acupoint_cost(acupoint.level, levels, meridian.coefficient)
 
-    if char.experience < exp_cost:
-        return jsonify({'message': f'Not enough experience, need {exp_cost}', 'required': exp_cost}), 400
+    if char.experience < exp_needed_total:
+        return jsonify({'message': f'Not enough experience, need {exp_needed_total}', 'required': exp_needed_total}), 400
 
-    # 升级穴位
-    acupoint.level += 1
-    char.experience -= exp_cost
-    resource.amount -= lingshi_cost
+    if not wallet_debit(char.id, lingshi_cost):
+        return jsonify({'message': f'Not enough ling shi, need {lingshi_cost}', 'required': lingshi_cost}), 400
 
-    # 计算属性加成：根据经脉类型和穴位等级
-    old_bonus = acupoint.attribute_bonus
-    acupoint.attribute_bonus = calculate_acupoint_bonus(meridian.name, acupoint.level)
-    bonus_increase = acupoint.attribute_bonus - old_bonus
+    # 升级穴位
+    bonus_increase = raise_acupoint(acupoint, meridian, levels)
+    char.experience -= exp_needed_total
 
     # 更新人物属性
-    attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+    attr = g.attributes
     if attr:
         apply_acupoint_bonus_to_character(attr, meridian.name, bonus_increase)
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({
         'message': f'{acupoint.name}升级成功！',
         'acupoint_name': acupoint.name,
         'new_level': acupoint.level,
-        'exp_cost': exp_cost,
+        'levels_gained': levels,
+        'exp_cost': exp_needed_total,
         'lingshi_cost': lingshi_cost,
         'attribute_bonus': acupoint.attribute_bonus,
         'bonus_increase': bonus_increase
     }), 200
 
 
+@app.route('/meridian/<int:meridian_id>/auto_cultivate', methods=['POST'])
+@token_required
+@character_required
+def auto_cultivate_meridian(current_user, meridian_id):
+    """自动修炼经脉：按穴位顺序用现有经验和灵石升到能负担的最高等级，一次结算"""
+    data = request.get_json(silent=True) or {}
+    meridian = db.session.get(Meridian, meridian_id)
+    char = g.character
+    if not meridian or meridian.character_id != char.id:
+        return jsonify({'message': 'Meridian not found'}), 404
+
+    if not meridian.is_open:
+        return jsonify({'message': f'需要先开启{meridian.name}才能修炼穴位'}), 400
+
+    # 可选预算上限，默认使用全部经验和灵石
+    exp_budget = char.experience or 0
+    lingshi_budget = wallet_balance(char.id)
+    try:
+        if data.get('max_exp') is not None:
+            exp_budget = min(exp_budget, int(data['max_exp']))
+        if data.get('max_lingshi') is not None:
+            lingshi_budget = min(lingshi_budget, int(data['max_lingshi']))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid budget'}), 400
+
+    total_exp = total_lingshi = total_bonus = 0
+    upgraded = []
+    for acupoint in Acupoint.query.filter_by(meridian_id=meridian.id).order_by(Acupoint.id):
+        levels = affordable_acupoint_levels(acupoint.level, acupoint.max_level, meridian.coefficient,
+                                            exp_budget - total_exp, lingshi_budget - total_lingshi)
+        if levels == 0:
+            continue
+        exp_needed_total, lingshi_cost = acupoint_cost(acupoint.level, levels, meridian.coefficient)
+        total_exp += exp_needed_total
+        total_lingshi += lingshi_cost
+        total_bonus += raise_acupoint(acupoint, meridian, levels)
+        upgraded.append({'id': acupoint.id, 'name': acupoint.name, 'new_level': acupoint.level, 'levels_gained': levels})
+
+    if not upgraded:
+        return jsonify({'message': 'Nothing to cultivate: acupoints maxed or not enough experience/ling shi'}), 400
+
+    if not wallet_debit(char.id, total_lingshi):
+        return jsonify({'message': f'Not enough ling shi, have {wallet_balance(char.id)}', 'required': total_lingshi}), 400
+    char.experience -= total_exp
+
+    attr = g.attributes
+    if attr:
+        apply_acupoint_bonus_to_character(attr, meridian.name, total_bonus)
+
+    refresh_character_stats(char.id)
+    db.session.commit()
+    return jsonify({
+        'message': f'{meridian.name}修炼完成，共提升{sum(u["levels_gained"] for u in upgraded)}级',
+        'meridian_name': meridian.name,
+        'acupoints': upgraded,
+        'exp_cost': total_exp,
+        'lingshi_cost': total_lingshi,
+        'bonus_increase': total_bonus
+    }), 200
+
+
+def raise_acupoint(acupoint, meridian, levels):
+    """穴位升 levels 级并重算加成，返回加成增量（加成随等级线性增长）"""
+    old_bonus = acupoint.attribute_bonus or 0
+    acupoint.level += levels
+    acupoint.attribute_bonus = calculate_acupoint_bonus(meridian.name, acupoint.level)
+    return acupoint.attribute_bonus - old_bonus
+
+
 def calculate_acupoint_bonus(meridian_name: str, level: int) -> int:
     """根据经脉类型和等级计算穴位属性加成"""
     # 基础加成系数
@@ -1937,8 +2735,9 @@ def apply_acupoint_bonus_to_character(attr, meridian_name: str, bonus_increase:
 
 @app.route('/pet', methods=['GET'])
 @token_required
+@character_required
 def get_pets(current_user):
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     pets = Pet.query.filter_by(owner_id=char.id).all()
     return jsonify([{
         'id': p.id,
@@ -1948,17 +2747,17 @@ def get_pets(current_user):
 
 @app.route('/pet/feed/<int:pet_id>', methods=['POST'])
 @token_required
+@character_required
 def feed_pet(current_user, pet_id):
     """喂养宠物"""
     pet = db.session.get(Pet, pet_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not pet or pet.owner_id != char.id:
         return jsonify({'message': 'Pet not found'}), 404
 
     # 检查资源（灵石）
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
     feed_cost = 10  # 喂养消耗10灵石
-    if not resource or resource.amount < feed_cost:
+    if not wallet_debit(char.id, feed_cost):
         return jsonify({'message': f'Not enough ling shi, need {feed_cost}', 'required': feed_cost}), 400
 
     # 计算亲密度经验增益（基于宠物品质）
@@ -1969,7 +2768,6 @@ def feed_pet(current_user, pet_id):
     # 更新亲密度
     pet.intimacy_exp += exp_gain
     pet.last_feed_time = db.func.current_timestamp()
-    resource.amount -= feed_cost
 
     # 检查是否可以升级亲密度等级
     if pet.intimacy_exp >= pet.max_intimacy_exp and pet.intimacy_level < 10:
@@ -1987,6 +2785,7 @@ def feed_pet(current_user, pet_id):
         # 更新技能触发概率
         pet.skill_trigger_rate = min(0.5, pet.intimacy_level / 20.0)  # 最高25%
 
+        refresh_character_stats(char.id)
         db.session.commit()
         return jsonify({
             'message': f'喂养成功！亲密度等级提升到{pet.intimacy_level}',
@@ -2013,10 +2812,11 @@ def feed_pet(current_user, pet_id):
 
 @app.route('/pet/play/<int:pet_id>', methods=['POST'])
 @token_required
+@character_required
 def play_with_pet(current_user, pet_id):
     """陪伴宠物"""
     pet = db.session.get(Pet, pet_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not pet or pet.owner_id != char.id:
         return jsonify({'message': 'Pet not found'}), 404
 
@@ -2043,6 +2843,7 @@ def play_with_pet(current_user, pet_id):
         pet.defense_bonus += attr_bonus
         pet.hp_bonus += attr_bonus * 2
         pet.speed_bonus += attr_bonus
+        refresh_character_stats(char.id)
 
     db.session.commit()
     return jsonify({
@@ -2055,10 +2856,11 @@ def play_with_pet(current_user, pet_id):
 
 @app.route('/pet/battle/<int:pet_id>', methods=['POST'])
 @token_required
+@character_required
 def pet_battle(current_user, pet_id):
     """宠物参与战斗"""
     pet = db.session.get(Pet, pet_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not pet or pet.owner_id != char.id:
         return jsonify({'message': 'Pet not found'}), 404
 
@@ -2088,6 +2890,9 @@ def pet_battle(current_user, pet_id):
         pet.hp_bonus += level_bonus * 3
         pet.speed_bonus += level_bonus
 
+    if pet_level_up:
+        refresh_character_stats(char.id)
+
     # 检查亲密度等级升级
     intimacy_level_up = False
     if pet.intimacy_exp >= pet.max_intimacy_exp and pet.intimacy_level < 10:
@@ -2113,16 +2918,14 @@ def pet_battle(current_user, pet_id):
 
 @app.route('/pet/capture', methods=['POST'])
 @token_required
+@character_required
 def capture_pet(current_user):
     """捕捉宠物"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     data = request.get_json() or {}
 
     # 捕捉消耗灵石
     capture_cost = 500
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < capture_cost:
-        return jsonify({'message': f'Not enough ling shi, need {capture_cost}', 'required': capture_cost}), 400
 
     # 宠物品质随机生成
     quality_roll = random.random()
@@ -2142,8 +2945,13 @@ def capture_pet(current_user):
         quality = '传说'
         success_rate = 0.1
 
-    # 捕捉成功率
-    if random.random() < success_rate:
+    # 捕捉成功率；需持有全额灵石，成功扣全额，失败只扣一半
+    success = random.random() < success_rate
+    failure_cost = capture_cost // 2
+    if not wallet_debit(char.id, capture_cost if success else failure_cost, required=capture_cost):
+        return jsonify({'message': f'Not enough ling shi, need {capture_cost}', 'required': capture_cost}), 400
+
+    if success:
         # 生成宠物
         pet_names = {
             '普通': ['小狗', '小猫', '兔子', '松鼠'],
@@ -2179,8 +2987,8 @@ def capture_pet(current_user):
             captured_at=db.func.current_timestamp()
         )
 
-        resource.amount -= capture_cost
         db.session.add(new_pet)
+        refresh_character_stats(char.id)
         db.session.commit()
 
         return jsonify({
@@ -2195,8 +3003,6 @@ def capture_pet(current_user):
         }), 201
     else:
         # 捕捉失败，消耗部分灵石
-        failure_cost = capture_cost // 2
-        resource.amount -= failure_cost
         db.session.commit()
 
         return jsonify({
@@ -2208,10 +3014,11 @@ def capture_pet(current_user):
 
 @app.route('/pet/levelup/<int:pet_id>', methods=['POST'])
 @token_required
+@character_required
 def levelup_pet(current_user, pet_id):
     """宠物升级"""
     pet = db.session.get(Pet, pet_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not pet or pet.owner_id != char.id:
         return jsonify({'message': 'Pet not found'}), 404
 
@@ -2235,6 +3042,7 @@ def levelup_pet(current_user, pet_id):
     pet.hp_bonus += level_bonus * 3
     pet.speed_bonus += level_bonus
 
+    refresh_character_stats(char.id)
     db.session.commit()
     return jsonify({
         'message': f'Pet upgraded to level {pet.level}!',
@@ -2251,10 +3059,11 @@ def levelup_pet(current_user, pet_id):
 
 @app.route('/pet/skill/<int:pet_id>', methods=['POST'])
 @token_required
+@character_required
 def use_pet_skill(current_user, pet_id):
     """使用宠物技能"""
     pet = db.session.get(Pet, pet_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not pet or pet.owner_id != char.id:
         return jsonify({'message': 'Pet not found'}), 404
 
@@ -2298,9 +3107,10 @@ def get_pet_market(current_user):
 
 @app.route('/pet/market/buy/<int:pet_template_id>', methods=['POST'])
 @token_required
+@character_required
 def buy_pet_from_market(current_user, pet_template_id):
     """从宠物市场购买宠物"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
 
     # 模拟宠物模板数据
     pet_templates = {
@@ -2321,8 +3131,7 @@ def buy_pet_from_market(current_user, pet_template_id):
         return jsonify({'message': f'You already have a {template["name"]}'}), 400
 
     # 检查灵石
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < template['price']:
+    if not wallet_debit(char.id, template['price']):
         return jsonify({'message': f'Not enough ling shi, need {template["price"]}', 'required': template['price']}), 400
 
     # 创建宠物
@@ -2339,8 +3148,8 @@ def buy_pet_from_market(current_user, pet_template_id):
         captured_at=db.func.current_timestamp()
     )
 
-    resource.amount -= template['price']
     db.session.add(new_pet)
+    refresh_character_stats(char.id)
     db.session.commit()
 
     return jsonify({
@@ -2353,55 +3162,160 @@ def buy_pet_from_market(current_user, pet_template_id):
         }
     }), 201
 
+# 宗门列表可用的排序字段（除 id 外均按降序）
+SECT_SORT_COLUMNS = {
+    'id': Sect.id,
+    'power': Sect.power,
+    'prestige': Sect.prestige,
+    'level': Sect.level,
+    'members': Sect.member_count,
+}
+
+# 宗门职位等级（数字越小地位越高），只能踢出地位低于自己的成员
+SECT_POSITION_RANK = {'宗主': 0, '大长老': 1, '长老': 2, '执事': 3, '弟子': 4}
+
+
 @app.route('/sect', methods=['GET'])
 @token_required
 def get_sects(current_user):
-    """获取宗门列表"""
-    sects = Sect.query.all()
+    """获取宗门列表（分页，可按实力/威望/等级/成员数排序）"""
+    page, per_page = parse_pagination(request.args)
+    sort = request.args.get('sort', 'id')
+    sort_column = SECT_SORT_COLUMNS.get(sort)
+    if sort_column is None:
+        return jsonify({'message': f'Invalid sort, allowed: {list(SECT_SORT_COLUMNS)}'}), 400
+
+    query = Sect.query
+    if sort != 'id':
+        query = query.order_by(sort_column.desc(), Sect.id)
+    else:
+        query = query.order_by(Sect.id)
+    total = Sect.query.count()
+    sects = query.offset((page - 1) * per_page).limit(per_page).all()
+
+    # 与详情页一致：显示值 = 已汇总的值 + 本页宗门尚未汇总的贡献流水（排序按已汇总的值）
+    pending = pending_sect_contributions([sect.id for sect in sects])
     sects_data = []
     for sect in sects:
-        member_count = SectMember.query.filter_by(sect_id=sect.id).count()
+        _, pending_prosperity, pending_power = pending.get(sect.id, (0, 0, 0))
         sects_data.append({
             'id': sect.id,
             'name': sect.name,
             'level': sect.level,
-            'prosperity': sect.prosperity,
-            'power': sect.power,
+            'prosperity': sect.prosperity + pending_prosperity,
+            'power': sect.power + pending_power,
             'prestige': sect.prestige,
-            'member_count': member_count,
+            'member_count': sect.member_count or 0,
             'description': sect.description,
             'created_at': sect.created_at.isoformat() if sect.created_at else None
         })
-    return jsonify({'sects': sects_data}), 200
+    return jsonify({
+        'sects': sects_data,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'sort': sort
+    }), 200
+
+
+# 宗门详情页头部（宗门基本信息）短时缓存，宗门数据变化时失效
+sect_header_cache = TTLCache(app.config['SECT_HEADER_TTL'])
+
+def sect_header(sect_id):
+    """宗门基本信息（带缓存），宗门不存在时返回 None"""
+    header = sect_header_cache.get(sect_id)
+    if header is None:
+        sect = db.session.get(Sect, sect_id)
+        if not sect:
+            return None
+        # 计数 = 已汇总的值 + 尚未汇总的贡献流水
+        pending_amount, pending_prosperity, pending_power = pending_sect_contribution(sect_id)
+        header = {
+            'id': sect.id,
+            'name': sect.name,
+            'level': sect.level,
+            'prosperity': sect.prosperity + pending_prosperity,
+            'contribution': sect.contribution + pending_amount,
+            'power': sect.power + pending_power,
+            'construction': sect.construction,
+            'prestige': sect.prestige,
+            'member_count': sect.member_count or 0,
+            'description': sect.description,
+            'resources': sect.resources,
+            'facilities': sect.facilities
+        }
+        sect_header_cache.set(sect_id, header)
+    return header
+
+def parse_member_cursor(cursor):
+    """成员分页游标 '贡献值:成员id'，非法时返回 None"""
+    try:
+        contribution, member_id = cursor.split(':')
+        return int(contribution), int(member_id)
+    except (AttributeError, ValueError):
+        return None
 
 
 @app.route('/sect/<int:sect_id>', methods=['GET'])
 @token_required
 def get_sect_detail(current_user, sect_id):
-    """获取宗门详情"""
-    sect = db.session.get(Sect, sect_id)
-    if not sect:
+    """获取宗门详情（成员按贡献值降序游标分页；任务按 id 升序游标分页，默认全部状态，可按 task_status 筛选）"""
+    header = sect_header(sect_id)
+    if header is None:
         return jsonify({'message': 'Sect not found'}), 404
 
-    # 获取宗门成员
-    members = SectMember.query.filter_by(sect_id=sect_id).all()
+    _, per_page = parse_pagination(request.args)
+
+    # 获取宗门成员：连表取人物信息，按 (贡献值, id) 降序游标分页
+    contribution = SectMember.contribution
+    query = db.session.query(SectMember, Character.name, Character.level, Character.realm)\
+        .outerjoin(Character, Character.id == SectMember.character_id)\
+        .filter(SectMember.sect_id == sect_id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        position = parse_member_cursor(cursor)
+        if position is None:
+            return jsonify({'message': 'Invalid cursor'}), 400
+        after_contribution, after_id = position
+        query = query.filter(db.or_(
+            contribution < after_contribution,
+            db.and_(contribution == after_contribution, SectMember.id < after_id)
+        ))
+    rows = query.order_by(contribution.desc(), SectMember.id.desc()).limit(per_page + 1).all()
+
     members_data = []
-    for member in members:
-        char = Character.query.get(member.character_id)
+    for member, char_name, char_level, char_realm in rows[:per_page]:
         members_data.append({
             'id': member.id,
             'character_id': member.character_id,
-            'character_name': char.name if char else 'Unknown',
+            'character_name': char_name or 'Unknown',
+            'character_level': char_level,
+            'character_realm': char_realm,
             'position': member.position,
             'contribution': member.contribution,
             'total_contribution': member.total_contribution,
             'joined_at': member.joined_at.isoformat() if member.joined_at else None
         })
-
-    # 获取宗门任务
-    tasks = SectTask.query.filter_by(sect_id=sect_id).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        last = rows[per_page - 1][0]
+        next_cursor = f'{last.contribution or 0}:{last.id}'
+
+    # 获取宗门任务：默认全部状态，按 id 升序，task_cursor 为上一页最后一个任务的 id
+    status = request.args.get('task_status', 'all')
+    task_query = SectTask.query.filter_by(sect_id=sect_id)
+    if status != 'all':
+        task_query = task_query.filter_by(status=status)
+    task_cursor = request.args.get('task_cursor')
+    if task_cursor:
+        try:
+            task_query = task_query.filter(SectTask.id > int(task_cursor))
+        except ValueError:
+            return jsonify({'message': 'Invalid task cursor'}), 400
+    tasks = task_query.order_by(SectTask.id).limit(per_page + 1).all()
+    next_task_cursor = str(tasks[per_page - 1].id) if len(tasks) > per_page else None
     tasks_data = []
-    for task in tasks:
+    for task in tasks[:per_page]:
         tasks_data.append({
             'id': task.id,
             'title': task.title,
@@ -2412,21 +3326,11 @@ def get_sect_detail(current_user, sect_id):
         })
 
     return jsonify({
-        'sect': {
-            'id': sect.id,
-            'name': sect.name,
-            'level': sect.level,
-            'prosperity': sect.prosperity,
-            'contribution': sect.contribution,
-            'power': sect.power,
-            'construction': sect.construction,
-            'prestige': sect.prestige,
-            'description': sect.description,
-            'resources': sect.resources,
-            'facilities': sect.facilities
-        },
+        'sect': header,
         'members': members_data,
-        'tasks': tasks_data
+        'next_cursor': next_cursor,
+        'tasks': tasks_data,
+        'next_task_cursor': next_task_cursor
     }), 200
 
 
@@ -2435,7 +3339,7 @@ def get_sect_detail(current_user, sect_id):
 def create_sect(current_user):
     """创建宗门"""
     data = request.get_json()
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -2446,8 +3350,7 @@ def create_sect(current_user):
 
     # 创建宗门消耗灵石
     create_cost = 10000
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < create_cost:
+    if not wallet_debit(char.id, create_cost):
         return jsonify({'message': f'Not enough ling shi, need {create_cost}', 'required': create_cost}), 400
 
     new_sect = Sect(
@@ -2457,7 +3360,8 @@ def create_sect(current_user):
         contribution=0,
         power=char.level * 10,  # 初始实力值基于创建者等级
         construction=0,
-        prestige=0
+        prestige=0,
+        member_count=1
     )
     db.session.add(new_sect)
     db.session.commit()  # 先提交以获取ID
@@ -2472,9 +3376,6 @@ def create_sect(current_user):
     )
     db.session.add(member)
 
-    # 扣除灵石
-    resource.amount -= create_cost
-
     db.session.commit()
     return jsonify({
         'message': 'Sect created successfully!',
@@ -2490,7 +3391,7 @@ def create_sect(current_user):
 @token_required
 def join_sect(current_user, sect_id):
     """加入宗门"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'No character found'}), 404
 
@@ -2513,7 +3414,9 @@ def join_sect(current_user, sect_id):
         total_contribution=0
     )
     db.session.add(member)
+    adjust_sect_member_count(sect_id, 1)
     db.session.commit()
+    sect_header_cache.invalidate(sect_id)
 
     return jsonify({
         'message': f'Successfully joined {sect.name}',
@@ -2522,8 +3425,58 @@ def join_sect(current_user, sect_id):
     }), 200
 
 
+@app.route('/sect/leave', methods=['POST'])
+@token_required
+def leave_sect(current_user):
+    """退出宗门（宗主不能直接退出）"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'No character found'}), 404
+
+    member = SectMember.query.filter_by(character_id=char.id).first()
+    if not member:
+        return jsonify({'message': 'You are not in any sect'}), 400
+    if member.position == '宗主':
+        return jsonify({'message': 'Sect master cannot leave the sect'}), 400
+
+    sect_id = member.sect_id
+    db.session.delete(member)
+    adjust_sect_member_count(sect_id, -1)
+    db.session.commit()
+    sect_header_cache.invalidate(sect_id)
+
+    return jsonify({'message': 'Successfully left the sect', 'sect_id': sect_id}), 200
+
+
+@app.route('/sect/kick/<int:character_id>', methods=['POST'])
+@token_required
+def kick_sect_member(current_user, character_id):
+    """踢出宗门成员（宗主和大长老可操作，只能踢出职位低于自己的成员）"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'No character found'}), 404
+
+    member = SectMember.query.filter_by(character_id=char.id).first()
+    if not member or member.position not in ['宗主', '大长老']:
+        return jsonify({'message': 'No permission to kick members'}), 403
+
+    target = SectMember.query.filter_by(sect_id=member.sect_id, character_id=character_id).first()
+    if not target:
+        return jsonify({'message': 'Member not found'}), 404
+    if SECT_POSITION_RANK.get(target.position, len(SECT_POSITION_RANK)) <= SECT_POSITION_RANK[member.position]:
+        return jsonify({'message': 'Cannot kick a member of equal or higher position'}), 403
+
+    db.session.delete(target)
+    adjust_sect_member_count(member.sect_id, -1)
+    db.session.commit()
+    sect_header_cache.invalidate(member.sect_id)
+
+    return jsonify({'message': 'Member kicked', 'character_id': character_id, 'sect_id': member.sect_id}), 200
+
+
 @app.route('/sect/upgrade/<int:sect_id>', methods=['POST'])
 @token_required
+@character_required
 def upgrade_sect(current_user, sect_id):
     """宗门升级"""
     sect = db.session.get(Sect, sect_id)
@@ -2531,11 +3484,15 @@ def upgrade_sect(current_user, sect_id):
         return jsonify({'message': 'Sect not found'}), 404
 
     # 检查权限（只有宗主和大长老可以升级）
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(sect_id=sect_id, character_id=char.id).first()
     if not member or member.position not in ['宗主', '大长老']:
         return jsonify({'message': 'No permission to upgrade sect'}), 403
 
+    # 先把该宗门未汇总的贡献计入，再按准确的贡献值判断
+    if fold_sect_contributions(sect_id):
+        db.session.refresh(sect)
+
     if sect.level >= sect.max_level:
         return jsonify({'message': f'Sect already at max level ({sect.max_level})'}), 400
 
@@ -2546,15 +3503,16 @@ def upgrade_sect(current_user, sect_id):
     if sect.contribution < upgrade_cost:
         return jsonify({'message': f'Not enough sect contribution, need {upgrade_cost}', 'required': upgrade_cost}), 400
 
-    # 升级宗门
+    # 升级宗门（计数用 SQL 表达式更新，不覆盖并发汇总的贡献流水）
     sect.level += 1
-    sect.contribution -= upgrade_cost
+    sect.contribution = Sect.contribution - upgrade_cost
 
     # 升级奖励
-    sect.power += 50  # 实力值增加
-    sect.prestige += 10  # 威望值增加
+    sect.power = Sect.power + 50  # 实力值增加
+    sect.prestige = Sect.prestige + 10  # 威望值增加
 
     db.session.commit()
+    sect_header_cache.invalidate(sect_id)
     return jsonify({
         'message': f'Sect upgraded to level {sect.level}!',
         'new_level': sect.level,
@@ -2566,9 +3524,10 @@ def upgrade_sect(current_user, sect_id):
 
 @app.route('/sect/task', methods=['GET'])
 @token_required
+@character_required
 def get_sect_tasks(current_user):
     """获取宗门任务列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2592,9 +3551,10 @@ def get_sect_tasks(current_user):
 
 @app.route('/sect/task/create', methods=['POST'])
 @token_required
+@character_required
 def create_sect_task(current_user):
     """创建宗门任务（宗主权限）"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member or member.position not in ['宗主', '大长老']:
         return jsonify({'message': 'No permission to create tasks'}), 403
@@ -2620,9 +3580,10 @@ def create_sect_task(current_user):
 
 @app.route('/sect/activity', methods=['GET'])
 @token_required
+@character_required
 def get_sect_activities(current_user):
     """获取宗门活动"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2647,9 +3608,10 @@ def get_sect_activities(current_user):
 
 @app.route('/sect/shop', methods=['GET'])
 @token_required
+@character_required
 def get_sect_shop(current_user):
     """获取宗门商店"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2675,9 +3637,10 @@ def get_sect_shop(current_user):
 
 @app.route('/sect/shop/buy/<int:item_id>', methods=['POST'])
 @token_required
+@character_required
 def buy_from_sect_shop(current_user, item_id):
     """从宗门商店购买物品"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2708,9 +3671,10 @@ def buy_from_sect_shop(current_user, item_id):
 
 @app.route('/sect/tournament', methods=['GET'])
 @token_required
+@character_required
 def get_sect_tournaments(current_user):
     """获取宗门比武"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2754,30 +3718,24 @@ def get_sect_alliances(current_user):
 
 @app.route('/sect/my', methods=['GET'])
 @token_required
+@character_required
 def get_my_sect(current_user):
     """获取我的宗门信息"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
 
     if not member:
         return jsonify({'sect': None, 'member': None}), 200
 
-    sect = Sect.query.get(member.sect_id)
-    if not sect:
+    header = sect_header(member.sect_id)
+    if header is None:
         return jsonify({'message': 'Sect not found'}), 404
 
     return jsonify({
-        'sect': {
-            'id': sect.id,
-            'name': sect.name,
-            'level': sect.level,
-            'prosperity': sect.prosperity,
-            'contribution': sect.contribution,
-            'power': sect.power,
-            'construction': sect.construction,
-            'prestige': sect.prestige,
-            'description': sect.description
-        },
+        'sect': {key: header[key] for key in (
+            'id', 'name', 'level', 'prosperity', 'contribution', 'power',
+            'construction', 'prestige', 'description'
+        )},
         'member': {
             'position': member.position,
             'contribution': member.contribution,
@@ -2788,10 +3746,11 @@ def get_my_sect(current_user):
 
 @app.route('/sect/contribute', methods=['POST'])
 @token_required
+@character_required
 def contribute_to_sect(current_user):
     """为宗门贡献资源"""
     data = request.get_json()
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     member = SectMember.query.filter_by(character_id=char.id).first()
     if not member:
         return jsonify({'message': 'You are not in any sect'}), 400
@@ -2800,31 +3759,32 @@ def contribute_to_sect(current_user):
     if contribution_amount <= 0:
         return jsonify({'message': 'Invalid contribution amount'}), 400
 
-    # 检查玩家灵石
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < contribution_amount:
-        return jsonify({'message': f'Not enough ling shi, have {resource.amount if resource else 0}', 'required': contribution_amount}), 400
-
     # 扣除灵石，增加宗门贡献值和成员贡献值
-    resource.amount -= contribution_amount
+    if not wallet_debit(char.id, contribution_amount):
+        return jsonify({'message': f'Not enough ling shi, have {wallet_balance(char.id)}', 'required': contribution_amount}), 400
+
     member.contribution += contribution_amount
     member.total_contribution += contribution_amount
 
-    sect = Sect.query.get(member.sect_id)
-    sect.contribution += contribution_amount
-
-    # 根据贡献更新宗门属性
-    sect.prosperity += int(contribution_amount / 100)  # 每100灵石增加1繁荣度
-    sect.power += int(contribution_amount / 200)  # 每200灵石增加1实力值
+    # 宗门计数先记入贡献流水，由定时任务批量汇总，避免所有成员争抢宗门这一行
+    db.session.add(SectContribution(
+        sect_id=member.sect_id,
+        character_id=char.id,
+        amount=contribution_amount,
+        prosperity=int(contribution_amount / 100),  # 每100灵石增加1繁荣度
+        power=int(contribution_amount / 200)  # 每200灵石增加1实力值
+    ))
 
     db.session.commit()
+    sect_header_cache.invalidate(member.sect_id)
+    header = sect_header(member.sect_id)
 
     return jsonify({
         'message': f'Successfully contributed {contribution_amount} ling shi to sect',
         'contribution_added': contribution_amount,
         'personal_contribution': member.contribution,
-        'sect_prosperity': sect.prosperity,
-        'sect_power': sect.power
+        'sect_prosperity': header['prosperity'] if header else None,
+        'sect_power': header['power'] if header else None
     }), 200
 
 
@@ -2858,7 +3818,7 @@ def refine_pill(current_user, pill_id):
     if not pill:
         return jsonify({'message': 'Pill not found'}), 404
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -2872,38 +3832,48 @@ def refine_pill(current_user, pill_id):
     final_success_rate = min(0.95, base_success_rate + furnace_bonus)
 
     # 炼制消耗
-    refine_cost = pill.difficulty * 100  # 基础消耗
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < refine_cost:
+    count = parse_batch_count(request.get_json(silent=True) or {})
+    if count is None:
+        return jsonify({'message': 'Invalid count'}), 400
+    refine_cost = pill.difficulty * 100 * count  # 基础消耗
+    if not wallet_debit(char.id, refine_cost):
         return jsonify({'message': f'Not enough ling shi, need {refine_cost}', 'required': refine_cost}), 400
 
-    # 炼制逻辑
-    resource.amount -= refine_cost
-    if random.random() < final_success_rate:
+    # 炼制逻辑：所有随机数一次取出，成功数量合并为一次库存增加
+    successes = sum(1 for roll in batch_uniforms(count) if roll < final_success_rate)
+    if successes:
         # 炼制成功，创建丹药物品
         # 检查是否已有相同丹药，增加数量
         existing_item = PillItem.query.filter_by(owner_id=char.id, pill_id=pill_id).first()
         if existing_item:
-            existing_item.quantity += 1
+            existing_item.quantity += successes
         else:
-            new_item = PillItem(owner_id=char.id, pill_id=pill_id, quantity=1)
+            new_item = PillItem(owner_id=char.id, pill_id=pill_id, quantity=successes)
             db.session.add(new_item)
+    db.session.commit()
 
-        db.session.commit()
+    if count > 1:
         return jsonify({
-            'message': f'炼制成功！获得{pill.name}',
+            'message': f'炼制{count}次，获得{pill.name}{successes}枚',
             'pill_name': pill.name,
+            'attempts': count,
+            'successes': successes,
             'success_rate': final_success_rate,
             'cost': refine_cost
         }), 200
-    else:
-        # 炼制失败
-        db.session.commit()
+    if successes:
         return jsonify({
-            'message': '炼制失败',
+            'message': f'炼制成功！获得{pill.name}',
+            'pill_name': pill.name,
             'success_rate': final_success_rate,
             'cost': refine_cost
-        }), 400
+        }), 200
+    # 炼制失败
+    return jsonify({
+        'message': '炼制失败',
+        'success_rate': final_success_rate,
+        'cost': refine_cost
+    }), 400
 
 
 @app.route('/pill/use/<int:pill_id>', methods=['POST'])
@@ -2911,7 +3881,7 @@ def refine_pill(current_user, pill_id):
 def use_pill(current_user, pill_id):
     """使用丹药"""
     # 首先检查玩家是否拥有这个丹药
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -2923,7 +3893,7 @@ def use_pill(current_user, pill_id):
     if not pill:
         return jsonify({'message': 'Pill not found'}), 404
 
-    attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+    attr = g.attributes
     if not attr:
         return jsonify({'message': 'Character attributes not found'}), 404
 
@@ -2967,6 +3937,8 @@ def use_pill(current_user, pill_id):
         # 解毒丹药 - 这里简化处理
         pass  # 可以添加中毒状态系统
 
+    refresh_character_stats(char.id)
+
     # 减少丹药数量
     pill_item.quantity -= 1
     if pill_item.quantity <= 0:
@@ -2984,7 +3956,7 @@ def use_pill(current_user, pill_id):
 @token_required
 def get_character_pills(current_user):
     """获取角色拥有的丹药"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3008,35 +3980,155 @@ def get_character_pills(current_user):
 
 
 # 灵植系统API
+# 灵植变异可选属性
+LINGZHI_MUTATION_ATTRIBUTES = ['攻击', '防御', '生命', '速度']
+# 照顾一次的灵石消耗、照顾方式
+LINGZHI_CARE_COST = 10
+LINGZHI_CARE_TYPES = ('water', 'fertilizer', 'sunlight')
+# 收获奖励品质倍率
+LINGZHI_HARVEST_MULTIPLIERS = {
+    '凡品': 1, '黄品': 2, '玄品': 5, '地品': 10, '天品': 20, '无上': 50
+}
+
+def apply_lingzhi_care(lingzhi, lingtian, care_type, roll):
+    """照顾灵植一次（不扣费、不提交），roll 为 [0,1) 随机数，返回 (变异概率, 是否变异)"""
+    if care_type == 'water':
+        lingzhi.water_level = min(100, lingzhi.water_level + 20)
+    elif care_type == 'fertilizer':
+        lingzhi.fertilizer_level = min(100, lingzhi.fertilizer_level + 20)
+        # 记录施肥次数（用于变异概率计算）
+        lingtian.fertilizer_level += 1
+    elif care_type == 'sunlight':
+        lingzhi.sunlight_level = min(100, lingzhi.sunlight_level + 20)
+
+    # 计算变异概率：(1 + 0.1 × (灵田等级-1)) × (1 + 0.05 × min(施肥次数, 10)) × 天气系数× P基本概率
+    # 简化：假设灵田等级为1，天气系数为1.0
+    lingtian_level = 1  # 可以后续扩展灵田等级系统
+    fertilizer_times = min(lingtian.fertilizer_level, 10)
+    weather_factor = 1.0  # 可以后续添加天气系统
+    base_mutation_rate = lingzhi.mutation_rate
+
+    final_mutation_rate = (1 + 0.1 * (lingtian_level - 1)) * (1 + 0.05 * fertilizer_times) * weather_factor * base_mutation_rate
+    final_mutation_rate = min(final_mutation_rate, 0.1)  # 最高不超过10%
+
+    # 变异检查
+    mutated = False
+    if not lingzhi.has_mutated and roll < final_mutation_rate:
+        mutated = True
+        lingzhi.has_mutated = True
+
+        # 随机变异属性
+        lingzhi.attribute_type = random.choice(LINGZHI_MUTATION_ATTRIBUTES)
+        lingzhi.attribute_value = random.randint(5, 20) * lingzhi.level
+
+    lingzhi.last_cared_at = datetime.datetime.utcnow()
+    lingzhi.growth_stage = lingzhi_growth(lingzhi.planted_at, lingzhi.max_growth_time, lingzhi.last_cared_at)[0]
+    return final_mutation_rate, mutated
+
+def lingzhi_harvest_reward(lingzhi):
+    """收获奖励（灵石）：品质倍率 × 等级，变异灵植翻倍"""
+    base_reward = 100
+    multiplier = LINGZHI_HARVEST_MULTIPLIERS.get(lingzhi.quality, 1)
+    reward = base_reward * multiplier * lingzhi.level  # 等级越高奖励越多
+
+    # 变异奖励
+    if lingzhi.has_mutated and lingzhi.attribute_value > 0:
+        reward *= 2  # 变异灵植奖励翻倍
+    return reward
+
+# 数据库端掷骰的精度：概率按百万分之一取整
+SQL_ROLL_SCALE = 1000000
+
+def sql_random_int(n):
+    """SQL 表达式：每行独立的 [0, n) 随机整数（SQLite 的 random() 为 64 位整数，MySQL 为 RAND()）"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return db.func.abs(db.func.random()) % n
+    if dialect in ('mysql', 'mariadb'):
+        return db.func.floor(db.func.rand() * n)
+    return db.func.floor(db.func.random() * n)
+
+def run_farm_tick(now=None):
+    """灵田定时推进：衰减照顾值、推进生长阶段、掷变异，全部按集合批量更新"""
+    now = now or datetime.datetime.utcnow()
+    decay = app.config['FARM_CARE_DECAY']
+
+    def decayed(column):
+        return db.case((column > decay, column - decay), else_=0)
+
+    # 照顾值衰减：一条 UPDATE
+    decayed_count = db.session.execute(
+        db.update(Lingzhi)
+        .where(db.or_(Lingzhi.water_level > 0, Lingzhi.fertilizer_level > 0, Lingzhi.sunlight_level > 0))
+        .values(
+            water_level=decayed(Lingzhi.water_level),
+            fertilizer_level=decayed(Lingzhi.fertilizer_level),
+            sunlight_level=decayed(Lingzhi.sunlight_level),
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    # 生长阶段：按成熟时间分组，每组一条 UPDATE（种植时间与各阶段截止时间比较）
+    staged_count = 0
+    growth_times = db.session.query(Lingzhi.max_growth_time).filter(Lingzhi.max_growth_time.isnot(None)).distinct()
+    for (max_growth_time,) in growth_times.all():
+        stage = db.case(
+            *[(Lingzhi.planted_at <= cutoff, name) for name, cutoff in lingzhi_stage_cutoffs(max_growth_time, now)],
+            else_=LINGZHI_STAGES[0]
+        )
+        staged_count += db.session.execute(
+            db.update(Lingzhi)
+            .where(Lingzhi.max_growth_time == max_growth_time,
+                   db.or_(Lingzhi.growth_stage.is_(None), Lingzhi.growth_stage != stage))
+            .values(growth_stage=stage)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+    # 变异：一条 UPDATE，每株灵植在数据库中独立掷骰（概率为变异率×系数，上限10%），属性也在库内随机
+    chance = db.func.coalesce(Lingzhi.mutation_rate, 0) * app.config['FARM_TICK_MUTATION_SCALE']
+    chance = db.case((chance > 0.1, 0.1), else_=chance)
+    attribute_type = db.case(
+        dict(enumerate(LINGZHI_MUTATION_ATTRIBUTES)), value=sql_random_int(len(LINGZHI_MUTATION_ATTRIBUTES))
+    )
+    mutated_count = db.session.execute(
+        db.update(Lingzhi)
+        .where(Lingzhi.has_mutated == False, sql_random_int(SQL_ROLL_SCALE) < chance * SQL_ROLL_SCALE)
+        .values(
+            has_mutated=True,
+            attribute_type=attribute_type,
+            attribute_value=(sql_random_int(16) + 5) * db.func.coalesce(Lingzhi.level, 1)
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    db.session.commit()
+    return {'decayed': decayed_count, 'staged': staged_count, 'mutated': mutated_count}
+
+scheduler.register('farm_tick', app.config['FARM_TICK_INTERVAL'],
+                   leased_job('farm_tick', app.config['FARM_TICK_INTERVAL'], run_farm_tick))
+
+
 @app.route('/lingzhi', methods=['GET'])
 @token_required
 def get_lingzhis(current_user):
     """获取灵植列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
     lingzhis = Lingzhi.query.filter_by(owner_id=char.id).all()
+    # 生长状态由时间戳即时推算，只读不写；阶段在下一次照顾/收获时落库
+    current_time = datetime.datetime.utcnow()
     lingzhis_data = []
     for lz in lingzhis:
-        # 计算当前生长状态
-        current_time = datetime.datetime.utcnow()
-        planted_time = lz.planted_at
-        time_diff = (current_time - planted_time).total_seconds() / 60  # 分钟
-
-        growth_progress = min(100, (time_diff / lz.max_growth_time) * 100)
-
-        # 更新生长状态
-        if growth_progress >= 100 and lz.growth_stage != '成熟':
-            lz.growth_stage = '成熟'
-            db.session.commit()
+        growth_stage, growth_progress, _ = lingzhi_growth(lz.planted_at, lz.max_growth_time, current_time)
 
         lingzhis_data.append({
             'id': lz.id,
             'name': lz.name,
             'quality': lz.quality,
             'level': lz.level,
-            'growth_stage': lz.growth_stage,
+            'growth_stage': growth_stage,
             'growth_progress': growth_progress,
             'has_mutated': lz.has_mutated,
             'attribute_type': lz.attribute_type,
@@ -3055,7 +4147,7 @@ def get_lingzhis(current_user):
 def plant_lingzhi(current_user):
     """种植灵植"""
     data = request.get_json()
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3093,11 +4185,12 @@ def plant_lingzhi(current_user):
         mutation_rate=config['mutation_rate']
     )
 
+    db.session.add(new_lingzhi)
+    db.session.flush()  # 先取得灵植 id 再关联灵田
+
     available_lingtian.lingzhi_id = new_lingzhi.id
     available_lingtian.is_occupied = True
     available_lingtian.planted_at = datetime.datetime.utcnow()
-
-    db.session.add(new_lingzhi)
     db.session.commit()
 
     return jsonify({
@@ -3113,23 +4206,23 @@ def plant_lingzhi(current_user):
 
 @app.route('/lingzhi/harvest/<int:lingzhi_id>', methods=['POST'])
 @token_required
+@character_required
 def harvest_lingzhi(current_user, lingzhi_id):
     """收获灵植"""
     data = request.get_json() or {}
     action = data.get('action', 'harvest')  # harvest 或 upgrade
 
     lingzhi = db.session.get(Lingzhi, lingzhi_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not lingzhi or lingzhi.owner_id != char.id:
         return jsonify({'message': 'Lingzhi not found'}), 404
 
     # 检查是否成熟
     current_time = datetime.datetime.utcnow()
-    planted_time = lingzhi.planted_at
-    time_diff = (current_time - planted_time).total_seconds() / 60
-
-    if time_diff < lingzhi.max_growth_time:
+    growth_stage, _, time_diff = lingzhi_growth(lingzhi.planted_at, lingzhi.max_growth_time, current_time)
+    if growth_stage != '成熟':
         return jsonify({'message': 'Lingzhi not mature yet'}), 400
+    lingzhi.growth_stage = growth_stage
 
     if action == 'upgrade':
         # 升级灵植：检查是否可以升级（需要达到前面所有阶段生长时间总和）
@@ -3157,25 +4250,10 @@ def harvest_lingzhi(current_user, lingzhi_id):
 
     else:
         # 收获灵植
-        # 计算收获奖励
-        quality_multipliers = {
-            '凡品': 1, '黄品': 2, '玄品': 5, '地品': 10, '天品': 20, '无上': 50
-        }
-        base_reward = 100
-        multiplier = quality_multipliers.get(lingzhi.quality, 1)
-        reward = base_reward * multiplier * lingzhi.level  # 等级越高奖励越多
-
-        # 变异奖励
-        if lingzhi.has_mutated and lingzhi.attribute_value > 0:
-            reward *= 2  # 变异灵植奖励翻倍
+        reward = lingzhi_harvest_reward(lingzhi)
 
         # 发放奖励（灵石）
-        resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-        if resource:
-            resource.amount += reward
-        else:
-            resource = Resource(character_id=char.id, type='灵石', amount=reward)
-            db.session.add(resource)
+        wallet_credit(char.id, reward)
 
         # 清理灵植和灵田
         lingtian = Lingtian.query.filter_by(lingzhi_id=lingzhi_id).first()
@@ -3198,13 +4276,14 @@ def harvest_lingzhi(current_user, lingzhi_id):
 
 @app.route('/lingzhi/care/<int:lingzhi_id>', methods=['POST'])
 @token_required
+@character_required
 def care_lingzhi(current_user, lingzhi_id):
     """照顾灵植"""
     data = request.get_json()
     care_type = data.get('type', 'water')  # water, fertilizer, sunlight
 
     lingzhi = db.session.get(Lingzhi, lingzhi_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not lingzhi or lingzhi.owner_id != char.id:
         return jsonify({'message': 'Lingzhi not found'}), 404
 
@@ -3214,51 +4293,11 @@ def care_lingzhi(current_user, lingzhi_id):
         return jsonify({'message': 'Lingzhi not planted in any lingtian'}), 404
 
     # 照顾消耗
-    care_cost = 10
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < care_cost:
+    care_cost = LINGZHI_CARE_COST
+    if not wallet_debit(char.id, care_cost):
         return jsonify({'message': f'Not enough ling shi, need {care_cost}', 'required': care_cost}), 400
 
-    # 更新照顾状态
-    resource.amount -= care_cost
-
-    if care_type == 'water':
-        lingzhi.water_level = min(100, lingzhi.water_level + 20)
-    elif care_type == 'fertilizer':
-        lingzhi.fertilizer_level = min(100, lingzhi.fertilizer_level + 20)
-        # 记录施肥次数（用于变异概率计算）
-        lingtian.fertilizer_level += 1
-    elif care_type == 'sunlight':
-        lingzhi.sunlight_level = min(100, lingzhi.sunlight_level + 20)
-
-    # 计算变异概率：(1 + 0.1 × (灵田等级-1)) × (1 + 0.05 × min(施肥次数, 10)) × 天气系数× P基本概率
-    # 简化：假设灵田等级为1，天气系数为1.0
-    lingtian_level = 1  # 可以后续扩展灵田等级系统
-    fertilizer_times = min(lingtian.fertilizer_level, 10)
-    weather_factor = 1.0  # 可以后续添加天气系统
-    base_mutation_rate = lingzhi.mutation_rate
-
-    final_mutation_rate = (1 + 0.1 * (lingtian_level - 1)) * (1 + 0.05 * fertilizer_times) * weather_factor * base_mutation_rate
-    final_mutation_rate = min(final_mutation_rate, 0.1)  # 最高不超过10%
-
-    # 变异检查
-    mutated = False
-    attribute_type = None
-    attribute_value = 0
-
-    if not lingzhi.has_mutated and random.random() < final_mutation_rate:
-        mutated = True
-        lingzhi.has_mutated = True
-
-        # 随机变异属性
-        attributes = ['攻击', '防御', '生命', '速度']
-        attribute_type = random.choice(attributes)
-        attribute_value = random.randint(5, 20) * lingzhi.level
-
-        lingzhi.attribute_type = attribute_type
-        lingzhi.attribute_value = attribute_value
-
-    lingzhi.last_cared_at = datetime.datetime.utcnow()
+    final_mutation_rate, mutated = apply_lingzhi_care(lingzhi, lingtian, care_type, random.random())
     db.session.commit()
 
     return jsonify({
@@ -3270,8 +4309,8 @@ def care_lingzhi(current_user, lingzhi_id):
         'sunlight_level': lingzhi.sunlight_level,
         'mutation_rate': final_mutation_rate,
         'mutated': mutated,
-        'attribute_type': attribute_type,
-        'attribute_value': attribute_value
+        'attribute_type': lingzhi.attribute_type if mutated else None,
+        'attribute_value': lingzhi.attribute_value if mutated else 0
     }), 200
 
 
@@ -3279,7 +4318,7 @@ def care_lingzhi(current_user, lingzhi_id):
 @token_required
 def get_lingtians(current_user):
     """获取灵田列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3319,7 +4358,7 @@ def get_lingtians(current_user):
 @token_required
 def init_lingtians(current_user):
     """初始化灵田"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3344,11 +4383,115 @@ def init_lingtians(current_user):
     return jsonify({'message': 'Lingtians initialized successfully'}), 201
 
 
+def planted_lingtians(character_id):
+    """一次查询取出人物所有已种植的灵田及其灵植"""
+    return db.session.query(Lingtian, Lingzhi)\
+        .join(Lingzhi, Lingtian.lingzhi_id == Lingzhi.id)\
+        .filter(Lingtian.owner_id == character_id)\
+        .order_by(Lingtian.slot)\
+        .all()
+
+
+@app.route('/lingtian/care_all', methods=['POST'])
+@token_required
+def care_all_lingtians(current_user):
+    """一键照顾所有灵田（每块灵田按所选方式各照顾一次，统一扣费）"""
+    data = request.get_json() or {}
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    care_types = data.get('types', list(LINGZHI_CARE_TYPES))
+    if isinstance(care_types, str):
+        care_types = [care_types]
+    if not care_types or any(t not in LINGZHI_CARE_TYPES for t in care_types):
+        return jsonify({'message': f'Invalid care types, allowed: {list(LINGZHI_CARE_TYPES)}'}), 400
+
+    plots = planted_lingtians(char.id)
+    if not plots:
+        return jsonify({'message': 'No planted lingtian'}), 400
+
+    total_cost = LINGZHI_CARE_COST * len(care_types) * len(plots)
+    if not wallet_debit(char.id, total_cost):
+        return jsonify({'message': f'Not enough ling shi, need {total_cost}', 'required': total_cost}), 400
+
+    rolls = iter(batch_uniforms(len(care_types) * len(plots)))
+    results = []
+    for lingtian, lingzhi in plots:
+        mutated = False
+        for care_type in care_types:
+            _, care_mutated = apply_lingzhi_care(lingzhi, lingtian, care_type, next(rolls))
+            mutated = mutated or care_mutated
+        results.append({
+            'lingtian_id': lingtian.id,
+            'lingzhi_id': lingzhi.id,
+            'name': lingzhi.name,
+            'growth_stage': lingzhi.growth_stage,
+            'water_level': lingzhi.water_level,
+            'fertilizer_level': lingzhi.fertilizer_level,
+            'sunlight_level': lingzhi.sunlight_level,
+            'mutated': mutated,
+            'attribute_type': lingzhi.attribute_type if mutated else None,
+            'attribute_value': lingzhi.attribute_value if mutated else 0
+        })
+    db.session.commit()
+
+    return jsonify({
+        'message': f'Cared for {len(results)} lingzhi',
+        'care_types': care_types,
+        'cost': total_cost,
+        'results': results
+    }), 200
+
+
+@app.route('/lingtian/harvest_all', methods=['POST'])
+@token_required
+def harvest_all_lingtians(current_user):
+    """一键收获所有成熟灵植，奖励一次性发放"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    current_time = datetime.datetime.utcnow()
+    harvested = []
+    total_reward = 0
+    for lingtian, lingzhi in planted_lingtians(char.id):
+        if lingzhi_growth(lingzhi.planted_at, lingzhi.max_growth_time, current_time)[0] != '成熟':
+            continue
+        reward = lingzhi_harvest_reward(lingzhi)
+        total_reward += reward
+        harvested.append({
+            'lingzhi_id': lingzhi.id,
+            'name': lingzhi.name,
+            'quality': lingzhi.quality,
+            'level': lingzhi.level,
+            'mutated': lingzhi.has_mutated,
+            'reward': reward
+        })
+        # 清理灵植和灵田
+        lingtian.lingzhi_id = None
+        lingtian.is_occupied = False
+        lingtian.planted_at = None
+        db.session.delete(lingzhi)
+
+    if not harvested:
+        return jsonify({'message': 'No mature lingzhi to harvest'}), 400
+
+    wallet_credit(char.id, total_reward)
+    db.session.commit()
+
+    return jsonify({
+        'message': f'Successfully harvested {len(harvested)} lingzhi',
+        'reward': total_reward,
+        'harvested': harvested
+    }), 200
+
+
 @app.route('/lingzhi/codex', methods=['GET'])
 @token_required
 def get_lingzhi_codex(current_user):
     """获取灵植图鉴"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3392,7 +4535,7 @@ def start_combat(current_user):
     monster_id = data.get('monster_id')
     dungeon_id = data.get('dungeon_id')
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3405,20 +4548,20 @@ def start_combat(current_user):
     weather = random.choice(['晴天', '雨天', '雪天', '雾天', '雷暴', '烈日'])
 
     if combat_type == 'monster':
-        monster = db.session.get(Monster, monster_id)
+        monster = catalog.monster(monster_id)
         if not monster:
             return jsonify({'message': 'Monster not found'}), 404
 
         combat = CombatState(
             character_id=char.id,
-            monster_id=monster_id,
+            monster_id=monster.id,
             weather=weather,
-            character_hp=calculate_combat_stats(char, weather)['total_hp'],
+            character_hp=get_combat_stats(char, weather)['total_hp'],
             monster_hp=monster.hp,
             is_active=True
         )
     elif combat_type == 'dungeon':
-        dungeon = db.session.get(Dungeon, dungeon_id)
+        dungeon = catalog.dungeon(dungeon_id)
         if not dungeon:
             return jsonify({'message': 'Dungeon not found'}), 404
 
@@ -3427,21 +4570,19 @@ def start_combat(current_user):
             return jsonify({'message': f'Level requirement not met: {dungeon.level_requirement}', 'required_level': dungeon.level_requirement}), 400
 
         # 选择第一个怪物作为开始
-        monster_ids = eval(dungeon.monster_ids) if dungeon.monster_ids else []
-        if not monster_ids:
+        if not dungeon.monster_ids:
             return jsonify({'message': 'Dungeon has no monsters'}), 400
 
-        first_monster_id = monster_ids[0]
-        monster = db.session.get(Monster, first_monster_id)
+        monster = catalog.monster(dungeon.monster_ids[0])
         if not monster:
             return jsonify({'message': 'Dungeon monster not found'}), 404
 
         combat = CombatState(
             character_id=char.id,
-            monster_id=first_monster_id,
-            dungeon_id=dungeon_id,
+            monster_id=monster.id,
+            dungeon_id=dungeon.id,
             weather=weather,
-            character_hp=calculate_combat_stats(char, weather)['total_hp'],
+            character_hp=get_combat_stats(char, weather)['total_hp'],
             monster_hp=monster.hp,
             is_active=True
         )
@@ -3471,58 +4612,29 @@ def start_combat(current_user):
 
 @app.route('/combat/<int:combat_id>/action', methods=['POST'])
 @token_required
+@character_required
 def perform_combat_action(current_user, combat_id):
     """执行战斗行动"""
     data = request.get_json()
     action_type = data.get('action', 'attack')  # attack, defend, skill, flee
 
     combat = db.session.get(CombatState, combat_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not combat or combat.character_id != char.id or not combat.is_active:
         return jsonify({'message': 'Combat not found or not active'}), 404
 
-    monster = db.session.get(Monster, combat.monster_id)
+    monster = catalog.monster(combat.monster_id)
     if not monster:
         return jsonify({'message': 'Monster not found'}), 404
 
     # 计算战斗属性
-    char_stats = calculate_combat_stats(char, combat.weather)
-    monster_stats = {
-        'total_attack': monster.attack,
-        'total_defense': monster.defense,
-        'total_hp': monster.hp,
-        'total_speed': monster.speed,
-        'crit_rate': 0.05,
-        'dodge_rate': 0.05,
-        'hit_rate': 0.9,
-        'crit_damage': 1.5,
-        'penetration_rate': 0,
-        'linggen': monster.linggen
-    }
+    char_stats = get_combat_stats(char, combat.weather)
+    monster_stats = build_monster_stats(monster)
+    equipped_shentong = Shentong.query.filter_by(character_id=char.id, equipped=True).first()
 
-    combat_log = []
+    combat_log = resolve_combat_turn(action_type, char_stats, monster_stats, combat, data, equipped_shentong)
     combat_result = None
 
-    # 决定行动顺序（速度高的先行动）
-    if char_stats['total_speed'] >= monster_stats['total_speed']:
-        # 玩家先行动
-        player_action_result = perform_player_action(action_type, char_stats, monster_stats, combat, data)
-        combat_log.extend(player_action_result['log'])
-
-        if combat.monster_hp > 0 and not player_action_result.get('fled', False):
-            # 怪物行动
-            monster_action_result = perform_monster_action(monster_stats, char_stats, combat)
-            combat_log.extend(monster_action_result['log'])
-    else:
-        # 怪物先行动
-        monster_action_result = perform_monster_action(monster_stats, char_stats, combat)
-        combat_log.extend(monster_action_result['log'])
-
-        if combat.character_hp > 0 and not monster_action_result.get('fled', False):
-            # 玩家行动
-            player_action_result = perform_player_action(action_type, char_stats, monster_stats, combat, data)
-            combat_log.extend(player_action_result['log'])
-
     # 检查战斗结果
     if combat.character_hp <= 0:
         combat_result = 'defeat'
@@ -3535,15 +4647,15 @@ def perform_combat_action(current_user, combat_id):
 
     # 如果是副本战斗且胜利，进入下一波
     if combat_result == 'victory' and combat.dungeon_id:
-        dungeon = db.session.get(Dungeon, combat.dungeon_id)
+        dungeon = catalog.dungeon(combat.dungeon_id)
         if dungeon:
-            monster_ids = eval(dungeon.monster_ids) if dungeon.monster_ids else []
+            monster_ids = dungeon.monster_ids
             current_index = monster_ids.index(combat.monster_id) if combat.monster_id in monster_ids else -1
 
             if current_index < len(monster_ids) - 1:
                 # 还有下一波怪物
                 next_monster_id = monster_ids[current_index + 1]
-                next_monster = db.session.get(Monster, next_monster_id)
+                next_monster = catalog.monster(next_monster_id)
                 if next_monster:
                     combat.monster_id = next_monster_id
                     combat.monster_hp = next_monster.hp
@@ -3566,7 +4678,177 @@ def perform_combat_action(current_user, combat_id):
     }), 200
 
 
-def perform_player_action(action_type, char_stats, monster_stats, combat, data):
+# 自动战斗单场最大回合数，防止双方都打不动时无限循环
+AUTO_COMBAT_MAX_TURNS = 500
+
+# 自动战斗压缩日志的字段顺序
+AUTO_COMBAT_LOG_FIELDS = ['turn', 'wave', 'damage_dealt', 'damage_taken', 'character_hp', 'monster_hp']
+
+
+@app.route('/combat/auto', methods=['POST'])
+@token_required
+def auto_combat(current_user):
+    """自动战斗：在一次请求内结算整场战斗，只在结束时提交一次"""
+    data = request.get_json() or {}
+    combat_type = data.get('type', 'monster')  # monster 或 dungeon
+    action_type = data.get('action', 'attack')  # attack 或 skill
+    if action_type not in ('attack', 'skill'):
+        return jsonify({'message': 'Invalid action'}), 400
+
+    try:
+        max_turns = int(data.get('max_turns', AUTO_COMBAT_MAX_TURNS))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid max_turns'}), 400
+    max_turns = max(1, min(max_turns, AUTO_COMBAT_MAX_TURNS))
+
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    # 检查是否有正在进行的战斗
+    active_combat = CombatState.query.filter_by(character_id=char.id, is_active=True).first()
+    if active_combat:
+        return jsonify({'message': 'Combat already in progress'}), 400
+
+    dungeon_id = None
+    if combat_type == 'monster':
+        monster = catalog.monster(data.get('monster_id'))
+        if not monster:
+            return jsonify({'message': 'Monster not found'}), 404
+        waves = [monster]
+    elif combat_type == 'dungeon':
+        dungeon = catalog.dungeon(data.get('dungeon_id'))
+        if not dungeon:
+            return jsonify({'message': 'Dungeon not found'}), 404
+
+        # 检查等级要求
+        if char.level < dungeon.level_requirement:
+            return jsonify({'message': f'Level requirement not met: {dungeon.level_requirement}', 'required_level': dungeon.level_requirement}), 400
+
+        if not dungeon.monster_ids:
+            return jsonify({'message': 'Dungeon has no monsters'}), 400
+
+        # 与逐回合模式一致，缺失的怪物之后视为副本结束
+        dungeon_id = dungeon.id
+        waves = catalog.dungeon_waves(dungeon_id)
+        if not waves:
+            return jsonify({'message': 'Dungeon monster not found'}), 404
+    else:
+        return jsonify({'message': 'Invalid combat type'}), 400
+
+    weather = random.choice(['晴天', '雨天', '雪天', '雾天', '雷暴', '烈日'])
+    char_stats = get_combat_stats(char, weather)
+    if char_stats is None:
+        return jsonify({'message': 'Character attributes not found'}), 404
+    equipped_shentong = Shentong.query.filter_by(character_id=char.id, equipped=True).first()
+
+    combat = CombatState(
+        character_id=char.id,
+        monster_id=waves[0].id,
+        dungeon_id=dungeon_id,
+        weather=weather,
+        current_turn=0,
+        character_hp=char_stats['total_hp'],
+        monster_hp=waves[0].hp,
+        is_active=True
+    )
+    db.session.add(combat)
+
+    # 整场战斗在内存中进行，压缩日志每回合一行
+    turn_log = []
+    rewards = {'experience': 0, 'lingshi': 0}
+    combat_result = 'timeout'
+    wave = 0
+    monster_stats = build_monster_stats(waves[0])
+    while combat.current_turn < max_turns:
+        monster_hp_before = combat.monster_hp
+        character_hp_before = combat.character_hp
+        resolve_combat_turn(action_type, char_stats, monster_stats, combat, data, equipped_shentong)
+        combat.current_turn += 1
+        turn_log.append([
+            combat.current_turn, wave,
+            monster_hp_before - combat.monster_hp, character_hp_before - combat.character_hp,
+            combat.character_hp, combat.monster_hp
+        ])
+
+        if combat.character_hp <= 0:
+            combat_result = 'defeat'
+            break
+        if combat.monster_hp <= 0:
+            reward = award_combat_rewards(char, waves[wave], weather)
+            rewards['experience'] += reward['experience']
+            rewards['lingshi'] += reward['lingshi']
+            wave += 1
+            if wave >= len(waves):
+                combat_result = 'victory'
+                break
+            # 进入下一波
+            combat.monster_id = waves[wave].id
+            combat.monster_hp = waves[wave].hp
+            monster_stats = build_monster_stats(waves[wave])
+
+    combat.is_active = False
+    db.session.commit()
+
+    return jsonify({
+        'combat_id': combat.id,
+        'result': combat_result,
+        'turns': combat.current_turn,
+        'waves_cleared': wave,
+        'weather': weather,
+        'character_hp': combat.character_hp,
+        'level': char.level,
+        'rewards': rewards,
+        'log_fields': AUTO_COMBAT_LOG_FIELDS,
+        'log': turn_log
+    }), 200
+
+
+def build_monster_stats(monster):
+    """构造怪物的战斗属性"""
+    return {
+        'name': monster.name,
+        'total_attack': monster.attack,
+        'total_defense': monster.defense,
+        'total_hp': monster.hp,
+        'total_speed': monster.speed,
+        'crit_rate': 0.05,
+        'dodge_rate': 0.05,
+        'hit_rate': 0.9,
+        'crit_damage': 1.5,
+        'penetration_rate': 0,
+        'linggen': monster.linggen
+    }
+
+
+def resolve_combat_turn(action_type, char_stats, monster_stats, combat, data, equipped_shentong=None):
+    """结算一个回合（双方各行动一次），返回战斗日志"""
+    combat_log = []
+
+    # 决定行动顺序（速度高的先行动）
+    if char_stats['total_speed'] >= monster_stats['total_speed']:
+        # 玩家先行动
+        player_action_result = perform_player_action(action_type, char_stats, monster_stats, combat, data, equipped_shentong)
+        combat_log.extend(player_action_result['log'])
+
+        if combat.monster_hp > 0 and not player_action_result.get('fled', False):
+            # 怪物行动
+            monster_action_result = perform_monster_action(monster_stats, char_stats, combat)
+            combat_log.extend(monster_action_result['log'])
+    else:
+        # 怪物先行动
+        monster_action_result = perform_monster_action(monster_stats, char_stats, combat)
+        combat_log.extend(monster_action_result['log'])
+
+        if combat.character_hp > 0 and not monster_action_result.get('fled', False):
+            # 玩家行动
+            player_action_result = perform_player_action(action_type, char_stats, monster_stats, combat, data, equipped_shentong)
+            combat_log.extend(player_action_result['log'])
+
+    return combat_log
+
+
+def perform_player_action(action_type, char_stats, monster_stats, combat, data, equipped_shentong=None):
     """执行玩家行动"""
     log = []
 
@@ -3577,7 +4859,6 @@ def perform_player_action(action_type, char_stats, monster_stats, combat, data):
         log.append(f"你发动普通攻击，造成{damage}点伤害！")
 
         # 神通发动检查
-        equipped_shentong = Shentong.query.filter_by(character_id=combat.character_id, equipped=True).first()
         if equipped_shentong and random.random() < equipped_shentong.trigger_rate:
             shentong_damage = int(damage * equipped_shentong.damage_multiplier)
             combat.monster_hp -= shentong_damage
@@ -3626,16 +4907,16 @@ def perform_monster_action(monster_stats, char_stats, combat):
         # 普通攻击
         damage = calculate_damage(monster_stats, char_stats, combat.weather)
         combat.character_hp -= damage
-        log.append(f"{Monster.query.get(combat.monster_id).name if combat.monster_id else '怪物'}发动攻击，造成{damage}点伤害！")
+        log.append(f"{monster_stats.get('name', '怪物')}发动攻击，造成{damage}点伤害！")
     else:
         # 特殊行动（这里简化）
-        log.append(f"{Monster.query.get(combat.monster_id).name if combat.monster_id else '怪物'}使用特殊技能！")
+        log.append(f"{monster_stats.get('name', '怪物')}使用特殊技能！")
 
     return {'log': log}
 
 
 def award_combat_rewards(character, monster, weather):
-    """发放战斗奖励"""
+    """发放战斗奖励（由调用方提交）"""
     # 经验奖励
     exp_reward = monster.experience_reward
     weather_bonus = WEATHER_FACTORS.get(weather, {}).get('基础', 1.0)
@@ -3643,39 +4924,37 @@ def award_combat_rewards(character, monster, weather):
 
     character.experience += exp_reward
 
-    # 检查升级
-    while character.experience >= exp_for_level(character.level):
-        character.experience -= exp_for_level(character.level)
-        if character.level < 100:  # 最大等级限制
-            character.level += 1
+    # 检查升级（查经验表批量升级；满级后多余经验按满级所需取余，与逐级扣除一致）
+    gained = affordable_levels(character.level, character.experience, MAX_LEVEL - character.level)
+    if gained:
+        character.experience -= exp_cost(character.level, gained)
+        character.level += gained
+    if character.level >= MAX_LEVEL:
+        character.experience %= exp_needed(character.level)
 
     # 灵石奖励
     lingshi_reward = monster.lingshi_reward
-    resource = Resource.query.filter_by(character_id=character.id, type='灵石').first()
-    if resource:
-        resource.amount += lingshi_reward
-    else:
-        resource = Resource(character_id=character.id, type='灵石', amount=lingshi_reward)
-        db.session.add(resource)
+    wallet_credit(character.id, lingshi_reward)
 
     # 掉落物品（简化处理）
     if monster.drop_items and random.random() < 0.3:  # 30%掉落概率
         # 这里可以添加物品掉落逻辑
         pass
 
-    db.session.commit()
+    return {'experience': exp_reward, 'lingshi': lingshi_reward}
 
 
 @app.route('/combat/<int:combat_id>', methods=['GET'])
 @token_required
+@character_required
 def get_combat_status(current_user, combat_id):
     """获取战斗状态"""
     combat = db.session.get(CombatState, combat_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not combat or combat.character_id != char.id:
         return jsonify({'message': 'Combat not found'}), 404
 
-    monster = db.session.get(Monster, combat.monster_id) if combat.monster_id else None
+    monster = catalog.monster(combat.monster_id) if combat.monster_id else None
 
     return jsonify({
         'combat_id': combat.id,
@@ -3695,10 +4974,11 @@ def get_combat_status(current_user, combat_id):
 
 @app.route('/combat/<int:combat_id>/end', methods=['POST'])
 @token_required
+@character_required
 def end_combat(current_user, combat_id):
     """结束战斗"""
     combat = db.session.get(CombatState, combat_id)
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not combat or combat.character_id != char.id:
         return jsonify({'message': 'Combat not found'}), 404
 
@@ -3713,7 +4993,7 @@ def end_combat(current_user, combat_id):
 @token_required
 def get_monsters(current_user):
     """获取怪物列表"""
-    monsters = Monster.query.all()
+    monsters = catalog.monster_list
     monsters_data = []
     for monster in monsters:
         monsters_data.append({
@@ -3738,11 +5018,11 @@ def get_monsters(current_user):
 @token_required
 def get_dungeons(current_user):
     """获取副本列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
-    dungeons = Dungeon.query.filter(Dungeon.level_requirement <= char.level).all()
+    dungeons = [d for d in catalog.dungeon_list if d.level_requirement <= char.level]
     dungeons_data = []
     for dungeon in dungeons:
         dungeons_data.append({
@@ -3762,7 +5042,7 @@ def get_dungeons(current_user):
 @token_required
 def get_world_map(current_user):
     """获取世界地图"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3782,7 +5062,7 @@ def get_world_map(current_user):
 @token_required
 def explore_map_point(current_user, point_id):
     """探索地图点"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3799,12 +5079,7 @@ def explore_map_point(current_user, point_id):
 
     # 发放资源
     for resource_item in result['resources']:
-        resource = Resource.query.filter_by(character_id=char.id, type=resource_item['type']).first()
-        if resource:
-            resource.amount += resource_item['amount']
-        else:
-            resource = Resource(character_id=char.id, type=resource_item['type'], amount=resource_item['amount'])
-            db.session.add(resource)
+        wallet_credit(char.id, resource_item['amount'], resource_item['type'])
 
     db.session.commit()
 
@@ -3820,7 +5095,7 @@ def explore_map_point(current_user, point_id):
 @token_required
 def get_life_skills(current_user):
     """获取生活技能列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3842,7 +5117,7 @@ def get_life_skills(current_user):
 @token_required
 def init_life_skills(current_user):
     """初始化生活技能"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3869,7 +5144,7 @@ def identify_item(current_user):
     item_type = data.get('item_type')  # equipment, treasure, rune
     item_id = data.get('item_id')
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -3879,8 +5154,7 @@ def identify_item(current_user):
 
     # 消耗灵石
     cost = 50 * skill_level  # 鉴定消耗随技能等级增加
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < cost:
+    if not wallet_debit(char.id, cost):
         return jsonify({'message': f'Not enough ling shi, need {cost}', 'required': cost}), 400
 
     # 计算成功率：基础成功率 = min(技能等级系数 + 道具品质系数 + 悟性*系数, 基础成功率上限)
@@ -3901,16 +5175,12 @@ def identify_item(current_user):
         )
         db.session.add(identification)
 
-        # 扣除灵石
-        resource.amount -= cost
-
         # 增加技能经验
         if identify_skill:
             identify_skill.experience += 10
             # 检查升级
-            while identify_skill.experience >= identify_skill.level * 100:
-                identify_skill.experience -= identify_skill.level * 100
-                identify_skill.level += 1
+            identify_skill.level, identify_skill.experience = skill_level_progress(
+                identify_skill.level, identify_skill.experience)
 
         db.session.commit()
 
@@ -3922,7 +5192,6 @@ def identify_item(current_user):
         }), 200
     else:
         # 鉴定失败
-        resource.amount -= cost
         db.session.commit()
 
         return jsonify({
@@ -3936,7 +5205,7 @@ def identify_item(current_user):
 @token_required
 def get_materials(current_user):
     """获取材料列表"""
-    materials = Material.query.all()
+    materials = catalog.material_list
     materials_data = []
     for material in materials:
         materials_data.append({
@@ -3956,14 +5225,14 @@ def get_materials(current_user):
 @token_required
 def get_material_inventory(current_user):
     """获取材料库存"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
     inventory = MaterialInventory.query.filter_by(character_id=char.id).all()
     inventory_data = []
     for item in inventory:
-        material = Material.query.get(item.material_id)
+        material = catalog.material(item.material_id)
         if material:
             inventory_data.append({
                 'id': item.id,
@@ -3985,13 +5254,18 @@ def collect_materials(current_user):
     """采集材料"""
     data = request.get_json()
     material_id = data.get('material_id')
-    quantity = data.get('quantity', 1)
+    try:
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid quantity'}), 400
+    if quantity < 1:
+        return jsonify({'message': 'Invalid quantity'}), 400
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
-    material = Material.query.get(material_id)
+    material = catalog.material(material_id)
     if not material:
         return jsonify({'message': 'Material not found'}), 404
 
@@ -4007,14 +5281,11 @@ def collect_materials(current_user):
 
     # 消耗灵石
     cost = 20 * quantity
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < cost:
+    if not wallet_debit(char.id, cost):
         return jsonify({'message': f'Not enough ling shi, need {cost}', 'required': cost}), 400
 
-    collected = 0
-    for i in range(quantity):
-        if random.random() < final_success_rate:
-            collected += 1
+    # 采集数量服从二项分布，一次抽样，耗时与 quantity 无关
+    collected = binomial_sample(quantity, final_success_rate)
 
     if collected > 0:
         # 更新材料库存
@@ -4033,16 +5304,12 @@ def collect_materials(current_user):
             )
             db.session.add(inventory_item)
 
-        # 扣除灵石
-        resource.amount -= cost
-
         # 增加技能经验
         if collect_skill:
             collect_skill.experience += collected * 5
             # 检查升级
-            while collect_skill.experience >= collect_skill.level * 100:
-                collect_skill.experience -= collect_skill.level * 100
-                collect_skill.level += 1
+            collect_skill.level, collect_skill.experience = skill_level_progress(
+                collect_skill.level, collect_skill.experience)
 
         db.session.commit()
 
@@ -4054,7 +5321,6 @@ def collect_materials(current_user):
         }), 200
     else:
         # 采集失败
-        resource.amount -= cost
         db.session.commit()
 
         return jsonify({
@@ -4073,7 +5339,7 @@ def calculate_success_rate(current_user):
     skill_type = data.get('skill_type')
     material_quality_factor = data.get('material_quality_factor', 1.0)
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4101,47 +5367,65 @@ def calculate_success_rate(current_user):
 # 社交和经济系统API
 
 # 好友系统API
+# 每个人物的好友 id 集合（LRU 缓存，带过期时间），“是否好友”判断无需查库
+friend_cache = LRUCache(app.config['FRIEND_CACHE_SIZE'], ttl=app.config['FRIEND_CACHE_TTL'])
+
+def friend_ids(character_id):
+    """人物的好友 id 集合（带缓存）"""
+    def load():
+        other = db.case((Friendship.character_id == character_id, Friendship.friend_id), else_=Friendship.character_id)
+        rows = db.session.query(other).filter(
+            db.or_(Friendship.character_id == character_id, Friendship.friend_id == character_id)
+        )
+        return frozenset(friend_id for (friend_id,) in rows)
+    return friend_cache.get_or_set(character_id, load)
+
+def are_friends(character_id, other_id):
+    return other_id in friend_ids(character_id)
+
+def invalidate_friends(*character_ids):
+    for character_id in character_ids:
+        friend_cache.invalidate(character_id)
+
+
 @app.route('/friends', methods=['GET'])
 @token_required
 def get_friends(current_user):
-    """获取好友列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    """获取好友列表（一次连表查询）"""
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
-    # 获取好友关系（双向）
-    friends1 = Friendship.query.filter_by(character_id=char.id).all()
-    friends2 = Friendship.query.filter_by(friend_id=char.id).all()
+    other = db.case((Friendship.character_id == char.id, Friendship.friend_id), else_=Friendship.character_id)
+    rows = db.session.query(Friendship, Character.id, Character.name, Character.level, Character.realm)\
+        .join(Character, Character.id == other)\
+        .filter(db.or_(Friendship.character_id == char.id, Friendship.friend_id == char.id))\
+        .order_by(Character.id)\
+        .all()
 
     friends_data = []
-    friend_ids = set()
-
-    for friendship in friends1 + friends2:
-        friend_id = friendship.friend_id if friendship.character_id == char.id else friendship.character_id
-        if friend_id not in friend_ids:
-            friend_ids.add(friend_id)
-            friend_char = Character.query.get(friend_id)
-            if friend_char:
-                friends_data.append({
-                    'id': friend_id,
-                    'name': friend_char.name,
-                    'level': friend_char.level,
-                    'realm': friend_char.realm,
-                    'intimacy': friendship.intimacy,
-                    'status': friendship.status
-                })
+    for friendship, friend_id, name, level, realm in rows:
+        friends_data.append({
+            'id': friend_id,
+            'name': name,
+            'level': level,
+            'realm': realm,
+            'intimacy': friendship.intimacy,
+            'status': friendship.status
+        })
 
     return jsonify({'friends': friends_data}), 200
 
 
 @app.route('/friends/add', methods=['POST'])
 @token_required
+@character_required
 def add_friend(current_user):
     """添加好友"""
     data = request.get_json()
     friend_name = data.get('friend_name')
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     friend_char = Character.query.filter_by(name=friend_name).first()
 
     if not char or not friend_char:
@@ -4151,22 +5435,24 @@ def add_friend(current_user):
         return jsonify({'message': 'Cannot add yourself as friend'}), 400
 
     # 检查是否已经是好友
-    existing = Friendship.query.filter(
-        ((Friendship.character_id == char.id) & (Friendship.friend_id == friend_char.id)) |
-        ((Friendship.character_id == friend_char.id) & (Friendship.friend_id == char.id))
-    ).first()
-
-    if existing:
+    if are_friends(char.id, friend_char.id):
         return jsonify({'message': 'Already friends'}), 400
 
-    # 创建好友关系
+    # 创建好友关系（有序对，唯一索引兜底并发重复添加）
+    character_id, other_id = friendship_pair(char.id, friend_char.id)
     friendship = Friendship(
-        character_id=char.id,
-        friend_id=friend_char.id,
+        character_id=character_id,
+        friend_id=other_id,
         intimacy=0
     )
     db.session.add(friendship)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        invalidate_friends(char.id, friend_char.id)
+        return jsonify({'message': 'Already friends'}), 400
+    invalidate_friends(char.id, friend_char.id)
 
     return jsonify({
         'message': f'Successfully added {friend_name} as friend',
@@ -4179,33 +5465,174 @@ def add_friend(current_user):
     }), 201
 
 
+@app.route('/friends/remove/<int:friend_id>', methods=['POST'])
+@token_required
+def remove_friend(current_user, friend_id):
+    """删除好友"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    character_id, other_id = friendship_pair(char.id, friend_id)
+    deleted = Friendship.query.filter_by(character_id=character_id, friend_id=other_id).delete()
+    db.session.commit()
+    invalidate_friends(char.id, friend_id)
+    if not deleted:
+        return jsonify({'message': 'Not friends'}), 404
+
+    return jsonify({'message': 'Friend removed', 'friend_id': friend_id}), 200
+
+
 # 邮件系统API
+# 批量标记已读/删除单次最多处理的邮件数
+MAIL_BULK_MAX = 500
+
+def broadcast_system_mail(title, content, min_level=None):
+    """向所有（或达到等级的）人物群发系统邮件（无发件人），一条 INSERT ... SELECT，返回收件人数（不提交）"""
+    recipients = db.select(
+        Character.id, db.literal(title), db.literal(content),
+        db.func.current_timestamp(), db.literal(False), db.literal(True)
+    )
+    if min_level is not None:
+        recipients = recipients.where(Character.level >= min_level)
+    result = db.session.execute(
+        db.insert(Mail).from_select(
+            ['receiver_id', 'title', 'content', 'sent_at', 'read_status', 'is_system'],
+            recipients
+        )
+    )
+    return result.rowcount
+
+
 @app.route('/mail', methods=['GET'])
 @token_required
 def get_mail(current_user):
-    """获取邮件列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    """获取邮件列表（按发送时间倒序游标分页，unread=1 只看未读）"""
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
-    mails = Mail.query.filter_by(receiver_id=char.id).order_by(Mail.sent_at.desc()).all()
+    _, per_page = parse_pagination(request.args)
+    query = Mail.query.filter_by(receiver_id=char.id)
+    if request.args.get('unread') in ('1', 'true'):
+        query = query.filter_by(read_status=False)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            after_id = int(cursor)
+        except ValueError:
+            return jsonify({'message': 'Invalid cursor'}), 400
+        # 游标为上一页最后一封邮件的 id，按库中原值比较 (sent_at, id)，避免时间格式/精度差异
+        if Mail.query.filter_by(id=after_id, receiver_id=char.id).count():
+            anchor = db.aliased(Mail)
+            after_sent_at = db.select(anchor.sent_at).where(anchor.id == after_id).scalar_subquery()
+            query = query.filter(db.or_(
+                Mail.sent_at < after_sent_at,
+                db.and_(Mail.sent_at == after_sent_at, Mail.id < after_id)
+            ))
+        else:
+            query = query.filter(Mail.id < after_id)  # 游标邮件已删除时按 id 近似续读
+    mails = query.order_by(Mail.sent_at.desc(), Mail.id.desc()).limit(per_page + 1).all()
+    has_more = len(mails) > per_page
+    mails = mails[:per_page]
+
+    # 发件人名一次 IN 查询取出
+    sender_ids = {mail.sender_id for mail in mails if not mail.is_system}
+    sender_names = dict(
+        db.session.query(Character.id, Character.name).filter(Character.id.in_(sender_ids))
+    ) if sender_ids else {}
+
     mails_data = []
     for mail in mails:
-        sender = Character.query.get(mail.sender_id)
         mails_data.append({
             'id': mail.id,
             'title': mail.title,
             'content': mail.content,
-            'sender_name': sender.name if sender else 'System',
+            'sender_name': 'System' if mail.is_system else sender_names.get(mail.sender_id, 'System'),
+            'from_friend': not mail.is_system and are_friends(char.id, mail.sender_id),
             'sent_at': mail.sent_at.isoformat(),
             'read_status': mail.read_status
         })
+    next_cursor = str(mails[-1].id) if has_more else None
+
+    return jsonify({'mails': mails_data, 'next_cursor': next_cursor}), 200
+
+
+@app.route('/mail/unread_count', methods=['GET'])
+@token_required
+def get_unread_mail_count(current_user):
+    """未读邮件数"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    count = db.session.query(db.func.count(Mail.id))\
+        .filter(Mail.receiver_id == char.id, Mail.read_status == False)\
+        .scalar()
+    return jsonify({'unread_count': count}), 200
 
-    return jsonify({'mails': mails_data}), 200
+
+def select_bulk_mails(character_id, data):
+    """批量操作的目标邮件：ids 列表或 all=true，返回 (查询条件, 错误响应)"""
+    conditions = [Mail.receiver_id == character_id]
+    if data.get('all') is True:
+        return conditions, None
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids or len(ids) > MAIL_BULK_MAX:
+        return None, (jsonify({'message': f'Provide ids (1-{MAIL_BULK_MAX}) or all=true'}), 400)
+    try:
+        conditions.append(Mail.id.in_([int(i) for i in ids]))
+    except (TypeError, ValueError):
+        return None, (jsonify({'message': 'Invalid ids'}), 400)
+    return conditions, None
+
+
+@app.route('/mail/read', methods=['POST'])
+@token_required
+def read_mails(current_user):
+    """批量标记邮件为已读"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    conditions, error = select_bulk_mails(char.id, request.get_json() or {})
+    if error:
+        return error
+    updated = db.session.execute(
+        db.update(Mail).where(*conditions, Mail.read_status == False)
+        .values(read_status=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    return jsonify({'message': f'{updated} mails marked as read', 'updated': updated}), 200
+
+
+@app.route('/mail/delete', methods=['POST'])
+@token_required
+def delete_mails(current_user):
+    """批量删除邮件（all=true 时只删除已读邮件）"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    data = request.get_json() or {}
+    conditions, error = select_bulk_mails(char.id, data)
+    if error:
+        return error
+    if data.get('all') is True:
+        conditions.append(Mail.read_status == True)
+    deleted = db.session.execute(
+        db.delete(Mail).where(*conditions).execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    return jsonify({'message': f'{deleted} mails deleted', 'deleted': deleted}), 200
 
 
 @app.route('/mail/send', methods=['POST'])
 @token_required
+@character_required
 def send_mail(current_user):
     """发送邮件"""
     data = request.get_json()
@@ -4216,7 +5643,7 @@ def send_mail(current_user):
     if not receiver_name or not title or not content:
         return jsonify({'message': 'Missing required fields'}), 400
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     receiver = Character.query.filter_by(name=receiver_name).first()
 
     if not char or not receiver:
@@ -4240,9 +5667,10 @@ def send_mail(current_user):
 
 @app.route('/mail/<int:mail_id>/read', methods=['POST'])
 @token_required
+@character_required
 def read_mail(current_user, mail_id):
     """标记邮件为已读"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     mail = Mail.query.filter_by(id=mail_id, receiver_id=char.id).first()
 
     if not mail:
@@ -4257,6 +5685,7 @@ def read_mail(current_user, mail_id):
 # 排行榜API
 @app.route('/rankings/<ranking_type>', methods=['GET'])
 @token_required
+@character_required
 def get_rankings(current_user, ranking_type):
     """获取排行榜"""
     valid_types = ['level', 'battle_power', 'wealth', 'sect']
@@ -4278,20 +5707,13 @@ def get_rankings(current_user, ranking_type):
             })
 
     elif ranking_type == 'battle_power':
-        # 战力排行榜
-        chars = Character.query.all()
-        char_powers = []
-        for char in chars:
-            attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
-            if attr:
-                power = compute_battle_power(attr,
-                    Equipment.query.filter_by(character_id=char.id).all(),
-                    Mantra.query.filter_by(character_id=char.id).all(),
-                    Treasure.query.filter_by(character_id=char.id).all())
-                char_powers.append((char, power))
-
-        char_powers.sort(key=lambda x: x[1], reverse=True)
-        for i, (char, power) in enumerate(char_powers[:100], 1):
+        # 战力排行榜：读取增量维护的 Ranking 表，走 (type, score) 索引
+        rows = db.session.query(Ranking.score, Character).join(
+            Character, Character.id == Ranking.character_id
+        ).filter(Ranking.type == 'battle_power').order_by(
+            Ranking.score.desc(), Ranking.character_id
+        ).limit(100).all()
+        for i, (power, char) in enumerate(rows, 1):
             rankings.append({
                 'rank': i,
                 'name': char.name,
@@ -4300,30 +5722,56 @@ def get_rankings(current_user, ranking_type):
                 'value': power
             })
 
+        # 我的排名 = 战力高于我的人数 + 1，COUNT(*) 只扫描 (type, score) 索引中高于我的区间
+        char = g.character
+        my_score = db.session.query(Ranking.score).filter_by(
+            character_id=char.id, type='battle_power'
+        ).scalar() if char else None
+        if my_score is not None:
+            higher = db.session.query(db.func.count()).select_from(Ranking).filter(
+                Ranking.type == 'battle_power', Ranking.score > my_score
+            ).scalar()
+            my_rank = {'rank': higher + 1, 'name': char.name, 'value': my_score}
+        else:
+            my_rank = None
+        return jsonify({'rankings': rankings, 'type': ranking_type, 'my_rank': my_rank}), 200
+
     elif ranking_type == 'wealth':
-        # 财富排行榜
-        chars = Character.query.all()
-        char_wealths = []
-        for char in chars:
-            wealth = 0
-            resources = Resource.query.filter_by(character_id=char.id).all()
-            for res in resources:
-                wealth += res.amount
-            char_wealths.append((char, wealth))
-
-        char_wealths.sort(key=lambda x: x[1], reverse=True)
-        for i, (char, wealth) in enumerate(char_wealths[:100], 1):
-            rankings.append({
-                'rank': i,
-                'name': char.name,
-                'level': char.level,
-                'realm': char.realm,
-                'value': wealth
-            })
+        # 财富排行榜：短时缓存，刷新风暴期间每个周期只查询一次数据库
+        rankings = wealth_ranking_cache.get_or_set('top', compute_wealth_rankings)
 
     return jsonify({'rankings': rankings, 'type': ranking_type}), 200
 
 
+wealth_ranking_cache = TTLCache(app.config['WEALTH_RANKING_TTL'])
+
+
+def compute_wealth_rankings(limit=100):
+    """按资源加权总额计算财富排行，一条分组聚合查询完成"""
+    weights = app.config['WEALTH_WEIGHTS']
+    weighted_amount = db.case(
+        *[(Resource.type == res_type, Resource.amount * weight) for res_type, weight in weights.items()],
+        else_=Resource.amount
+    )
+    totals = db.session.query(
+        Resource.character_id,
+        db.func.sum(weighted_amount).label('wealth')
+    ).group_by(Resource.character_id).subquery()
+
+    wealth = db.func.coalesce(totals.c.wealth, 0)
+    rows = db.session.query(Character, wealth).outerjoin(
+        totals, totals.c.character_id == Character.id
+    ).order_by(wealth.desc(), Character.id).limit(limit).all()
+
+    return [{
+        'rank': i,
+        'name': char.name,
+        'level': char.level,
+        'realm': char.realm,
+        'value': int(value)
+    } for i, (char, value) in enumerate(rows, 1)]
+
+
 # 商城API
 @app.route('/shop', methods=['GET'])
 @token_required
@@ -4348,7 +5796,7 @@ def get_shop(current_user):
 @token_required
 def buy_from_shop(current_user, item_id):
     """从商城购买物品"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4357,13 +5805,9 @@ def buy_from_shop(current_user, item_id):
         return jsonify({'message': 'Shop item not found'}), 404
 
     final_price = int(shop_item.price * shop_item.discount)
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < final_price:
+    if not wallet_debit(char.id, final_price):
         return jsonify({'message': f'Not enough ling shi, need {final_price}', 'required': final_price}), 400
 
-    # 扣除灵石
-    resource.amount -= final_price
-
     # 这里应该创建对应的物品，暂时只记录购买
     db.session.commit()
 
@@ -4377,6 +5821,7 @@ def buy_from_shop(current_user, item_id):
 # 交易系统API
 @app.route('/trade/create', methods=['POST'])
 @token_required
+@character_required
 def create_trade(current_user):
     """创建交易"""
     data = request.get_json()
@@ -4384,7 +5829,7 @@ def create_trade(current_user):
     offer_items = data.get('offer_items', [])
     request_items = data.get('request_items', [])
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     target = Character.query.filter_by(name=target_name).first()
 
     if not char or not target:
@@ -4395,7 +5840,8 @@ def create_trade(current_user):
 
     return jsonify({
         'message': f'Trade request sent to {target_name}',
-        'status': 'pending'
+        'status': 'pending',
+        'is_friend': are_friends(char.id, target.id)
     }), 201
 
 
@@ -4404,7 +5850,7 @@ def create_trade(current_user):
 @token_required
 def get_quests(current_user):
     """获取任务列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4426,9 +5872,10 @@ def get_quests(current_user):
 
 @app.route('/quests/accept/<int:quest_id>', methods=['POST'])
 @token_required
+@character_required
 def accept_quest(current_user, quest_id):
     """接受任务"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     quest = Quest.query.get(quest_id)
 
     if not char or not quest:
@@ -4449,7 +5896,7 @@ def accept_quest(current_user, quest_id):
 @token_required
 def get_achievements(current_user):
     """获取成就列表"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4472,7 +5919,7 @@ def get_achievements(current_user):
 @token_required
 def get_codex(current_user, entry_type):
     """获取图鉴"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4501,7 +5948,7 @@ def get_codex(current_user, entry_type):
 @token_required
 def get_inventory(current_user):
     """获取背包物品"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4522,23 +5969,165 @@ def get_inventory(current_user):
 
 
 # 聊天系统API
+# 各频道最近消息的本进程缓存（按频道键：world / (sect, 宗门id) / (private, 人物id)），
+# 以数据库为准定期同步，多个 worker 进程各自同步，互相发送的消息都能读到
+chat_hub = ChatHub(app.config['CHAT_BUFFER_SIZE'], max_age=app.config['CHAT_SYNC_INTERVAL'])
+CHAT_CHANNELS = ('world', 'sect', 'private')
+
+def chat_message_data(msg, sender_name=None):
+    """聊天消息序列化（缓冲区与接口共用）"""
+    return {
+        'id': msg.id,
+        'channel': msg.channel,
+        'sender_id': msg.sender_id,
+        'sender_name': msg.sender_name or sender_name or 'Unknown',
+        'receiver_id': msg.receiver_id,
+        'content': msg.content,
+        'sent_at': msg.sent_at.isoformat() if msg.sent_at else None,
+        'is_read': msg.is_read
+    }
+
+def chat_channel_key(char, channel):
+    """人物在某频道对应的缓冲键，不在宗门时宗门频道返回 None"""
+    if channel == 'world':
+        return ('world',)
+    if channel == 'sect':
+        member = SectMember.query.filter_by(character_id=char.id).first()
+        return ('sect', member.sect_id) if member else None
+    if channel == 'private':
+        return ('private', char.id)
+    return None
+
+def chat_history(key, after_id=None, limit=50):
+    """从数据库读取某频道的消息（旧消息没有记录发送者名时连表补上），按 id 升序"""
+    query = db.session.query(ChatMessage, Character.name)\
+        .outerjoin(Character, Character.id == ChatMessage.sender_id)\
+        .filter(ChatMessage.channel == key[0])
+    if key[0] == 'sect':
+        query = query.filter(ChatMessage.sect_id == key[1])
+    elif key[0] == 'private':
+        query = query.filter(db.or_(ChatMessage.receiver_id == key[1], ChatMessage.sender_id == key[1]))
+    if after_id is not None:
+        rows = query.filter(ChatMessage.id > after_id).order_by(ChatMessage.id).limit(limit).all()
+    else:
+        rows = query.order_by(ChatMessage.id.desc()).limit(limit).all()[::-1]
+    return [chat_message_data(msg, name) for msg, name in rows]
+
+def chat_loader(key):
+    """缓存同步用的数据库读取函数：after_id 为空时取最新一页，否则取更新的消息
+
+    在独立的应用上下文中查询，退出时即归还连接，长轮询等待和 SSE 推送期间不占用数据库连接。
+    """
+    def load(after_id):
+        with app.app_context():
+            return chat_history(key, after_id=after_id, limit=app.config['CHAT_BUFFER_SIZE'])
+    return load
+
+def chat_messages_since(key, after_id):
+    """缓存中比 after_id 新的消息；缓存已覆盖不到时回退到数据库"""
+    messages, complete = chat_hub.since(key, after_id)
+    if complete:
+        return messages
+    return chat_history(key, after_id=after_id, limit=app.config['CHAT_BUFFER_SIZE'])
+
+def open_chat_channel(channel):
+    """校验频道并同步缓存，返回 (缓冲键, 错误响应)"""
+    char = g.character
+    if not char:
+        return None, (jsonify({'message': 'Character not found'}), 404)
+    if channel not in CHAT_CHANNELS:
+        return None, (jsonify({'message': f'Invalid channel, allowed: {list(CHAT_CHANNELS)}'}), 400)
+    key = chat_channel_key(char, channel)
+    if key is None:
+        return None, (jsonify({'message': 'You are not in any sect'}), 400)
+    chat_hub.refresh(key, chat_loader(key))
+    return key, None
+
+def parse_chat_after(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
 @app.route('/chat/world', methods=['GET'])
 @token_required
 def get_world_chat(current_user):
-    """获取世界聊天消息"""
-    messages = ChatMessage.query.filter_by(channel='world').order_by(ChatMessage.sent_at.desc()).limit(50).all()
-    messages_data = []
-    for msg in messages:
-        sender = Character.query.get(msg.sender_id)
-        messages_data.append({
-            'id': msg.id,
-            'sender_name': sender.name if sender else 'Unknown',
-            'content': msg.content,
-            'sent_at': msg.sent_at.isoformat(),
-            'is_read': msg.is_read
-        })
+    """获取世界聊天消息（最近50条，来自缓存）"""
+    key, error = open_chat_channel('world')
+    if error:
+        return error
+    return jsonify({'messages': chat_hub.recent(key, 50)}), 200  # 最新的在后面
 
-    return jsonify({'messages': messages_data[::-1]}), 200  # 反转顺序，返回最新的在后面
+
+@app.route('/chat/poll', methods=['GET'])
+@token_required
+def poll_chat(current_user):
+    """长轮询：有比 after 新的消息立即返回，否则最多等待 timeout 秒"""
+    key, error = open_chat_channel(request.args.get('channel', 'world'))
+    if error:
+        return error
+
+    after_id = parse_chat_after(request.args.get('after'))
+    if after_id is None:
+        return jsonify({'messages': chat_hub.recent(key, 50)}), 200
+
+    messages = chat_messages_since(key, after_id)
+    if not messages:
+        try:
+            timeout = min(float(request.args.get('timeout', app.config['CHAT_POLL_TIMEOUT'])), app.config['CHAT_POLL_TIMEOUT'])
+        except (TypeError, ValueError):
+            timeout = app.config['CHAT_POLL_TIMEOUT']
+        db.session.close()  # 等待期间归还数据库连接
+        messages, complete = chat_hub.wait(key, after_id, max(0.0, timeout), chat_loader(key))
+        if not complete:
+            messages = chat_history(key, after_id=after_id, limit=app.config['CHAT_BUFFER_SIZE'])
+    return jsonify({'messages': messages}), 200
+
+
+@app.route('/chat/stream', methods=['GET'])
+@token_required
+def stream_chat(current_user):
+    """SSE 推送频道消息，支持 Last-Event-ID 断线续传
+
+    每个连接占用一个同步 worker，因此连接只保持 CHAT_STREAM_MAX_SECONDS 秒，
+    之后由客户端按 retry 间隔自动重连，从 Last-Event-ID 继续。
+    """
+    key, error = open_chat_channel(request.args.get('channel', 'world'))
+    if error:
+        return error
+
+    after_id = parse_chat_after(request.headers.get('Last-Event-ID') or request.args.get('after'))
+    if after_id is None:
+        recent = chat_hub.recent(key, 1)
+        after_id = recent[-1]['id'] if recent else 0
+    backlog = chat_messages_since(key, after_id)
+    try:
+        duration = min(float(request.args.get('duration', app.config['CHAT_STREAM_MAX_SECONDS'])),
+                       app.config['CHAT_STREAM_MAX_SECONDS'])
+    except (TypeError, ValueError):
+        duration = app.config['CHAT_STREAM_MAX_SECONDS']
+    db.session.close()  # 推送期间不占用数据库连接（同步缓存时在独立的应用上下文中查询）
+
+    def events(last_id, pending):
+        deadline = time.monotonic() + duration
+        yield f"retry: {app.config['CHAT_STREAM_RETRY_MS']}\n\n"
+        while True:
+            for msg in pending:
+                last_id = msg['id']
+                yield f"id: {msg['id']}\ndata: {json.dumps(msg, ensure_ascii=False)}\n\n"
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            pending, complete = chat_hub.wait(key, last_id, min(15.0, remaining), chat_loader(key))
+            if not complete:
+                with app.app_context():
+                    pending = chat_history(key, after_id=last_id, limit=app.config['CHAT_BUFFER_SIZE'])
+            if not pending:
+                yield ': keepalive\n\n'
+
+    return Response(events(after_id, backlog), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/chat/send', methods=['POST'])
@@ -4552,26 +6141,47 @@ def send_chat_message(current_user):
 
     if not content:
         return jsonify({'message': 'Content cannot be empty'}), 400
+    if channel not in CHAT_CHANNELS:
+        return jsonify({'message': f'Invalid channel, allowed: {list(CHAT_CHANNELS)}'}), 400
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
     receiver_id = None
-    if receiver_name and channel == 'private':
-        receiver = Character.query.filter_by(name=receiver_name).first()
-        if receiver:
-            receiver_id = receiver.id
+    sect_id = None
+    if channel == 'private':
+        receiver = Character.query.filter_by(name=receiver_name).first() if receiver_name else None
+        if not receiver:
+            return jsonify({'message': 'Receiver not found'}), 404
+        receiver_id = receiver.id
+    elif channel == 'sect':
+        key = chat_channel_key(char, channel)
+        if key is None:
+            return jsonify({'message': 'You are not in any sect'}), 400
+        sect_id = key[1]
 
     message = ChatMessage(
         sender_id=char.id,
+        sender_name=char.name,
         receiver_id=receiver_id,
+        sect_id=sect_id,
         channel=channel,
         content=content
     )
     db.session.add(message)
     db.session.commit()
 
+    # 提交后通知本进程的等待者立即同步缓存，私聊同时通知双方
+    if channel == 'world':
+        chat_hub.publish(('world',))
+    elif channel == 'sect':
+        chat_hub.publish(('sect', sect_id))
+    else:
+        chat_hub.publish(('private', receiver_id))
+        if receiver_id != char.id:
+            chat_hub.publish(('private', char.id))
+
     return jsonify({
         'message': 'Message sent',
         'message_id': message.id
@@ -4589,7 +6199,7 @@ def change_linggen(current_user):
     change_method = data.get('change_method', 'item')  # item, event, special_quest
     item_name = data.get('item_name')  # 如果是通过道具改变
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4602,11 +6212,9 @@ def change_linggen(current_user):
         # 检查是否拥有该道具（这里简化，实际应该检查背包）
         # 消耗灵石作为代价
         cost = 50000  # 改变灵根消耗大量灵石
-        resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-        if not resource or resource.amount < cost:
+        if not wallet_debit(char.id, cost):
             return jsonify({'message': f'Not enough ling shi, need {cost}', 'required': cost}), 400
 
-        resource.amount -= cost
 
         # 随机生成新灵根（不能和原有灵根相同）
         available_linggen = ['金', '木', '水', '火', '土']
@@ -4640,6 +6248,7 @@ def change_linggen(current_user):
 
     # 更新人物灵根
     char.linggen = new_linggen
+    refresh_character_stats(char.id)
 
     # 灵根改变可能影响现有功法契合度
     # 这里可以添加功法兼容性检查逻辑
@@ -4655,6 +6264,39 @@ def change_linggen(current_user):
 
 
 # 组队系统API
+# 招募中队伍的内存索引（按活动类型和等级段），供组队大厅查找
+team_registry = TeamRegistry(max_level=MAX_LEVEL, ttl=app.config['TEAM_REGISTRY_TTL'])
+
+def recruiting_team_entries():
+    """从数据库读取所有招募中的队伍"""
+    rows = db.session.query(
+        Team.id, Team.activity_type, Team.min_level, Team.max_level, Team.member_count, Team.max_members
+    ).filter(Team.status == 'recruiting')
+    return [TeamEntry(*row) for row in rows]
+
+def sync_team_registry(team):
+    """队伍提交后同步内存索引"""
+    if team.status != 'recruiting':
+        team_registry.discard(team.id)
+        return
+    team_registry.put(TeamEntry(
+        team.id, team.activity_type, team.min_level, team.max_level, team.member_count or 0, team.max_members
+    ))
+
+def team_data(team):
+    return {
+        'id': team.id,
+        'name': team.name,
+        'leader_id': team.leader_id,
+        'activity_type': team.activity_type,
+        'max_members': team.max_members,
+        'min_level': team.min_level,
+        'max_level': team.max_level,
+        'member_count': team.member_count or 0,
+        'status': team.status,
+        'created_at': team.created_at.isoformat() if team.created_at else None
+    }
+
 @app.route('/team/create', methods=['POST'])
 @token_required
 def create_team(current_user):
@@ -4662,14 +6304,19 @@ def create_team(current_user):
     data = request.get_json()
     team_name = data.get('name')
     activity_type = data.get('activity_type', 'dungeon')
-    max_members = data.get('max_members', 5)
-    min_level = data.get('min_level', 1)
-    max_level = data.get('max_level', 100)
+    try:
+        max_members = int(data.get('max_members', 5))
+        min_level = int(data.get('min_level', 1))
+        max_level = int(data.get('max_level', 100))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid team settings'}), 400
 
     if not team_name:
         return jsonify({'message': 'Team name is required'}), 400
+    if max_members < 1 or min_level > max_level:
+        return jsonify({'message': 'Invalid team settings'}), 400
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4678,26 +6325,22 @@ def create_team(current_user):
     if existing_member:
         return jsonify({'message': 'You are already in a team'}), 400
 
-    # 创建队伍
+    # 创建队伍，创建者作为队长加入
     team = Team(
         name=team_name,
         leader_id=char.id,
         activity_type=activity_type,
         max_members=max_members,
         min_level=min_level,
-        max_level=max_level
+        max_level=max_level,
+        member_count=1,
+        status='recruiting' if max_members > 1 else 'full'
     )
     db.session.add(team)
+    db.session.flush()
+    db.session.add(TeamMember(team_id=team.id, character_id=char.id, role='leader'))
     db.session.commit()
-
-    # 将创建者加入队伍
-    team_member = TeamMember(
-        team_id=team.id,
-        character_id=char.id,
-        role='leader'
-    )
-    db.session.add(team_member)
-    db.session.commit()
+    sync_team_registry(team)
 
     return jsonify({
         'message': f'Team "{team_name}" created successfully',
@@ -4712,12 +6355,54 @@ def create_team(current_user):
     }), 201
 
 
+@app.route('/team/find', methods=['GET'])
+@token_required
+def find_teams(current_user):
+    """组队大厅：查找适合当前等级（或 level 参数）的招募中队伍，按 id 游标分页"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    activity_type = request.args.get('activity_type', 'dungeon')
+    _, per_page = parse_pagination(request.args)
+    try:
+        level = int(request.args.get('level', char.level))
+        after_id = int(request.args.get('cursor', 0))
+    except ValueError:
+        return jsonify({'message': 'Invalid level or cursor'}), 400
+
+    team_registry.refresh(recruiting_team_entries)
+    candidates = team_registry.find(activity_type, level, per_page, after_id=after_id)
+
+    # 候选队伍及队长名一次查询取出，并按库中状态复核（其他进程的改动可能尚未同步到索引）
+    rows = db.session.query(Team, Character.name)\
+        .outerjoin(Character, Character.id == Team.leader_id)\
+        .filter(Team.id.in_([entry.id for entry in candidates]))\
+        .all() if candidates else []
+    found = {team.id: (team, leader_name) for team, leader_name in rows}
+    teams_data = []
+    for entry in candidates:
+        team, leader_name = found.get(entry.id, (None, None))
+        if team is None or team.status != 'recruiting' or (team.member_count or 0) >= team.max_members:
+            team_registry.discard(entry.id)
+            continue
+        if team.activity_type != activity_type or not team.min_level <= level <= team.max_level:
+            continue
+        teams_data.append(dict(team_data(team), leader_name=leader_name))
+
+    return jsonify({
+        'teams': teams_data,
+        'next_cursor': str(candidates[-1].id) if len(candidates) == per_page else None
+    }), 200
+
+
 @app.route('/team/join/<int:team_id>', methods=['POST'])
 @token_required
+@character_required
 def join_team(current_user, team_id):
     """加入队伍"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
-    team = Team.query.get(team_id)
+    char = g.character
+    team = db.session.get(Team, team_id)
 
     if not char or not team:
         return jsonify({'message': 'Character or team not found'}), 404
@@ -4731,28 +6416,30 @@ def join_team(current_user, team_id):
     if team.status != 'recruiting':
         return jsonify({'message': 'Team is not recruiting'}), 400
 
-    current_members = TeamMember.query.filter_by(team_id=team_id).count()
-    if current_members >= team.max_members:
+    if (team.member_count or 0) >= team.max_members:
         return jsonify({'message': 'Team is full'}), 400
 
     # 检查等级要求
     if char.level < team.min_level or char.level > team.max_level:
         return jsonify({'message': f'Level requirement not met ({team.min_level}-{team.max_level})'}), 400
 
-    # 加入队伍
-    team_member = TeamMember(
-        team_id=team_id,
-        character_id=char.id,
-        role='member'
-    )
-    db.session.add(team_member)
-    db.session.commit()
+    # 原子地占一个名额，满员时同时改为 full（status 写在前面，MySQL 按顺序求值 SET 时读到的仍是旧人数）
+    claimed = db.session.execute(
+        db.update(Team)
+        .where(Team.id == team_id, Team.status == 'recruiting', Team.member_count < Team.max_members)
+        .ordered_values(
+            (Team.status, db.case((Team.member_count + 1 >= Team.max_members, 'full'), else_=Team.status)),
+            (Team.member_count, Team.member_count + 1)
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        db.session.rollback()
+        return jsonify({'message': 'Team is full'}), 400
 
-    # 检查队伍是否已满
-    new_member_count = TeamMember.query.filter_by(team_id=team_id).count()
-    if new_member_count >= team.max_members:
-        team.status = 'full'
-        db.session.commit()
+    db.session.add(TeamMember(team_id=team_id, character_id=char.id, role='member'))
+    db.session.commit()
+    sync_team_registry(team)
 
     return jsonify({
         'message': f'Successfully joined team "{team.name}"',
@@ -4764,17 +6451,20 @@ def join_team(current_user, team_id):
 @app.route('/team/<int:team_id>', methods=['GET'])
 @token_required
 def get_team_info(current_user, team_id):
-    """获取队伍信息"""
-    team = Team.query.get(team_id)
-    if not team:
+    """获取队伍信息（队伍、成员及人物信息一次连接查询）"""
+    rows = db.session.query(Team, TeamMember, Character)\
+        .outerjoin(TeamMember, TeamMember.team_id == Team.id)\
+        .outerjoin(Character, Character.id == TeamMember.character_id)\
+        .filter(Team.id == team_id)\
+        .order_by(TeamMember.id)\
+        .all()
+    if not rows:
         return jsonify({'message': 'Team not found'}), 404
 
-    # 获取队伍成员
-    members = TeamMember.query.filter_by(team_id=team_id).all()
+    team = rows[0][0]
     members_data = []
-    for member in members:
-        char = Character.query.get(member.character_id)
-        if char:
+    for _, member, char in rows:
+        if member and char:
             members_data.append({
                 'id': member.id,
                 'character_id': member.character_id,
@@ -4786,17 +6476,7 @@ def get_team_info(current_user, team_id):
             })
 
     return jsonify({
-        'team': {
-            'id': team.id,
-            'name': team.name,
-            'leader_id': team.leader_id,
-            'activity_type': team.activity_type,
-            'max_members': team.max_members,
-            'min_level': team.min_level,
-            'max_level': team.max_level,
-            'status': team.status,
-            'created_at': team.created_at.isoformat()
-        },
+        'team': team_data(team),
         'members': members_data,
         'member_count': len(members_data)
     }), 200
@@ -4806,7 +6486,7 @@ def get_team_info(current_user, team_id):
 @token_required
 def leave_team(current_user):
     """离开队伍"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4814,34 +6494,415 @@ def leave_team(current_user):
     if not team_member:
         return jsonify({'message': 'You are not in any team'}), 400
 
-    team = Team.query.get(team_member.team_id)
+    team_id = team_member.team_id
+    team = db.session.get(Team, team_id)
     is_leader = team_member.role == 'leader'
 
     # 删除成员记录
     db.session.delete(team_member)
+    db.session.flush()
 
-    if is_leader:
-        # 如果是队长离开，解散队伍或转让队长
-        remaining_members = TeamMember.query.filter_by(team_id=team.id).all()
-        if remaining_members:
-            # 转让给第一个成员
-            remaining_members[0].role = 'leader'
-            team.leader_id = remaining_members[0].character_id
-        else:
-            # 队伍解散
-            db.session.delete(team)
+    remaining = TeamMember.query.filter_by(team_id=team_id).order_by(TeamMember.id).first()
+    if remaining is None:
+        # 队伍解散
+        db.session.delete(team)
+        db.session.commit()
+        team_registry.discard(team_id)
+        return jsonify({'message': 'Successfully left the team'}), 200
 
+    if is_leader:
+        # 队长离开时转让给最早加入的成员
+        remaining.role = 'leader'
+        team.leader_id = remaining.character_id
+
+    # 空出名额，满员队伍恢复招募
+    db.session.execute(
+        db.update(Team).where(Team.id == team_id)
+        .values(
+            member_count=Team.member_count - 1,
+            status=db.case((Team.status == 'full', 'recruiting'), else_=Team.status)
+        )
+        .execution_options(synchronize_session=False)
+    )
     db.session.commit()
+    sync_team_registry(team)
 
     return jsonify({'message': 'Successfully left the team'}), 200
 
 
+# 竞技场API
+# 排位赛统一按晴天结算，使用晴天战斗属性快照
+ARENA_WEATHER = '晴天'
+# 排位对决最大回合数，用尽时按剩余生命比例判定胜负
+ARENA_MAX_TURNS = 100
+# 天梯积分变化系数
+ARENA_ELO_K = 32
+ARENA_INITIAL_RATING = 1000
+
+# 排位匹配的积分范围规则；排队数据在 ArenaQueueEntry 表中，多个 Web 进程共享
+arena_matchmaker = ArenaMatchmaker(
+    app.config['ARENA_WINDOW_BASE'], app.config['ARENA_WINDOW_GROWTH'], app.config['ARENA_WINDOW_MAX']
+)
+
+def simulate_duel(stats_a, stats_b, weather=ARENA_WEATHER, max_turns=ARENA_MAX_TURNS):
+    """在内存中模拟一场对决（速度高者先手，双方各出手一次为一回合），返回 (胜者下标 0/1, 回合数)"""
+    stats = (stats_a, stats_b)
+    max_hp = (max(1, stats_a['total_hp']), max(1, stats_b['total_hp']))
+    hp = list(max_hp)
+    order = (0, 1) if stats_a['total_speed'] >= stats_b['total_speed'] else (1, 0)
+    for turn in range(1, max_turns + 1):
+        for attacker in order:
+            defender = 1 - attacker
+            hp[defender] -= calculate_damage(stats[attacker], stats[defender], weather)
+            if hp[defender] <= 0:
+                return attacker, turn
+    return (0 if hp[0] / max_hp[0] >= hp[1] / max_hp[1] else 1), max_turns
+
+def arena_record(character_id):
+    """人物的竞技场记录，不存在时创建（不提交）；并发首次创建撞上唯一索引时改用已有记录"""
+    arena = Arena.query.filter_by(character_id=character_id).first()
+    if arena is None:
+        try:
+            with db.session.begin_nested():
+                arena = Arena(character_id=character_id, rating=ARENA_INITIAL_RATING, season_high=ARENA_INITIAL_RATING,
+                              wins=0, losses=0, streak=0)
+                db.session.add(arena)
+        except IntegrityError:
+            arena = Arena.query.filter_by(character_id=character_id).one()
+    return arena
+
+def arena_data(arena):
+    return {
+        'rating': arena.rating,
+        'wins': arena.wins,
+        'losses': arena.losses,
+        'streak': arena.streak,
+        'season_high': arena.season_high,
+        'last_match': arena.last_match.isoformat() if arena.last_match else None
+    }
+
+def pvp_result_data(match, character_id):
+    """从某一方的视角描述一场对决（match 为 PVPMatch 或 resolve_arena_matches 的结果）"""
+    get = match.get if isinstance(match, dict) else lambda field: getattr(match, field)
+    won = get('winner_id') == character_id
+    return {
+        'result': 'victory' if won else 'defeat',
+        'opponent_id': get('loser_id') if won else get('winner_id'),
+        'rating_change': get('winner_rating_change') if won else get('loser_rating_change'),
+        'match_type': get('match_type')
+    }
+
+def resolve_arena_matches(pairs, match_type='ranked'):
+    """结算一批排位对决（由调用方提交）
+
+    属性快照、竞技场记录各一次查询，对决全部在内存中模拟，对战记录一次批量插入。
+    缺少属性或竞技场记录的配对被跳过。
+    """
+    character_ids = list({character_id for pair in pairs for character_id in pair})
+    if not character_ids:
+        return []
+    stats = combat_stats_for(character_ids, ARENA_WEATHER)
+    # 锁定双方的竞技场记录（按 id 顺序加锁避免死锁），并发的排位赛/离线挑战依次结算，不会丢失积分更新
+    locked = Arena.query.filter(Arena.character_id.in_(character_ids))\
+        .order_by(Arena.id).with_for_update().populate_existing()
+    arenas = {arena.character_id: arena for arena in locked}
+
+    now = datetime.datetime.utcnow()
+    results = []
+    for a, b in pairs:
+        if a not in stats or b not in stats or a not in arenas or b not in arenas:
+            continue
+        winner_index, turns = simulate_duel(stats[a], stats[b])
+        winner_id, loser_id = (a, b) if winner_index == 0 else (b, a)
+        winner, loser = arenas[winner_id], arenas[loser_id]
+        winner_rating = winner.rating if winner.rating is not None else ARENA_INITIAL_RATING
+        loser_rating = loser.rating if loser.rating is not None else ARENA_INITIAL_RATING
+        change = elo_rating_change(winner_rating, loser_rating, ARENA_ELO_K)
+
+        winner.rating = winner_rating + change
+        winner.wins = (winner.wins or 0) + 1
+        winner.streak = (winner.streak or 0) + 1
+        winner.season_high = max(winner.season_high or 0, winner.rating)
+        winner.last_match = now
+        loser.rating = max(0, loser_rating - change)
+        loser.losses = (loser.losses or 0) + 1
+        loser.streak = 0
+        loser.last_match = now
+        results.append({
+            'winner_id': winner_id,
+            'loser_id': loser_id,
+            'winner_rating_change': change,
+            'loser_rating_change': loser.rating - loser_rating,
+            'match_type': match_type,
+            'match_time': now,
+            'turns': turns
+        })
+    if results:
+        db.session.execute(db.insert(PVPMatch), [
+            {field: result[field] for field in ('winner_id', 'loser_id', 'winner_rating_change',
+                                                'loser_rating_change', 'match_type', 'match_time')}
+            for result in results
+        ])
+    return results
+
+def queue_entry(row, now):
+    return QueueEntry(row.character_id, row.rating, (now - row.enqueued_at).total_seconds())
+
+def dequeue_pair(character_id, opponent_id):
+    """把一对人物移出队列（不提交）；其中一方已被其他请求或进程配走时不做改动并返回 False"""
+    savepoint = db.session.begin_nested()
+    removed = db.session.execute(
+        db.delete(ArenaQueueEntry).where(ArenaQueueEntry.character_id.in_([character_id, opponent_id]))
+        .execution_options(synchronize_session='evaluate')
+    ).rowcount
+    if removed != 2:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+def arena_queue_match(character_id):
+    """为排队中的人物按已等待时间放宽积分范围寻找对手（不提交）
+
+    只读取积分相邻的上下两名排队者（走 (rating, character_id) 索引）；配对成功时双方出队并返回对手 id。
+    """
+    row = db.session.get(ArenaQueueEntry, character_id)
+    if row is None:
+        return None
+    now = datetime.datetime.utcnow()
+    others = ArenaQueueEntry.query.filter(ArenaQueueEntry.character_id != character_id)
+    above = others.filter(ArenaQueueEntry.rating >= row.rating)\
+        .order_by(ArenaQueueEntry.rating, ArenaQueueEntry.character_id).first()
+    below = others.filter(ArenaQueueEntry.rating <= row.rating)\
+        .order_by(ArenaQueueEntry.rating.desc(), ArenaQueueEntry.character_id.desc()).first()
+    opponent = arena_matchmaker.pick(
+        queue_entry(row, now), [queue_entry(other, now) for other in (above, below) if other is not None]
+    )
+    if opponent is None or not dequeue_pair(character_id, opponent.character_id):
+        return None
+    return opponent.character_id
+
+def run_arena_matchmaking():
+    """定时任务：把放宽积分范围后可以配对的排队人物一次撮合并结算
+
+    队列在数据库中，由 worker 进程（或任一开启调度器的进程）持租约执行；
+    排队人物查询状态（GET /arena/queue）时也会按放宽后的范围重试匹配。
+    """
+    now = datetime.datetime.utcnow()
+    rows = ArenaQueueEntry.query.order_by(ArenaQueueEntry.rating, ArenaQueueEntry.character_id)\
+        .with_for_update().all()
+    pairs = arena_matchmaker.pair([queue_entry(row, now) for row in rows])
+    if not pairs:
+        db.session.rollback()
+        return 0
+    paired_ids = [character_id for pair in pairs for character_id in pair]
+    removed = db.session.execute(
+        db.delete(ArenaQueueEntry).where(ArenaQueueEntry.character_id.in_(paired_ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if removed != len(paired_ids):
+        # 期间有人被请求内的匹配配走或退出了队列，下个周期重新撮合
+        db.session.rollback()
+        return 0
+    resolve_arena_matches(pairs)
+    db.session.commit()
+    return len(pairs)
+
+scheduler.register('arena_matchmaking', app.config['ARENA_MATCH_INTERVAL'],
+                   leased_job('arena_matchmaking', app.config['ARENA_MATCH_INTERVAL'], run_arena_matchmaking))
+
+def arena_match_response(character_id, opponent_id):
+    """结算刚配对的一场对决并返回当前人物视角的结果"""
+    results = resolve_arena_matches([(character_id, opponent_id)])
+    db.session.commit()
+    if not results:
+        return jsonify({'message': 'Match could not be resolved'}), 400
+    arena = arena_record(character_id)
+    return jsonify(dict(
+        pvp_result_data(results[0], character_id),
+        turns=results[0]['turns'],
+        queued=False,
+        arena=arena_data(arena)
+    )), 200
+
+
+@app.route('/arena/queue', methods=['POST'])
+@token_required
+def join_arena_queue(current_user):
+    """加入排位匹配：积分相近的对手在队列中时立即结算，否则排队等待"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+    if db.session.get(ArenaQueueEntry, char.id):
+        return jsonify({'message': 'Already in queue'}), 400
+
+    arena = arena_record(char.id)
+    rating = arena.rating
+    try:
+        with db.session.begin_nested():
+            db.session.add(ArenaQueueEntry(character_id=char.id, rating=rating, enqueued_at=datetime.datetime.utcnow()))
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': 'Already in queue'}), 400
+    opponent_id = arena_queue_match(char.id)
+    if opponent_id is None:
+        db.session.commit()
+        return jsonify({
+            'message': 'Waiting for an opponent',
+            'queued': True,
+            'rating': rating,
+            'window': arena_matchmaker.window(0)
+        }), 202
+    return arena_match_response(char.id, opponent_id)
+
+
+@app.route('/arena/queue', methods=['GET'])
+@token_required
+def get_arena_queue_status(current_user):
+    """查询排位状态：排队中时按已等待时间放宽积分范围重试匹配，否则返回竞技场记录和最近一场对决"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+
+    queued = db.session.get(ArenaQueueEntry, char.id)
+    if queued:
+        opponent_id = arena_queue_match(char.id)
+        if opponent_id is not None:
+            return arena_match_response(char.id, opponent_id)
+        waited = (datetime.datetime.utcnow() - queued.enqueued_at).total_seconds()
+        return jsonify({'queued': True, 'waited': round(waited, 1), 'window': arena_matchmaker.window(waited)}), 200
+
+    arena = Arena.query.filter_by(character_id=char.id).first()
+    last_match = PVPMatch.query\
+        .filter(db.or_(PVPMatch.winner_id == char.id, PVPMatch.loser_id == char.id))\
+        .order_by(PVPMatch.id.desc()).first()
+    return jsonify({
+        'queued': False,
+        'arena': arena_data(arena) if arena else None,
+        'last_match': pvp_result_data(last_match, char.id) if last_match else None
+    }), 200
+
+
+# 防守战报邮件中逐条列出的挑战记录数上限
+ARENA_DEFENSE_MAIL_DETAIL_MAX = 20
+
+def send_arena_defense_mails():
+    """把尚未通知的防守记录按防守方各汇总成一封系统邮件（不提交），返回邮件数
+
+    先用一条 UPDATE 给待通知记录打上批次号，并发执行时每条记录只会被通知一次；发送后删除这些记录。
+    """
+    batch = uuid.uuid4().hex
+    claimed = db.session.execute(
+        db.update(ArenaDefenseLog).where(ArenaDefenseLog.mail_batch.is_(None))
+        .values(mail_batch=batch).execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        return 0
+
+    logs = ArenaDefenseLog.query.filter_by(mail_batch=batch).order_by(ArenaDefenseLog.id).all()
+    challenger_names = dict(
+        db.session.query(Character.id, Character.name)
+        .filter(Character.id.in_({log.challenger_id for log in logs}))
+    )
+    by_defender = {}
+    for log in logs:
+        by_defender.setdefault(log.defender_id, []).append(log)
+
+    mails = []
+    for defender_id, defender_logs in by_defender.items():
+        wins = sum(1 for log in defender_logs if log.defender_won)
+        net = sum(log.rating_change or 0 for log in defender_logs)
+        lines = [f"离线期间共被挑战{len(defender_logs)}次，守擂成功{wins}次，失败{len(defender_logs) - wins}次，积分变化{net:+d}。"]
+        for log in defender_logs[-ARENA_DEFENSE_MAIL_DETAIL_MAX:]:
+            outcome = '守擂成功' if log.defender_won else '守擂失败'
+            lines.append(f"{challenger_names.get(log.challenger_id, '无名修士')}向你发起挑战，{outcome}，积分{log.rating_change or 0:+d}")
+        if len(defender_logs) > ARENA_DEFENSE_MAIL_DETAIL_MAX:
+            lines.append(f"（仅列出最近{ARENA_DEFENSE_MAIL_DETAIL_MAX}场）")
+        mails.append({
+            'receiver_id': defender_id,
+            'title': '竞技场防守战报',
+            'content': '\n'.join(lines),
+            'read_status': False,
+            'is_system': True
+        })
+    db.session.execute(db.insert(Mail), mails)
+    # 战报已写入邮件，已通知的记录不再保留
+    db.session.execute(
+        db.delete(ArenaDefenseLog).where(ArenaDefenseLog.mail_batch == batch)
+        .execution_options(synchronize_session=False)
+    )
+    return len(mails)
+
+def run_arena_defense_mail():
+    """定时任务：发送防守战报邮件"""
+    sent = send_arena_defense_mails()
+    db.session.commit()
+    return sent
+
+scheduler.register('arena_defense_mail', app.config['ARENA_DEFENSE_MAIL_INTERVAL'],
+                   leased_job('arena_defense_mail', app.config['ARENA_DEFENSE_MAIL_INTERVAL'], run_arena_defense_mail))
+
+
+@app.route('/arena/challenge/<int:defender_id>', methods=['POST'])
+@token_required
+def challenge_arena(current_user, defender_id):
+    """离线挑战：与防守方的晴天战斗属性快照对决，防守方无需在线，战报稍后汇总邮件通知"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+    if defender_id == char.id:
+        return jsonify({'message': 'Cannot challenge yourself'}), 400
+    if db.session.get(ArenaQueueEntry, char.id):
+        return jsonify({'message': 'Leave the ranked queue first'}), 400
+    if not db.session.get(Character, defender_id):
+        return jsonify({'message': 'Defender not found'}), 404
+
+    arena_record(char.id)
+    arena_record(defender_id)
+    results = resolve_arena_matches([(char.id, defender_id)], match_type='challenge')
+    if not results:
+        db.session.rollback()
+        return jsonify({'message': 'Match could not be resolved'}), 400
+    result = results[0]
+    defender_won = result['winner_id'] == defender_id
+    db.session.add(ArenaDefenseLog(
+        defender_id=defender_id,
+        challenger_id=char.id,
+        defender_won=defender_won,
+        rating_change=result['winner_rating_change'] if defender_won else result['loser_rating_change']
+    ))
+    db.session.commit()
+
+    return jsonify(dict(
+        pvp_result_data(result, char.id),
+        turns=result['turns'],
+        arena=arena_data(arena_record(char.id))
+    )), 200
+
+
+@app.route('/arena/queue/leave', methods=['POST'])
+@token_required
+def leave_arena_queue(current_user):
+    """退出排位匹配"""
+    char = g.character
+    if not char:
+        return jsonify({'message': 'Character not found'}), 404
+    removed = db.session.execute(
+        db.delete(ArenaQueueEntry).where(ArenaQueueEntry.character_id == char.id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not removed:
+        return jsonify({'message': 'Not in queue'}), 400
+    db.session.commit()
+    return jsonify({'message': 'Left the queue'}), 200
+
+
 # 保底机制API
 @app.route('/guaranteed_drop/<drop_type>', methods=['GET'])
 @token_required
 def get_guaranteed_drop_status(current_user, drop_type):
     """获取保底状态"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -4855,120 +6916,118 @@ def get_guaranteed_drop_status(current_user, drop_type):
             'drop_type': drop_type,
             'attempts': 0,
             'guaranteed': False,
-            'guaranteed_threshold': 100  # 100次后必定掉落
+            'guaranteed_threshold': GUARANTEED_DROP_THRESHOLD  # 100次后必定掉落
         }), 200
 
     return jsonify({
         'drop_type': drop_type,
         'attempts': guaranteed_drop.attempts,
         'guaranteed': guaranteed_drop.guaranteed,
-        'guaranteed_threshold': 100,
+        'guaranteed_threshold': GUARANTEED_DROP_THRESHOLD,
         'last_attempt': guaranteed_drop.last_attempt.isoformat()
     }), 200
 
 
+# 保底抽取单次请求允许的次数（单抽、十连、百连）
+GUARANTEED_DROP_COUNTS = (1, 10, 100)
+# 保底掉落的装备类型与品质、法宝品质
+GUARANTEED_EQUIPMENT_TYPES = ('武器', '头盔', '衣服', '项链', '戒指')
+GUARANTEED_EQUIPMENT_QUALITIES = ('玄阶', '地阶', '天阶')
+GUARANTEED_TREASURE_QUALITIES = ('普通', '优质', '稀有', '史诗')
+
+
+def guaranteed_drop_reward(character_id, drop_type):
+    """生成一次保底掉落的奖励：(待插入的行, 奖励信息)，未知类型时行为 None"""
+    if drop_type == 'equipment':
+        equip_type = random.choice(GUARANTEED_EQUIPMENT_TYPES)
+        quality = random.choice(GUARANTEED_EQUIPMENT_QUALITIES)
+        name = f"{quality}{equip_type}"
+        row = {
+            'character_id': character_id,
+            'slot': EQUIPMENT_TYPE_SLOTS[equip_type],
+            'type': equip_type,
+            'name': name,
+            'quality': quality,
+            'max_level': 20 if quality == '玄阶' else 30 if quality == '地阶' else 40,
+            'equipped': False
+        }
+        return row, {'type': 'equipment', 'name': name, 'quality': quality}
+    if drop_type == 'treasure':
+        quality = random.choice(GUARANTEED_TREASURE_QUALITIES)
+        name = f"{quality}法宝"
+        # 法宝没有装备状态字段，与锻造一致默认放在1号栏位
+        row = {'character_id': character_id, 'slot': 1, 'name': name, 'quality': quality}
+        return row, {'type': 'treasure', 'name': name, 'quality': quality}
+    return None, {'type': 'unknown', 'description': '未知奖励'}
+
+
 @app.route('/guaranteed_drop/<drop_type>/attempt', methods=['POST'])
 @token_required
 def attempt_guaranteed_drop(current_user, drop_type):
-    """尝试保底掉落"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    """保底抽取：count=1/10/100 次依次结算（掉率随次数递增，100次必定掉落），奖励批量写入，计数器只写一次"""
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
-    # 获取或创建保底计数器
-    guaranteed_drop = GuaranteedDrop.query.filter_by(
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(request.args.get('count', data.get('count', 1)))
+    except (TypeError, ValueError):
+        count = None
+    if count not in GUARANTEED_DROP_COUNTS:
+        return jsonify({'message': f'count must be one of {", ".join(map(str, GUARANTEED_DROP_COUNTS))}'}), 400
+
+    # 获取或创建保底计数器（加行锁，同一人物并发抽取时依次结算）
+    counter_query = GuaranteedDrop.query.filter_by(
         character_id=char.id,
         drop_type=drop_type
-    ).first()
+    ).with_for_update()
+    guaranteed_drop = counter_query.first()
 
     if not guaranteed_drop:
-        guaranteed_drop = GuaranteedDrop(
-            character_id=char.id,
-            drop_type=drop_type,
-            attempts=0,
-            guaranteed=False
-        )
-        db.session.add(guaranteed_drop)
+        try:
+            with db.session.begin_nested():
+                guaranteed_drop = GuaranteedDrop(
+                    character_id=char.id,
+                    drop_type=drop_type,
+                    attempts=0,
+                    guaranteed=False
+                )
+                db.session.add(guaranteed_drop)
+        except IntegrityError:
+            # 并发的首次抽取已创建计数器（唯一索引），改为锁定该行
+            guaranteed_drop = counter_query.populate_existing().one()
 
-    # 增加尝试次数
-    guaranteed_drop.attempts += 1
+    drops, attempts, guaranteed, drop_rate = simulate_guaranteed_drops(
+        guaranteed_drop.attempts or 0, bool(guaranteed_drop.guaranteed), batch_uniforms(count)
+    )
+    guaranteed_drop.attempts = attempts
+    guaranteed_drop.guaranteed = guaranteed
     guaranteed_drop.last_attempt = db.func.current_timestamp()
 
-    # 检查是否达到保底
-    guaranteed_threshold = 100
-    if guaranteed_drop.attempts >= guaranteed_threshold:
-        guaranteed_drop.guaranteed = True
-
-    # 计算掉落概率
-    base_drop_rate = 0.01  # 基础1%掉率
-    if guaranteed_drop.guaranteed:
-        drop_rate = 1.0  # 保底必定掉落
-    else:
-        # 随着尝试次数增加，掉落概率逐渐提高
-        drop_rate = min(0.5, base_drop_rate + (guaranteed_drop.attempts * 0.005))
-
-    # 模拟掉落
-    dropped = random.random() < drop_rate
-
-    if dropped:
-        # 重置保底计数器
-        guaranteed_drop.attempts = 0
-        guaranteed_drop.guaranteed = False
-
-        # 根据掉落类型发放奖励
-        if drop_type == 'equipment':
-            # 创建随机装备
-            equip_type = random.choice(['武器', '头盔', '衣服', '项链', '戒指'])
-            quality = random.choice(['玄阶', '地阶', '天阶'])
-            name = f"{quality}{equip_type}"
-
-            equipment = Equipment(
-                character_id=char.id,
-                type=equip_type,
-                name=name,
-                quality=quality,
-                max_level=20 if quality == '玄阶' else 30 if quality == '地阶' else 40,
-                equipped=False
-            )
-            db.session.add(equipment)
-
-            reward_info = {
-                'type': 'equipment',
-                'name': name,
-                'quality': quality
-            }
-
-        elif drop_type == 'treasure':
-            # 创建随机法宝
-            quality = random.choice(['普通', '优质', '稀有', '史诗'])
-            name = f"{quality}法宝"
-
-            treasure = Treasure(
-                character_id=char.id,
-                name=name,
-                quality=quality,
-                equipped=False
-            )
-            db.session.add(treasure)
-
-            reward_info = {
-                'type': 'treasure',
-                'name': name,
-                'quality': quality
-            }
-
-        else:
-            reward_info = {'type': 'unknown', 'description': '未知奖励'}
+    # 根据掉落类型发放奖励，同类奖励一次批量插入
+    rows = []
+    rewards = []
+    for index, _ in drops:
+        row, reward_info = guaranteed_drop_reward(char.id, drop_type)
+        if row is not None:
+            rows.append(row)
+        rewards.append(dict(reward_info, attempt=index + 1))
+    if rows:
+        db.session.execute(db.insert(Equipment if drop_type == 'equipment' else Treasure), rows)
 
     db.session.commit()
 
     return jsonify({
         'drop_type': drop_type,
+        'count': count,
         'attempts': guaranteed_drop.attempts,
         'drop_rate': drop_rate,
-        'dropped': dropped,
-        'reward': reward_info if dropped else None,
-        'guaranteed': guaranteed_drop.guaranteed
+        'dropped': bool(drops),
+        'reward': rewards[0] if rewards else None,
+        'rewards': rewards,
+        'guaranteed': guaranteed_drop.guaranteed,
+        'guaranteed_threshold': GUARANTEED_DROP_THRESHOLD
     }), 200
 
 
@@ -5034,7 +7093,7 @@ def create_world_event(current_user):
 @token_required
 def get_trial_quests(current_user):
     """获取历练任务"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -5060,7 +7119,7 @@ def get_trial_quests(current_user):
 @token_required
 def accept_trial_quest(current_user, quest_id):
     """接受历练任务"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -5085,7 +7144,7 @@ def accept_trial_quest(current_user, quest_id):
 @token_required
 def complete_trial_quest(current_user, quest_id):
     """完成历练任务"""
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -5108,12 +7167,13 @@ def complete_trial_quest(current_user, quest_id):
     # 每1000点历练值提升1点全属性
     attribute_bonus = trial_quest.trial_points // 1000
     if attribute_bonus > 0:
-        attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+        attr = g.attributes
         if attr:
             attr.hp += attribute_bonus * 10
             attr.attack += attribute_bonus
             attr.defense += attribute_bonus
             attr.speed += attribute_bonus
+            refresh_character_stats(char.id)
 
     db.session.commit()
 
@@ -5137,7 +7197,7 @@ def enhanced_realm_breakthrough(current_user):
     """增强版境界突破API（包含纯度、丹药品质、功法契合）"""
     data = request.get_json()
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -5146,11 +7206,11 @@ def enhanced_realm_breakthrough(current_user):
         return jsonify({'message': '等级不足，无法突破境界'}), 400
 
     # 获取当前境界和下一个境界
-    current_realm = Realm.query.filter_by(name=char.realm).first()
+    current_realm = catalog.realm(char.realm)
     if not current_realm:
         return jsonify({'message': '境界数据错误'}), 500
 
-    next_realm = Realm.query.filter(Realm.stage > current_realm.stage).order_by(Realm.stage).first()
+    next_realm = catalog.next_realm(current_realm.name)
     if not next_realm:
         return jsonify({'message': '已达到最高境界'}), 400
 
@@ -5175,10 +7235,11 @@ def enhanced_realm_breakthrough(current_user):
     realm_success_bonus = current_realm.stage * 0.05  # 境界越高越难突破
     final_success_rate = min(0.95, (purity * pill_multiplier * mantra_compat * (1 - realm_success_bonus)))
 
-    # 消耗资源
+    # 消耗资源：需持有全额灵石，成功扣全额，失败只扣一半
     breakthrough_cost = int(1000 * (current_realm.stage + 1) * (2 - purity))  # 纯度越高消耗越少
-    resource = Resource.query.filter_by(character_id=char.id, type='灵石').first()
-    if not resource or resource.amount < breakthrough_cost:
+    failure_cost = breakthrough_cost // 2
+    success = random.random() < final_success_rate
+    if not wallet_debit(char.id, breakthrough_cost if success else failure_cost, required=breakthrough_cost):
         return jsonify({'message': f'灵石不足，需要{breakthrough_cost}灵石', 'required': breakthrough_cost}), 400
 
     # 记录突破尝试
@@ -5193,20 +7254,17 @@ def enhanced_realm_breakthrough(current_user):
     )
     db.session.add(breakthrough_record)
 
-    success = random.random() < final_success_rate
-
     if success:
         # 突破成功
         char.realm = next_realm.name
         char.level = 1
         char.experience = 0
-        resource.amount -= breakthrough_cost
 
         # 更新记录为成功
         breakthrough_record.success = True
 
         # 境界突破属性提升
-        attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+        attr = g.attributes
         realm_bonus = int(next_realm.coefficient * 50 * purity * pill_multiplier)
         attr.hp += realm_bonus * 10
         attr.attack += realm_bonus * 2
@@ -5215,6 +7273,7 @@ def enhanced_realm_breakthrough(current_user):
 
         # 纯度影响悟性提升
         char.wuxing += int(purity * 10)
+        refresh_character_stats(char.id)
 
         db.session.commit()
 
@@ -5236,8 +7295,6 @@ def enhanced_realm_breakthrough(current_user):
         }), 200
     else:
         # 突破失败
-        failure_cost = breakthrough_cost // 2
-        resource.amount -= failure_cost
         db.session.commit()
 
         return jsonify({
@@ -5260,7 +7317,7 @@ def calculate_formulas(current_user):
     formula_type = data.get('type')
     parameters = data.get('parameters', {})
 
-    char = Character.query.filter_by(user_id=current_user.id).first()
+    char = g.character
     if not char:
         return jsonify({'message': 'Character not found'}), 404
 
@@ -5268,7 +7325,7 @@ def calculate_formulas(current_user):
 
     if formula_type == 'combat_power':
         # 战力计算公式：战斗力 = (基础攻击力 + 功法攻击力 + 法宝攻击力) * 攻击权重 + (基础防御力 + 功法防御力 + 法宝防御力) * 防御权重 + 生命值 * 生命权重
-        attr = CharacterAttribute.query.filter_by(character_id=char.id).first()
+        attr = g.attributes
         if attr:
             # 计算装备、法宝、功法加成
             equip_attack = sum(e.attack_bonus for e in char.equipments if e.equipped) if char.equipments else 0
@@ -5392,5 +7449,10 @@ def serve_app_js():
     return jsonify({'message': 'app.js not found'}), 404
 
 
+# 进程内定时任务；debug 重载器的父进程不启动，避免重复执行
+if app.config['SCHEDULER_ENABLED'] and not (__name__ == '__main__' and 'WERKZEUG_RUN_MAIN' not in os.environ):
+    scheduler.start()
+
+
 if __name__ == '__main__':
     app.run(debug=True)
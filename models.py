@@ -202,6 +202,10 @@ class Pet(db.Model):
 
 # 宗门模型
 class Sect(db.Model):
+    __table_args__ = (
+        db.Index('ix_sect_power', 'power'),
+        db.Index('ix_sect_prestige', 'prestige'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     level = db.Column(db.Integer, default=1)
@@ -211,6 +215,7 @@ class Sect(db.Model):
     power = db.Column(db.Integer, default=0)  # 实力值
     construction = db.Column(db.Integer, default=0)  # 建设度
     prestige = db.Column(db.Integer, default=0)  # 威望值
+    member_count = db.Column(db.Integer, default=0, server_default='0')  # 成员数（加入/退出/踢出时维护）
     description = db.Column(db.Text)  # 宗门简介
     resources = db.Column(db.Text)  # 宗门资源JSON
     facilities = db.Column(db.Text)  # 宗门设施JSON
@@ -222,6 +227,7 @@ class Sect(db.Model):
 
 # 宗门成员模型
 class SectMember(db.Model):
+    __table_args__ = (db.Index('ix_sect_member_sect_contribution', 'sect_id', 'contribution', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     sect_id = db.Column(db.Integer, db.ForeignKey('sect.id'), nullable=False)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
@@ -234,6 +240,7 @@ class SectMember(db.Model):
 
 # 宗门任务模型
 class SectTask(db.Model):
+    __table_args__ = (db.Index('ix_sect_task_sect', 'sect_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     sect_id = db.Column(db.Integer, db.ForeignKey('sect.id'), nullable=False)
     title = db.Column(db.String(100), nullable=False)
@@ -299,6 +306,18 @@ class SectAlliance(db.Model):
     # Relationship to leader sect
     leader_sect = db.relationship('Sect', foreign_keys=[leader_sect_id])
 
+# 宗门贡献流水模型（捐献先记流水，宗门计数由定时任务批量汇总）
+class SectContribution(db.Model):
+    __table_args__ = (db.Index('ix_sect_contribution_sect_batch', 'sect_id', 'fold_batch'),)
+    id = db.Column(db.Integer, primary_key=True)
+    sect_id = db.Column(db.Integer, db.ForeignKey('sect.id'), nullable=False)
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # 贡献值
+    prosperity = db.Column(db.Integer, default=0)  # 带来的繁荣度
+    power = db.Column(db.Integer, default=0)  # 带来的实力值
+    fold_batch = db.Column(db.String(32), nullable=True)  # 汇总批次，为空表示尚未计入宗门
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
 # 丹药模型
 class Pill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -418,6 +437,24 @@ class CombatState(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
+# 战斗属性快照模型（按人物和天气缓存 calculate_combat_stats 的结果）
+class CombatStats(db.Model):
+    __table_args__ = (db.UniqueConstraint('character_id', 'weather', name='uq_combat_stats_character_weather'),)
+    id = db.Column(db.Integer, primary_key=True)
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    weather = db.Column(db.String(20), nullable=False, default='晴天')
+    total_attack = db.Column(db.Integer, default=0)
+    total_defense = db.Column(db.Integer, default=0)
+    total_hp = db.Column(db.Integer, default=0)
+    total_speed = db.Column(db.Integer, default=0)
+    crit_rate = db.Column(db.Float, default=0)
+    dodge_rate = db.Column(db.Float, default=0)
+    hit_rate = db.Column(db.Float, default=0)
+    crit_damage = db.Column(db.Float, default=1.0)
+    penetration_rate = db.Column(db.Float, default=0)
+    linggen = db.Column(db.String(10), default='无')
+    computed_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
 # 生活技能模型
 class LifeSkill(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -467,6 +504,7 @@ class WorldMap(db.Model):
 
 # 资源模型
 class Resource(db.Model):
+    __table_args__ = (db.Index('uq_resource_character_type', 'character_id', 'type', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     type = db.Column(db.String(20))
@@ -494,6 +532,11 @@ class Achievement(db.Model):
 
 # 好友模型
 class Friendship(db.Model):
+    # 好友关系按有序对存储：character_id < friend_id，每对只有一行
+    __table_args__ = (
+        db.Index('uq_friendship_pair', 'character_id', 'friend_id', unique=True),
+        db.Index('ix_friendship_friend', 'friend_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     friend_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
@@ -502,16 +545,27 @@ class Friendship(db.Model):
 
 # 邮件模型
 class Mail(db.Model):
+    __table_args__ = (
+        db.Index('ix_mail_receiver_sent', 'receiver_id', 'sent_at', 'id'),
+        db.Index('ix_mail_receiver_read', 'receiver_id', 'read_status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    sender_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    # 系统邮件没有发件人，sender_id 为空
+    sender_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=True)
     receiver_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text)
     sent_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     read_status = db.Column(db.Boolean, default=False)
+    # 系统邮件（显示为 System）
+    is_system = db.Column(db.Boolean, default=False, server_default='0')
 
 # 排行榜模型
 class Ranking(db.Model):
+    __table_args__ = (
+        db.Index('ix_ranking_type_score', 'type', 'score'),
+        db.Index('uq_ranking_character_type', 'character_id', 'type', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     type = db.Column(db.String(20))
@@ -539,6 +593,10 @@ class Transaction(db.Model):
 
 # 竞技场模型
 class Arena(db.Model):
+    __table_args__ = (
+        db.Index('uq_arena_character', 'character_id', unique=True),
+        db.Index('ix_arena_rating', 'rating'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     rank = db.Column(db.Integer, default=0)
@@ -549,8 +607,19 @@ class Arena(db.Model):
     last_match = db.Column(db.DateTime)
     season_high = db.Column(db.Integer, default=1000)
 
+# 排位匹配队列（多个 Web 进程共享），按 (积分, 人物 id) 索引，匹配时只读取积分相邻的排队者
+class ArenaQueueEntry(db.Model):
+    __table_args__ = (db.Index('ix_arena_queue_entry_rating', 'rating', 'character_id'),)
+    character_id = db.Column(db.Integer, db.ForeignKey('character.id'), primary_key=True, autoincrement=False)
+    rating = db.Column(db.Integer, nullable=False)
+    enqueued_at = db.Column(db.DateTime, nullable=False)
+
 # PVP战斗记录模型
 class PVPMatch(db.Model):
+    __table_args__ = (
+        db.Index('ix_pvp_match_winner', 'winner_id'),
+        db.Index('ix_pvp_match_loser', 'loser_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     winner_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     loser_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
@@ -559,6 +628,17 @@ class PVPMatch(db.Model):
     match_type = db.Column(db.String(20), default='ranked')  # ranked, casual
     match_time = db.Column(db.DateTime, default=db.func.current_timestamp())
 
+# 离线竞技防守记录（挑战结果定期按防守方汇总成一封邮件）
+class ArenaDefenseLog(db.Model):
+    __table_args__ = (db.Index('ix_arena_defense_log_batch', 'mail_batch'),)
+    id = db.Column(db.Integer, primary_key=True)
+    defender_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    challenger_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    defender_won = db.Column(db.Boolean, default=False)
+    rating_change = db.Column(db.Integer, default=0)  # 防守方积分变化
+    mail_batch = db.Column(db.String(32), nullable=True)  # 战报邮件批次，为空表示尚未通知
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
 # 图鉴模型
 class Codex(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -618,9 +698,12 @@ class Inventory(db.Model):
 
 # 聊天消息模型
 class ChatMessage(db.Model):
+    __table_args__ = (db.Index('ix_chat_message_channel_id', 'channel', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
+    sender_name = db.Column(db.String(50))  # 发送时记录的人物名，读取时无需再查人物
     receiver_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=True)  # 私聊时使用
+    sect_id = db.Column(db.Integer, db.ForeignKey('sect.id'), nullable=True)  # 宗门频道时使用
     channel = db.Column(db.String(20), default='world')  # world, sect, private, system
     content = db.Column(db.Text, nullable=False)
     sent_at = db.Column(db.DateTime, default=db.func.current_timestamp())
@@ -628,6 +711,9 @@ class ChatMessage(db.Model):
 
 # 组队模型
 class Team(db.Model):
+    __table_args__ = (
+        db.Index('ix_team_status', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
     leader_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
@@ -636,11 +722,16 @@ class Team(db.Model):
     max_level = db.Column(db.Integer, default=100)
     activity_type = db.Column(db.String(20), default='dungeon')  # dungeon, exploration, pvp
     status = db.Column(db.String(20), default='recruiting')  # recruiting, full, active, disbanded
+    member_count = db.Column(db.Integer, default=0, server_default='0')  # 成员数（加入/离开时维护）
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     members = db.relationship('TeamMember', backref='team', lazy=True)
 
 # 组队成员模型
 class TeamMember(db.Model):
+    __table_args__ = (
+        db.Index('ix_team_member_team', 'team_id'),
+        db.Index('ix_team_member_character', 'character_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
@@ -673,6 +764,9 @@ class LinggenChange(db.Model):
 
 # 保底计数器模型
 class GuaranteedDrop(db.Model):
+    __table_args__ = (
+        db.Index('uq_guaranteed_drop_character_type', 'character_id', 'drop_type', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     character_id = db.Column(db.Integer, db.ForeignKey('character.id'), nullable=False)
     drop_type = db.Column(db.String(20), nullable=False)  # equipment, treasure, pet, etc.
@@ -691,3 +785,9 @@ class RealmBreakthroughRecord(db.Model):
     mantra_compat = db.Column(db.Float, default=1.0)  # 功法契合度
     success = db.Column(db.Boolean, nullable=False)
     attempted_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+# 定时任务租约：多个进程同时运行调度器时，每个周期只有持有租约的进程执行任务
+class JobLease(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,26 @@
+# 群发系统邮件
+# 用法: python scripts/broadcast_mail.py "标题" "内容" [最低等级]
+
+import os
+import sys
+# Ensure project root is on sys.path so local modules (app, models) are imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db, broadcast_system_mail
+
+
+def main(argv):
+    if len(argv) < 2:
+        print('用法: python scripts/broadcast_mail.py "标题" "内容" [最低等级]')
+        return 1
+    title, content = argv[0], argv[1]
+    min_level = int(argv[2]) if len(argv) > 2 else None
+    with app.app_context():
+        count = broadcast_system_mail(title, content, min_level=min_level)
+        db.session.commit()
+    print(f'系统邮件已发送给 {count} 名人物')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,23 @@
+# 升级数据库表结构（补齐新增的列和索引、合并旧数据），部署新版本后、启动 Web 进程前执行一次
+# 用法: python scripts/migrate.py
+
+import os
+import sys
+# Ensure project root is on sys.path so local modules (app, models) are imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, db, migrate_database
+
+
+def main(argv):
+    with app.app_context():
+        added_columns = migrate_database()
+        db.session.commit()
+    for table, column in sorted(added_columns):
+        print(f'新增列 {table}.{column}')
+    print('数据库迁移完成')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,38 @@
+# 定时任务进程（灵田推进等），与 Web 进程分开运行
+# 用法: python scripts/worker.py            持续运行所有定时任务
+#       python scripts/worker.py --once     每个任务立即执行一次后退出
+#       python scripts/worker.py --once farm_tick
+
+import os
+import sys
+# Ensure project root is on sys.path so local modules (app, models) are imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import scheduler
+
+
+def main(argv):
+    once = '--once' in argv
+    names = [a for a in argv if not a.startswith('--')] or list(scheduler.jobs)
+    unknown = [n for n in names if n not in scheduler.jobs]
+    if unknown:
+        print(f"未知任务: {', '.join(unknown)}，可用任务: {', '.join(scheduler.jobs)}")
+        return 1
+
+    if once:
+        for name in names:
+            print(f'{name}: {scheduler.run_job(name)}')
+        return 0
+
+    print(f"定时任务已启动: {', '.join(scheduler.jobs)}")
+    thread = scheduler.start()
+    try:
+        while thread.is_alive():
+            thread.join(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,35 @@
+import pytest
+
+from app import app, db, migrate_database
+from models import User, Character
+
+
+@pytest.fixture(scope='session', autouse=True)
+def migrated_database():
+    """Bring an existing database up to the current schema, as scripts/migrate.py does on deploy."""
+    with app.app_context():
+        migrate_database()
+        db.session.commit()
+
+
+@pytest.fixture
+def make_player():
+    """Register, log in and create a character; returns (headers, character_id).
+
+    `cleanup(char)` runs inside an app context before commit, for clearing rows left
+    over from earlier runs against the same database.
+    """
+    def make(client, username, name, linggen='金', cleanup=None):
+        client.post('/register', json={'username': username, 'password': 'pw', 'email': f'{username}@example.com'})
+        token = client.post('/login', json={'username': username, 'password': 'pw'}).get_json()['token']
+        headers = {'Authorization': token}
+        client.post('/character', headers=headers, json={'name': name, 'linggen': linggen})
+        with app.app_context():
+            user = User.query.filter_by(username=username).first()
+            char = Character.query.filter_by(user_id=user.id).first()
+            if cleanup:
+                cleanup(char)
+                db.session.commit()
+            char_id = char.id
+        return headers, char_id
+    return make
@@ -31,3 +31,52 @@ def test_register_login_create_character():
     assert resp.status_code == 200
     data = resp.get_json()
     assert data.get('name') == '英雄'
+
+
+def test_character_selection_by_header_and_token_claim():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'multi_char', 'password': 'pw', 'email': 'multi@example.com'})
+    token = client.post('/login', json={'username': 'multi_char', 'password': 'pw'}).get_json()['token']
+    headers = {'Authorization': token}
+
+    client.post('/character', headers=headers, json={'name': '甲', 'linggen': '金'})
+    client.post('/character', headers=headers, json={'name': '乙', 'linggen': '水'})
+
+    from models import User, Character
+    with app.app_context():
+        user = User.query.filter_by(username='multi_char').first()
+        chars = Character.query.filter_by(user_id=user.id).order_by(Character.id).all()
+        first_id, last_id = chars[0].id, chars[-1].id
+
+    # 未指定人物时 /character 返回最新人物
+    assert client.get('/character', headers=headers).get_json()['id'] == last_id
+
+    # 请求头指定人物
+    resp = client.get('/character', headers={**headers, 'X-Character-Id': str(first_id)})
+    assert resp.get_json()['id'] == first_id
+
+    # 令牌声明指定人物
+    token = client.post('/login', json={'username': 'multi_char', 'password': 'pw', 'character_id': first_id}).get_json()['token']
+    assert client.get('/character', headers={'Authorization': token}).get_json()['id'] == first_id
+
+    # 不属于该账号的人物
+    resp = client.get('/character', headers={**headers, 'X-Character-Id': '999999'})
+    assert resp.status_code == 404
+
+    # 无效令牌
+    assert client.get('/character', headers={'Authorization': 'bad'}).status_code == 401
+
+
+def test_routes_without_a_character_return_404():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'no_char', 'password': 'pw', 'email': 'no_char@example.com'})
+    token = client.post('/login', json={'username': 'no_char', 'password': 'pw'}).get_json()['token']
+    headers = {'Authorization': token}
+
+    for method, url in [('post', '/treasure/estimate'), ('post', '/treasure/awaken/1'),
+                        ('post', '/mantra/cultivate/1'), ('get', '/pet')]:
+        resp = getattr(client, method)(url, headers=headers, json={})
+        assert resp.status_code == 404
+        assert resp.get_json()['message'] == '角色不存在'
@@ -0,0 +1,148 @@
+import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, simulate_duel, run_arena_matchmaking, run_arena_defense_mail, arena_record, normalize_arenas
+from models import Arena, ArenaQueueEntry, PVPMatch, ArenaDefenseLog, CombatStats, Mail
+from utils.arena import ArenaMatchmaker, QueueEntry
+from utils.helpers import elo_rating_change
+
+
+def clear_arena(char):
+    # 清理上次运行遗留的竞技场记录
+    Arena.query.filter_by(character_id=char.id).delete()
+    ArenaQueueEntry.query.filter_by(character_id=char.id).delete()
+    PVPMatch.query.filter(db.or_(PVPMatch.winner_id == char.id, PVPMatch.loser_id == char.id)).delete(synchronize_session=False)
+
+
+def test_matchmaker_widens_window_and_pairs_neighbours():
+    matchmaker = ArenaMatchmaker(base_window=50, growth=10, max_window=400)
+    assert matchmaker.window(0) == 50 and matchmaker.window(20) == 250 and matchmaker.window(100) == 400
+
+    entry = QueueEntry(3, 1030, 0)
+    assert matchmaker.pick(entry, [QueueEntry(1, 1000, 0), QueueEntry(2, 1200, 0)]).character_id == 1
+    # 等待越久可接受的积分差越大
+    assert matchmaker.pick(QueueEntry(2, 1200, 5), [QueueEntry(4, 1000, 0)]) is None
+    assert matchmaker.pick(QueueEntry(2, 1200, 20), [QueueEntry(4, 1000, 0)]).character_id == 4
+
+    def entries(waited):
+        return [QueueEntry(c, r, waited) for c, r in ((5, 1000), (6, 1100), (7, 1500), (9, 1650), (8, 2000))]
+    assert matchmaker.pair(entries(0)) == []
+    assert matchmaker.pair(entries(6)) == [(5, 6)]
+    assert matchmaker.pair(entries(11)) == [(5, 6), (7, 9)]
+
+
+def test_elo_and_duel_simulation():
+    assert elo_rating_change(1000, 1000) == 16
+    assert elo_rating_change(1400, 1000) < 16 < elo_rating_change(1000, 1400)
+
+    strong = {'total_attack': 500, 'total_defense': 50, 'total_hp': 2000, 'total_speed': 20, 'crit_rate': 0,
+              'dodge_rate': 0, 'hit_rate': 1.0, 'crit_damage': 1.0, 'penetration_rate': 0, 'linggen': '无'}
+    weak = dict(strong, total_attack=60, total_hp=500, total_speed=30)
+    assert simulate_duel(strong, weak) == (0, 2)
+    assert simulate_duel(weak, strong)[0] == 1
+
+
+def test_ranked_queue_resolves_duel_and_records_match(make_player):
+    client = app.test_client()
+    first, first_id = make_player(client, 'arena_first_test', '擂主甲', linggen='火', cleanup=clear_arena)
+    second, second_id = make_player(client, 'arena_second_test', '擂主乙', linggen='火', cleanup=clear_arena)
+
+    resp = client.post('/arena/queue', headers=first)
+    assert resp.status_code == 202
+    assert client.post('/arena/queue', headers=first).status_code == 400
+    assert client.get('/arena/queue', headers=first).get_json()['queued'] is True
+
+    resp = client.post('/arena/queue', headers=second)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['opponent_id'] == first_id
+    assert data['rating_change'] == (16 if data['result'] == 'victory' else -16)
+    assert data['arena']['rating'] == 1000 + data['rating_change']
+
+    status = client.get('/arena/queue', headers=first).get_json()
+    assert status['queued'] is False
+    assert status['last_match']['opponent_id'] == second_id
+    assert status['last_match']['result'] != data['result']
+    with app.app_context():
+        ratings = [Arena.query.filter_by(character_id=c).one().rating for c in (first_id, second_id)]
+        assert sum(ratings) == 2000
+        assert PVPMatch.query.filter(PVPMatch.winner_id.in_([first_id, second_id])).count() >= 1
+
+    assert client.post('/arena/queue/leave', headers=first).status_code == 400
+    with app.app_context():
+        assert run_arena_matchmaking() == 0
+
+
+def test_matchmaking_job_pairs_players_queued_through_other_processes(make_player):
+    client = app.test_client()
+    _, first_id = make_player(client, 'arena_batch_first', '候战甲', linggen='火', cleanup=clear_arena)
+    _, second_id = make_player(client, 'arena_batch_second', '候战乙', linggen='火', cleanup=clear_arena)
+
+    # 队列在数据库中：两人由不同进程排队，积分差超出初始范围，等待一分钟后由定时任务撮合
+    long_ago = datetime.datetime.utcnow() - datetime.timedelta(seconds=60)
+    with app.app_context():
+        for character_id, rating in ((first_id, 1000), (second_id, 1300)):
+            db.session.add(Arena(character_id=character_id, rating=rating, season_high=rating, wins=0, losses=0, streak=0))
+            db.session.add(ArenaQueueEntry(character_id=character_id, rating=rating, enqueued_at=long_ago))
+        db.session.commit()
+        assert run_arena_matchmaking() == 1
+        assert ArenaQueueEntry.query.filter(ArenaQueueEntry.character_id.in_([first_id, second_id])).count() == 0
+        assert PVPMatch.query.filter(PVPMatch.winner_id.in_([first_id, second_id])).count() == 1
+
+
+def test_offline_challenge_uses_snapshot_and_batches_defense_mail(make_player):
+    client = app.test_client()
+    challenger, challenger_id = make_player(client, 'arena_challenger_test', '挑战者', linggen='火', cleanup=clear_arena)
+    defender, defender_id = make_player(client, 'arena_defender_test', '守擂者', linggen='火', cleanup=clear_arena)
+    # 防守方的晴天快照在装备变化时已生成
+    client.get('/equipment', headers=defender)
+    with app.app_context():
+        ArenaDefenseLog.query.filter_by(defender_id=defender_id).delete()
+        Mail.query.filter_by(receiver_id=defender_id, title='竞技场防守战报').delete()
+        db.session.commit()
+        assert CombatStats.query.filter_by(character_id=defender_id, weather='晴天').count() == 1
+
+    assert client.post(f'/arena/challenge/{challenger_id}', headers=challenger).status_code == 400
+    results = []
+    for _ in range(3):
+        resp = client.post(f'/arena/challenge/{defender_id}', headers=challenger)
+        assert resp.status_code == 200
+        results.append(resp.get_json()['result'])
+
+    with app.app_context():
+        logs = ArenaDefenseLog.query.filter_by(defender_id=defender_id).all()
+        assert [log.defender_won for log in logs] == [r == 'defeat' for r in results]
+        assert run_arena_defense_mail() >= 1
+        mails = Mail.query.filter_by(receiver_id=defender_id, title='竞技场防守战报').all()
+        assert len(mails) == 1 and mails[0].is_system and mails[0].sender_id is None
+        assert '共被挑战3次' in mails[0].content
+        assert mails[0].content.count('挑战者向你发起挑战') == 3
+        # 已通知的记录随即删除，不会重复发送，也不会无限增长
+        assert ArenaDefenseLog.query.filter_by(defender_id=defender_id).count() == 0
+        assert run_arena_defense_mail() == 0
+
+
+def test_arena_record_unique_per_character(make_player):
+    client = app.test_client()
+    _, char_id = make_player(client, 'arena_legacy', '旧擂主', linggen='火', cleanup=clear_arena)
+    with app.app_context():
+        # 模拟唯一索引之前并发首次排队产生的重复记录
+        index = next(i for i in Arena.__table__.indexes if i.name == 'uq_arena_character')
+        index.drop(db.engine)
+        db.session.add_all([Arena(character_id=char_id, rating=rating) for rating in (1100, 1000)])
+        db.session.commit()
+        keep_id = db.session.query(db.func.min(Arena.id)).filter_by(character_id=char_id).scalar()
+
+        normalize_arenas()
+        index.create(db.engine)
+        assert [(a.id, a.rating) for a in Arena.query.filter_by(character_id=char_id)] == [(keep_id, 1100)]
+
+        # 唯一索引存在后不能再插入第二条，arena_record 返回已有记录
+        db.session.add(Arena(character_id=char_id, rating=1000))
+        try:
+            db.session.commit()
+            assert False, 'duplicate arena row accepted'
+        except IntegrityError:
+            db.session.rollback()
+        assert arena_record(char_id).id == keep_id
@@ -0,0 +1,39 @@
+import app as app_module
+from app import app, reload_catalog
+
+
+def test_catalog_loaded_and_reloadable():
+    catalog = app_module.catalog
+    assert catalog.monster_list
+    assert catalog.monster(1).name == catalog.monster('1').name
+
+    # 境界按阶段排列，下一境界为下一个下标
+    first = catalog.realms[0]
+    assert catalog.next_realm(first.name) == catalog.realms[1]
+    assert catalog.next_realm(catalog.realms[-1].name) is None
+
+    # 副本波次已预先解析
+    dungeon = catalog.dungeon_list[0]
+    assert isinstance(dungeon.monster_ids, tuple)
+    assert [m.id for m in catalog.dungeon_waves(dungeon.id)] == list(dungeon.monster_ids)
+
+    with app.app_context():
+        reloaded = reload_catalog()
+    assert reloaded.version == catalog.version + 1
+    assert app_module.catalog is reloaded
+
+
+def test_dungeon_list_served_from_catalog():
+    client = app.test_client()
+    client.post('/register', json={'username': 'catalog_test', 'password': 'pw', 'email': 'catalog@example.com'})
+    token = client.post('/login', json={'username': 'catalog_test', 'password': 'pw'}).get_json()['token']
+    headers = {'Authorization': token}
+    client.post('/character', headers=headers, json={'name': '目录', 'linggen': '木'})
+
+    resp = client.get('/monsters', headers=headers)
+    assert resp.status_code == 200
+    assert len(resp.get_json()['monsters']) == len(app_module.catalog.monster_list)
+
+    resp = client.get('/dungeons', headers=headers)
+    assert resp.status_code == 200
+    assert all(d['level_requirement'] <= 1 for d in resp.get_json()['dungeons'])
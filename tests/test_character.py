@@ -1,7 +1,7 @@
 import pytest
 from app import app, db
 from models import User, Character, CharacterAttribute
-from utils.helpers import exp_for_level
+from utils.helpers import exp_for_level, exp_cost
 
 
 def test_character_levelup_flow():
@@ -57,3 +57,34 @@ def test_character_levelup_flow():
     print(f"DEBUG: Final character level: {data['level']}")
     assert data['level'] == 2
     assert data['attributes']['hp'] > 100
+
+
+def test_character_levelup_to_max_stops_at_realm_gate():
+    client = app.test_client()
+    client.post('/register', json={'username': 'char_max_test', 'password': 'pw', 'email': 'cmax@example.com'})
+    token = client.post('/login', json={'username': 'char_max_test', 'password': 'pw'}).get_json()['token']
+    headers = {'Authorization': token}
+    client.post('/character', headers=headers, json={'name': '连升', 'linggen': '木'})
+    char_id = client.get('/character', headers=headers).get_json()['id']
+
+    # 经验足够升到 15 级，但第 10 级为境界关卡
+    with app.app_context():
+        char = db.session.get(Character, char_id)
+        char.level = 1
+        char.experience = exp_cost(1, 14) + 7
+        db.session.commit()
+
+    resp = client.post('/character/levelup', headers=headers, json={'max': True})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['new_level'] == 10
+    assert data['levels_gained'] == 9
+    assert data['exp_cost'] == exp_cost(1, 9)
+    assert data['need_realm_breakthrough'] is True
+
+    with app.app_context():
+        char = db.session.get(Character, char_id)
+        assert char.experience == exp_cost(1, 14) + 7 - exp_cost(1, 9)
+
+    resp = client.post('/character/levelup', headers=headers, json={'max': True})
+    assert resp.status_code == 400
@@ -0,0 +1,99 @@
+import json
+
+from app import app, db
+from models import ChatMessage
+from utils.chat import ChatHub
+
+
+def test_world_chat_served_from_buffer_with_poll_and_stream(make_player):
+    client = app.test_client()
+    alice, _ = make_player(client, 'chat_alice', '传音甲', linggen='火')
+    bob, _ = make_player(client, 'chat_bob', '传音乙', linggen='火')
+
+    resp = client.get('/chat/world', headers=alice)
+    assert resp.status_code == 200
+    before = resp.get_json()['messages']
+    last_id = before[-1]['id'] if before else 0
+
+    resp = client.post('/chat/send', headers=alice, json={'channel': 'world', 'content': '道友好'})
+    assert resp.status_code == 201
+    message_id = resp.get_json()['message_id']
+    with app.app_context():
+        assert db.session.get(ChatMessage, message_id).sender_name == '传音甲'
+
+    # 新消息直接出现在缓冲区中，发送者名已记录
+    messages = client.get('/chat/world', headers=bob).get_json()['messages']
+    assert messages[-1]['id'] == message_id and messages[-1]['sender_name'] == '传音甲'
+
+    resp = client.get(f'/chat/poll?channel=world&after={last_id}', headers=bob)
+    assert [m['id'] for m in resp.get_json()['messages']][-1] == message_id
+    resp = client.get(f'/chat/poll?channel=world&after={message_id}&timeout=0.1', headers=bob)
+    assert resp.get_json()['messages'] == []
+
+    resp = client.get(f'/chat/stream?channel=world&after={last_id}&duration=0.2', headers=bob)
+    assert resp.mimetype == 'text/event-stream'
+    events = [line[len('data: '):] for line in resp.get_data(as_text=True).splitlines() if line.startswith('data: ')]
+    assert json.loads(events[-1])['content'] == '道友好'
+
+
+def test_private_and_sect_channels_are_scoped(make_player):
+    client = app.test_client()
+    alice, _ = make_player(client, 'chat_carol', '传音丙', linggen='火')
+    bob, _ = make_player(client, 'chat_dave', '传音丁', linggen='火')
+
+    assert client.post('/chat/send', headers=alice, json={'channel': 'private', 'receiver_name': '查无此人', 'content': 'hi'}).status_code == 404
+    resp = client.post('/chat/send', headers=alice, json={'channel': 'private', 'receiver_name': '传音丁', 'content': '密语'})
+    assert resp.status_code == 201
+    message_id = resp.get_json()['message_id']
+
+    received = client.get('/chat/poll?channel=private&after=0', headers=bob).get_json()['messages']
+    assert message_id in [m['id'] for m in received]
+    sent = client.get('/chat/poll?channel=private', headers=alice).get_json()['messages']
+    assert message_id in [m['id'] for m in sent]
+
+    assert client.get('/chat/poll?channel=sect', headers=alice).status_code == 400
+    assert client.post('/chat/send', headers=alice, json={'channel': 'sect', 'content': 'x'}).status_code == 400
+
+
+def test_messages_written_by_other_processes_reach_pollers(make_player):
+    client = app.test_client()
+    alice, alice_id = make_player(client, 'chat_erin', '传音戊', linggen='火')
+    messages = client.get('/chat/world', headers=alice).get_json()['messages']
+    last_id = messages[-1]['id'] if messages else 0
+
+    # 另一个 worker 进程写入的消息不会发布到本进程的缓存
+    with app.app_context():
+        message = ChatMessage(sender_id=alice_id, sender_name='传音戊', channel='world', content='隔壁进程')
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+
+    resp = client.get(f'/chat/poll?channel=world&after={last_id}&timeout=3', headers=alice)
+    assert [m['id'] for m in resp.get_json()['messages']] == [message_id]
+
+
+def test_chat_hub_syncs_from_loader_and_tracks_coverage():
+    rows = [{'id': 2}, {'id': 4}]
+    calls = []
+
+    def loader(after_id):
+        calls.append(after_id)
+        return [m for m in rows if after_id is None or m['id'] > after_id][-2:]
+
+    hub = ChatHub(size=2, max_age=60)
+    hub.refresh('k', loader)
+    # 首页装满，id 2 之前是否还有消息无从得知
+    assert hub.since('k', 0) == ([], False)
+    # 其他频道的消息占用了中间的 id，不影响覆盖判断
+    assert hub.since('k', 2) == ([{'id': 4}], True)
+
+    rows.append({'id': 7})
+    hub.refresh('k', loader)
+    assert calls == [None]  # 同步间隔内不重复查询
+    hub.publish('k')
+    messages, complete = hub.wait('k', 4, 0.01, loader)
+    assert messages == [{'id': 7}] and complete and calls == [None, 4]
+    # id 2 被挤出缓存后，更早的读取需要回退到数据库
+    assert hub.since('k', 1) == ([], False)
+    assert hub.since('k', 3) == ([{'id': 4}, {'id': 7}], True)
+    assert hub.wait('k', 7, 0.01, loader) == ([], True)
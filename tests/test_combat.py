@@ -0,0 +1,82 @@
+from app import app, db
+from models import User, Character, CombatState, CombatStats
+
+
+def test_combat_stats_snapshot_invalidated_by_equipment_change():
+    client = app.test_client()
+
+    # 注册并登录
+    client.post('/register', json={'username': 'combat_test', 'password': 'pw', 'email': 'combat@example.com'})
+    resp = client.post('/login', json={'username': 'combat_test', 'password': 'pw'})
+    token = resp.get_json().get('token')
+    headers = {'Authorization': token}
+
+    # 创建人物并初始化装备栏
+    client.post('/character', headers=headers, json={'name': '斗士', 'linggen': '金'})
+    resp = client.get('/equipment', headers=headers)
+    assert resp.status_code == 200
+    equip_id = next(e['id'] for e in resp.get_json() if e['equipped'])
+
+    with app.app_context():
+        user = User.query.filter_by(username='combat_test').first()
+        char = Character.query.filter_by(user_id=user.id).first()
+        char_id = char.id
+        # 清理上次运行遗留的战斗
+        CombatState.query.filter_by(character_id=char_id, is_active=True).update({'is_active': False})
+        db.session.commit()
+
+    # 开始战斗时生成该天气下的属性快照
+    resp = client.post('/combat/start', headers=headers, json={'type': 'monster', 'monster_id': 1})
+    assert resp.status_code == 201
+    combat_id = resp.get_json()['combat_id']
+    with app.app_context():
+        weather = db.session.get(CombatState, combat_id).weather
+        assert CombatStats.query.filter_by(character_id=char_id, weather=weather).count() == 1
+
+    # 战斗回合复用快照
+    resp = client.post(f'/combat/{combat_id}/action', headers=headers, json={'action': 'attack'})
+    assert resp.status_code == 200
+    with app.app_context():
+        assert CombatStats.query.filter_by(character_id=char_id, weather=weather).count() == 1
+
+    # 卸下装备后快照失效，只立即重新生成晴天快照（离线竞技使用）
+    resp = client.post(f'/equipment/unequip/{equip_id}', headers=headers)
+    assert resp.status_code == 200
+    with app.app_context():
+        assert [s.weather for s in CombatStats.query.filter_by(character_id=char_id)] == ['晴天']
+    assert client.post(f'/equipment/equip/{equip_id}', headers=headers).status_code == 200
+
+    client.post(f'/combat/{combat_id}/end', headers=headers)
+
+
+def test_auto_combat_resolves_whole_fight():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'auto_combat_test', 'password': 'pw', 'email': 'auto_combat@example.com'})
+    resp = client.post('/login', json={'username': 'auto_combat_test', 'password': 'pw'})
+    token = resp.get_json().get('token')
+    headers = {'Authorization': token}
+
+    client.post('/character', headers=headers, json={'name': '挂机', 'linggen': '火'})
+    with app.app_context():
+        user = User.query.filter_by(username='auto_combat_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        CombatState.query.filter_by(character_id=char_id, is_active=True).update({'is_active': False})
+        db.session.commit()
+
+    resp = client.post('/combat/auto', headers=headers, json={'type': 'monster', 'monster_id': 1, 'max_turns': 50})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['result'] in ('victory', 'defeat', 'timeout')
+    assert 1 <= data['turns'] <= 50
+    assert len(data['log']) == data['turns']
+    assert all(len(row) == len(data['log_fields']) for row in data['log'])
+
+    # 一次请求结束整场战斗，不留下进行中的战斗
+    with app.app_context():
+        combat = db.session.get(CombatState, data['combat_id'])
+        assert combat.is_active is False
+        assert combat.current_turn == data['turns']
+
+    resp = client.post('/combat/auto', headers=headers, json={'type': 'monster', 'monster_id': 1, 'action': 'flee'})
+    assert resp.status_code == 400
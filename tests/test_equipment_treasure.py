@@ -18,8 +18,9 @@ def test_forge_rune_and_strengthen_equipment():
     with app.app_context():
         user = User.query.filter_by(username='eq_test').first()
         char = Character.query.filter_by(user_id=user.id).first()
-        r = Resource(character_id=char.id, type='灵石', amount=10000)
-        db.session.add(r)
+        # 每个人物每类资源只有一行钱包
+        r = Resource.query.filter_by(character_id=char.id, type='灵石').first()
+        r.amount = 10000
         # 创建一件装备
         eq = Equipment(character_id=char.id, slot=1, type='武器', name='测试剑')
         db.session.add(eq)
@@ -42,3 +43,46 @@ def test_forge_rune_and_strengthen_equipment():
             success = True
             break
     assert success or resp.status_code in (400,)
+
+
+def test_batch_strengthen_and_rune_forge_in_one_request():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'batch_test', 'password': 'pw', 'email': 'batch@example.com'})
+    resp = client.post('/login', json={'username': 'batch_test', 'password': 'pw'})
+    headers = {'Authorization': resp.get_json().get('token')}
+    client.post('/character', headers=headers, json={'name': '连锻', 'linggen': '火'})
+
+    with app.app_context():
+        user = User.query.filter_by(username='batch_test').first()
+        char = Character.query.filter_by(user_id=user.id).first()
+        wallet = Resource.query.filter_by(character_id=char.id, type='灵石').first()
+        wallet.amount = 100000
+        # 清理上次运行遗留的装备和符文
+        Equipment.query.filter_by(character_id=char.id, name='批量剑').delete()
+        Rune.query.filter_by(owner_id=char.id, name='批符').delete()
+        eq = Equipment(character_id=char.id, slot=1, type='武器', name='批量剑', strengthen_times=0)
+        db.session.add(eq)
+        db.session.commit()
+        char_id, equip_id = char.id, eq.id
+
+    # 一次请求强化 3 次，消耗一次算清
+    resp = client.post(f'/equipment/strengthen/{equip_id}', headers=headers, json={'count': 3})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['attempts'] == 3
+    assert data['strengthen_level'] == 3
+    assert data['cost'] == sum(int(100 * 2 * 1.0 * (1 + t * 0.1)) for t in range(3))
+
+    # 一次请求锻造 5 个符文
+    resp = client.post('/rune/forge', headers=headers, json={'name': '批符', 'count': 5})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['attempts'] == 5
+    assert data['cost'] == 1000
+    with app.app_context():
+        assert Rune.query.filter_by(owner_id=char_id, name='批符').count() == data['successes']
+        assert Resource.query.filter_by(character_id=char_id, type='灵石').first().amount == 100000 - 660 - 1000
+
+    resp = client.post('/rune/forge', headers=headers, json={'count': 0})
+    assert resp.status_code == 400
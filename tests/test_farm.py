@@ -0,0 +1,141 @@
+import datetime
+
+from app import app, db, run_farm_tick, acquire_job_lease, leased_job, LINGZHI_MUTATION_ATTRIBUTES
+from models import User, Character, Lingzhi, Lingtian, Resource, JobLease
+
+
+def test_farm_tick_decays_and_advances_in_bulk():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'farm_tick_test', 'password': 'pw', 'email': 'farm_tick@example.com'})
+    resp = client.post('/login', json={'username': 'farm_tick_test', 'password': 'pw'})
+    token = resp.get_json().get('token')
+    headers = {'Authorization': token}
+    client.post('/character', headers=headers, json={'name': '药农', 'linggen': '木'})
+
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        user = User.query.filter_by(username='farm_tick_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        Lingzhi.query.filter_by(owner_id=char_id).delete()
+        ripe = Lingzhi(owner_id=char_id, name='熟', max_growth_time=60, water_level=1,
+                       planted_at=now - datetime.timedelta(hours=2))
+        half = Lingzhi(owner_id=char_id, name='半', max_growth_time=60,
+                       planted_at=now - datetime.timedelta(minutes=30))
+        fresh = Lingzhi(owner_id=char_id, name='新', max_growth_time=90, planted_at=now)
+        db.session.add_all([ripe, half, fresh])
+        db.session.commit()
+        ids = (ripe.id, half.id, fresh.id)
+
+        result = run_farm_tick(now)
+        assert result['decayed'] >= 3 and result['staged'] >= 2
+
+        ripe, half, fresh = (db.session.get(Lingzhi, i) for i in ids)
+        assert (ripe.growth_stage, half.growth_stage, fresh.growth_stage) == ('成熟', '生长', '种子')
+        decay = app.config['FARM_CARE_DECAY']
+        assert ripe.water_level == 0
+        assert half.water_level == 50 - decay and half.sunlight_level == 50 - decay
+
+        # 阶段已是最新时不再重复写入
+        assert run_farm_tick(now)['staged'] == 0
+        Lingzhi.query.filter_by(owner_id=char_id).delete()
+        db.session.commit()
+
+
+def test_farm_tick_rolls_mutations_in_sql():
+    client = app.test_client()
+    client.post('/register', json={'username': 'farm_mutation_test', 'password': 'pw', 'email': 'farm_mutation@example.com'})
+    resp = client.post('/login', json={'username': 'farm_mutation_test', 'password': 'pw'})
+    client.post('/character', headers={'Authorization': resp.get_json().get('token')}, json={'name': '异种', 'linggen': '木'})
+
+    now = datetime.datetime.utcnow()
+    with app.app_context():
+        user = User.query.filter_by(username='farm_mutation_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        Lingzhi.query.filter_by(owner_id=char_id).delete()
+        # 变异率 1.0 时每株每次约 10% 变异；变异率 0 的永不变异
+        db.session.add_all([Lingzhi(owner_id=char_id, name='异', level=2, mutation_rate=1.0, planted_at=now) for _ in range(200)])
+        db.session.add_all([Lingzhi(owner_id=char_id, name='常', level=2, mutation_rate=0, planted_at=now) for _ in range(50)])
+        db.session.commit()
+
+        assert run_farm_tick(now)['mutated'] >= 1
+        mutated = Lingzhi.query.filter_by(owner_id=char_id, has_mutated=True).all()
+        assert 1 <= len(mutated) <= 60 and all(lz.name == '异' for lz in mutated)
+        assert all(lz.attribute_type in LINGZHI_MUTATION_ATTRIBUTES for lz in mutated)
+        assert all(10 <= lz.attribute_value <= 40 for lz in mutated)
+        Lingzhi.query.filter_by(owner_id=char_id).delete()
+        db.session.commit()
+
+
+def test_care_all_and_harvest_all_settle_in_one_wallet_update():
+    client = app.test_client()
+
+    client.post('/register', json={'username': 'farm_all_test', 'password': 'pw', 'email': 'farm_all@example.com'})
+    resp = client.post('/login', json={'username': 'farm_all_test', 'password': 'pw'})
+    token = resp.get_json().get('token')
+    headers = {'Authorization': token}
+    client.post('/character', headers=headers, json={'name': '田主', 'linggen': '木'})
+    client.post('/lingtian/init', headers=headers)
+
+    with app.app_context():
+        user = User.query.filter_by(username='farm_all_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        wallet = Resource.query.filter_by(character_id=char_id, type='灵石').first()
+        wallet.amount = 1000
+        # 清理上次运行遗留的灵植
+        Lingtian.query.filter_by(owner_id=char_id).update({'lingzhi_id': None, 'is_occupied': False})
+        Lingzhi.query.filter_by(owner_id=char_id).delete()
+        db.session.commit()
+
+    # 种下两株，灵田应记录灵植 id
+    for _ in range(2):
+        resp = client.post('/lingzhi/plant', headers=headers, json={'quality': '凡品'})
+        assert resp.status_code == 201
+    with app.app_context():
+        plots = Lingtian.query.filter_by(owner_id=char_id, is_occupied=True).all()
+        assert len(plots) == 2 and all(lt.lingzhi_id for lt in plots)
+        ripe_id = plots[0].lingzhi_id
+        db.session.get(Lingzhi, ripe_id).planted_at = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        db.session.commit()
+
+    resp = client.post('/lingtian/care_all', headers=headers, json={'types': ['water', 'sunlight']})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['cost'] == 2 * 2 * 10 and len(data['results']) == 2
+    assert all(r['water_level'] == 70 and r['sunlight_level'] == 70 for r in data['results'])
+
+    resp = client.post('/lingtian/care_all', headers=headers, json={'types': ['dance']})
+    assert resp.status_code == 400
+
+    # 只收获成熟的一株
+    resp = client.post('/lingtian/harvest_all', headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert [h['lingzhi_id'] for h in data['harvested']] == [ripe_id]
+    with app.app_context():
+        assert db.session.get(Lingzhi, ripe_id) is None
+        assert Lingtian.query.filter_by(owner_id=char_id, is_occupied=True).count() == 1
+        wallet = Resource.query.filter_by(character_id=char_id, type='灵石').first()
+        assert wallet.amount == 1000 - 40 + data['reward']
+
+    resp = client.post('/lingtian/harvest_all', headers=headers)
+    assert resp.status_code == 400
+
+
+def test_job_lease_lets_one_process_run_per_interval():
+    with app.app_context():
+        JobLease.query.filter_by(name='lease_test').delete()
+        db.session.commit()
+        assert acquire_job_lease('lease_test', 60) is True
+        # 租约未过期时其他进程（及本进程）都不能再次执行
+        assert acquire_job_lease('lease_test', 60) is False
+
+    runs = []
+    job = leased_job('lease_test', 60, lambda: runs.append(1) or 'ran')
+    assert job() is None and runs == []
+
+    with app.app_context():
+        db.session.get(JobLease, 'lease_test').expires_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        db.session.commit()
+    assert job() == 'ran' and runs == [1]
+    assert job() is None
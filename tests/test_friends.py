@@ -0,0 +1,55 @@
+from app import app, db, are_friends, friend_cache, normalize_friendships
+from models import Friendship
+
+
+def test_friendship_stored_as_canonical_pair_and_cached(make_player):
+    client = app.test_client()
+    alice, alice_id = make_player(client, 'friend_alice', '道侣甲', linggen='木')
+    bob, bob_id = make_player(client, 'friend_bob', '道侣乙', linggen='木')
+    with app.app_context():
+        Friendship.query.filter(Friendship.character_id.in_([alice_id, bob_id]) | Friendship.friend_id.in_([alice_id, bob_id])).delete(synchronize_session=False)
+        db.session.commit()
+    friend_cache.invalidate()
+
+    # 从 id 较大的一方添加，存储为有序对
+    adder, added = (bob, '道侣甲') if bob_id > alice_id else (alice, '道侣乙')
+    assert client.post('/friends/add', headers=adder, json={'friend_name': added}).status_code == 201
+    with app.app_context():
+        rows = Friendship.query.filter_by(character_id=min(alice_id, bob_id), friend_id=max(alice_id, bob_id)).all()
+        assert len(rows) == 1
+        assert are_friends(alice_id, bob_id) and are_friends(bob_id, alice_id)
+
+    # 反方向再次添加被拒绝
+    assert client.post('/friends/add', headers=alice, json={'friend_name': '道侣乙'}).status_code == 400
+    assert client.post('/friends/add', headers=bob, json={'friend_name': '道侣甲'}).status_code == 400
+
+    for headers, other_id, other_name in ((alice, bob_id, '道侣乙'), (bob, alice_id, '道侣甲')):
+        friends = client.get('/friends', headers=headers).get_json()['friends']
+        assert [(f['id'], f['name']) for f in friends] == [(other_id, other_name)]
+        assert friends[0]['realm']
+
+    assert client.post(f'/friends/remove/{alice_id}', headers=bob).status_code == 200
+    with app.app_context():
+        assert not are_friends(alice_id, bob_id)
+    assert client.get('/friends', headers=alice).get_json()['friends'] == []
+
+
+def test_normalize_friendships_handles_legacy_rows(make_player):
+    client = app.test_client()
+    _, a = make_player(client, 'friend_legacy_a', '旧友甲', linggen='木')
+    _, b = make_player(client, 'friend_legacy_b', '旧友乙', linggen='木')
+    low, high = min(a, b), max(a, b)
+    with app.app_context():
+        Friendship.query.filter(Friendship.character_id.in_([a, b]) | Friendship.friend_id.in_([a, b])).delete(synchronize_session=False)
+        db.session.commit()
+        # 模拟唯一索引之前的旧数据：只有反向的一行
+        db.session.execute(db.text('DROP INDEX uq_friendship_pair'))
+        db.session.add(Friendship(character_id=high, friend_id=low))
+        db.session.add(Friendship(character_id=high, friend_id=low))
+        db.session.commit()
+        normalize_friendships()
+        rows = Friendship.query.filter(Friendship.character_id.in_([a, b])).all()
+        assert [(r.character_id, r.friend_id) for r in rows] == [(low, high)]
+        for index in Friendship.__table__.indexes:
+            if index.name == 'uq_friendship_pair':
+                index.create(db.engine)
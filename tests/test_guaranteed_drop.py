@@ -0,0 +1,57 @@
+from app import app, db, normalize_guaranteed_drops
+from models import Equipment, Treasure, GuaranteedDrop
+
+
+def clear_counters(char):
+    GuaranteedDrop.query.filter_by(character_id=char.id).delete()
+
+
+def test_multi_pull_writes_rewards_and_counter_once(make_player):
+    client = app.test_client()
+    headers, char_id = make_player(client, 'gacha_test', '抽卡人', linggen='土', cleanup=clear_counters)
+
+    assert client.post('/guaranteed_drop/equipment/attempt?count=7', headers=headers).status_code == 400
+
+    with app.app_context():
+        equipment_before = Equipment.query.filter_by(character_id=char_id).count()
+        treasure_before = Treasure.query.filter_by(character_id=char_id).count()
+
+    resp = client.post('/guaranteed_drop/equipment/attempt?count=100', headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    # 百连中至少触发一次（第100次保底）
+    assert data['count'] == 100 and data['dropped']
+    assert all(r['type'] == 'equipment' for r in data['rewards'])
+    assert data['attempts'] == 100 - data['rewards'][-1]['attempt']
+
+    resp = client.post('/guaranteed_drop/treasure/attempt', headers=headers, json={'count': 10})
+    assert resp.status_code == 200
+    treasure_rewards = resp.get_json()['rewards']
+
+    with app.app_context():
+        assert Equipment.query.filter_by(character_id=char_id).count() == equipment_before + len(data['rewards'])
+        assert Treasure.query.filter_by(character_id=char_id).count() == treasure_before + len(treasure_rewards)
+        new_equipment = Equipment.query.filter_by(character_id=char_id, equipped=False).all()
+        assert all(e.slot in (1, 2, 3, 4, 8) for e in new_equipment)
+        counter = GuaranteedDrop.query.filter_by(character_id=char_id, drop_type='equipment').one()
+        assert counter.attempts == data['attempts']
+
+    status = client.get('/guaranteed_drop/equipment', headers=headers).get_json()
+    assert status['attempts'] == data['attempts']
+
+
+def test_normalize_guaranteed_drops_merges_duplicate_counters(make_player):
+    client = app.test_client()
+    _, char_id = make_player(client, 'gacha_legacy', '旧抽卡人', linggen='土', cleanup=clear_counters)
+    with app.app_context():
+        # 模拟唯一索引之前并发首抽产生的重复计数器
+        index = next(i for i in GuaranteedDrop.__table__.indexes if i.name == 'uq_guaranteed_drop_character_type')
+        index.drop(db.engine)
+        db.session.add_all([GuaranteedDrop(character_id=char_id, drop_type='equipment', attempts=n) for n in (3, 9)])
+        db.session.commit()
+        keep_id = db.session.query(db.func.min(GuaranteedDrop.id)).filter_by(character_id=char_id).scalar()
+
+        normalize_guaranteed_drops()
+        index.create(db.engine)
+        rows = GuaranteedDrop.query.filter_by(character_id=char_id, drop_type='equipment').all()
+        assert [(r.id, r.attempts) for r in rows] == [(keep_id, 9)]
@@ -0,0 +1,117 @@
+import datetime
+
+from utils.helpers import (
+    exp_for_level, exp_cost, affordable_levels, MAX_LEVEL, TTLCache, LRUCache,
+    binomial_sample, skill_level_progress, lingzhi_growth,
+    acupoint_cost, affordable_acupoint_levels, simulate_guaranteed_drops
+)
+
+
+def _brute_levels(level, experience):
+    gained = 0
+    while level <= MAX_LEVEL and experience >= exp_for_level(level):
+        experience -= exp_for_level(level)
+        level += 1
+        gained += 1
+    return gained
+
+
+def test_affordable_levels_matches_stepwise_loop():
+    for level in (1, 5, 9, 50, 99, 100):
+        for experience in (0, exp_for_level(level) - 1, exp_for_level(level), exp_cost(level, 1) * 3, 10 ** 9):
+            assert affordable_levels(level, experience) == _brute_levels(level, experience)
+    assert affordable_levels(3, 10 ** 12, max_levels=2) == 2
+    assert exp_cost(1, 3) == exp_for_level(1) + exp_for_level(2) + exp_for_level(3)
+    assert exp_cost(MAX_LEVEL, 2) == exp_for_level(MAX_LEVEL) + exp_for_level(MAX_LEVEL + 1)
+
+
+def test_ttl_cache_computes_once_until_expired():
+    cache = TTLCache(ttl=60)
+    calls = []
+    assert cache.get_or_set('k', lambda: calls.append(1) or 'v') == 'v'
+    assert cache.get_or_set('k', lambda: calls.append(1) or 'w') == 'v'
+    assert len(calls) == 1
+    cache.invalidate('k')
+    assert cache.get('k') is None
+
+
+def test_lru_cache_evicts_least_recent_and_expires_with_ttl():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+
+    # ttl 到期后重新计算，即使没有被淘汰
+    cache = LRUCache(maxsize=2, ttl=0)
+    assert cache.get_or_set('k', lambda: 'v') == 'v'
+    assert cache.get('k') is None
+    assert cache.get_or_set('k', lambda: 'w') == 'w'
+
+
+def test_skill_level_progress_matches_loop():
+    for level in (1, 2, 7, 50):
+        for experience in (0, 99, 100, level * 100, 12345, 10 ** 8):
+            lv, exp = level, experience
+            while exp >= lv * 100:
+                exp -= lv * 100
+                lv += 1
+            assert skill_level_progress(level, experience) == (lv, exp)
+
+
+def test_binomial_sample_bounds_and_mean():
+    assert binomial_sample(0, 0.5) == 0
+    assert binomial_sample(10, 1.0) == 10
+    assert binomial_sample(10, 0.0) == 0
+    for n, p in ((20, 0.3), (10 ** 6, 0.83)):
+        samples = [binomial_sample(n, p) for _ in range(500)]
+        assert all(0 <= s <= n for s in samples)
+        mean = sum(samples) / len(samples)
+        assert abs(mean - n * p) < 5 * (n * p * (1 - p)) ** 0.5 / len(samples) ** 0.5 + 1
+
+
+def test_lingzhi_growth_from_timestamps():
+    planted = datetime.datetime(2024, 1, 1)
+    assert lingzhi_growth(planted, 60, planted) == ('种子', 0.0, 0.0)
+    stage, progress, elapsed = lingzhi_growth(planted, 60, planted + datetime.timedelta(minutes=30))
+    assert (stage, progress, elapsed) == ('生长', 50.0, 30.0)
+    assert lingzhi_growth(planted, 60, planted + datetime.timedelta(minutes=59))[0] == '结果'
+    assert lingzhi_growth(planted, 60, planted + datetime.timedelta(hours=5))[:2] == ('成熟', 100.0)
+
+
+def test_acupoint_cost_closed_form_matches_per_level_sum():
+    for coefficient in (1.5, 2.5, 0.7):
+        for level in range(0, 10):
+            for levels in range(0, 11 - level):
+                per_level = [int(50 * k * coefficient) for k in range(level + 1, level + levels + 1)]
+                assert acupoint_cost(level, levels, coefficient) == (sum(per_level), sum(int(c * 0.5) for c in per_level))
+    exp, lingshi = acupoint_cost(2, 4, 1.5)
+    assert affordable_acupoint_levels(2, 10, 1.5, exp, lingshi) == 4
+    assert affordable_acupoint_levels(2, 10, 1.5, exp - 1, lingshi) == 3
+    assert affordable_acupoint_levels(9, 10, 2.5, 10 ** 9, 10 ** 9) == 1
+
+
+def test_guaranteed_drop_simulation_follows_per_attempt_rules():
+    # 第 n 次尝试的掉率 = min(0.5, 0.01 + 0.005n)，未掉落时保持计数
+    drops, attempts, guaranteed, rate = simulate_guaranteed_drops(0, False, [0.99] * 3)
+    assert (drops, attempts, guaranteed, rate) == ([], 3, False, 0.025)
+
+    # 掷出 0.02：第1次掉率 0.015、第2次 0.02（需严格小于）不掉，第3次 0.025 掉落并重置
+    drops, attempts, guaranteed, rate = simulate_guaranteed_drops(0, False, [0.02, 0.02, 0.02, 0.02])
+    assert drops == [(2, 0.025)]
+    assert (attempts, guaranteed, rate) == (1, False, 0.015)
+
+    # 掉率封顶 0.5（第98次起），第100次保底必出
+    drops, attempts, guaranteed, rate = simulate_guaranteed_drops(96, False, [0.6, 0.6, 0.6, 0.99])
+    assert drops == [(3, 1.0)]
+    assert (attempts, guaranteed, rate) == (0, False, 1.0)
+    assert simulate_guaranteed_drops(96, False, [0.6])[3] == 0.495
+    assert simulate_guaranteed_drops(97, False, [0.6])[3] == 0.5
+
+    # 已处于保底状态时下一次必出
+    assert simulate_guaranteed_drops(3, True, [0.999])[0] == [(0, 1.0)]
+
+    # 一直不出时第100次保底必出
+    drops, attempts, guaranteed, rate = simulate_guaranteed_drops(0, False, [0.99] * 100)
+    assert drops == [(99, 1.0)] and (attempts, guaranteed, rate) == (0, False, 1.0)
@@ -0,0 +1,57 @@
+from app import app, db, broadcast_system_mail
+from models import Character, Mail
+
+
+def clear_mail(char):
+    Mail.query.filter_by(receiver_id=char.id).delete()
+
+
+def test_mailbox_pagination_unread_and_bulk_operations(make_player):
+    client = app.test_client()
+    reader, reader_id = make_player(client, 'mail_reader', '收信人', linggen='水', cleanup=clear_mail)
+    writer, _ = make_player(client, 'mail_writer', '寄信人', linggen='水', cleanup=clear_mail)
+
+    for i in range(5):
+        resp = client.post('/mail/send', headers=writer, json={'receiver_name': '收信人', 'title': f'信{i}', 'content': '见字如面'})
+        assert resp.status_code == 201
+
+    assert client.get('/mail/unread_count', headers=reader).get_json()['unread_count'] == 5
+
+    # 同一秒发出的邮件按 id 区分，游标翻页不重不漏
+    seen, cursor = [], None
+    while True:
+        resp = client.get('/mail?per_page=2' + (f'&cursor={cursor}' if cursor else ''), headers=reader)
+        assert resp.status_code == 200
+        data = resp.get_json()
+        seen.extend(data['mails'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    assert [m['title'] for m in seen] == [f'信{i}' for i in range(4, -1, -1)]
+    assert all(m['sender_name'] == '寄信人' for m in seen)
+
+    ids = [m['id'] for m in seen[:3]]
+    assert client.post('/mail/read', headers=reader, json={'ids': ids}).get_json()['updated'] == 3
+    assert client.get('/mail/unread_count', headers=reader).get_json()['unread_count'] == 2
+    assert len(client.get('/mail?unread=1', headers=reader).get_json()['mails']) == 2
+
+    # all=true 删除时只删已读
+    assert client.post('/mail/delete', headers=reader, json={'all': True}).get_json()['deleted'] == 3
+    assert client.post('/mail/read', headers=reader, json={'all': True}).get_json()['updated'] == 2
+    assert client.post('/mail/delete', headers=reader, json={'ids': []}).status_code == 400
+    assert client.get('/mail?cursor=abc', headers=reader).status_code == 400
+
+
+def test_system_mail_broadcast_in_one_statement(make_player):
+    client = app.test_client()
+    headers, char_id = make_player(client, 'mail_broadcast', '众生', linggen='水', cleanup=clear_mail)
+
+    with app.app_context():
+        total = Character.query.count()
+        assert broadcast_system_mail('公告', '天降祥瑞') == total
+        db.session.commit()
+        mail = Mail.query.filter_by(receiver_id=char_id, title='公告').first()
+        assert mail.is_system and mail.sender_id is None
+
+    mails = client.get('/mail', headers=headers).get_json()['mails']
+    assert mails[0]['title'] == '公告' and mails[0]['sender_name'] == 'System'
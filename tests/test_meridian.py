@@ -0,0 +1,105 @@
+import app as app_module
+from app import app, db, reload_catalog, calculate_acupoint_bonus
+from models import User, Character, Meridian, Acupoint, Resource
+from utils.helpers import acupoint_cost
+
+
+def ensure_meridian_templates():
+    """测试库中没有经脉模板时补两条（与 scripts/init_db.py 的种子格式一致）"""
+    with app.app_context():
+        if Meridian.query.filter_by(character_id=None).count() == 0:
+            for name, points in (('任脉', ['会阴', '曲骨', '中极']), ('足阳明胃经', ['承泣', '四白'])):
+                mer = Meridian(name=name, coefficient=2.5 if name == '任脉' else 1.5)
+                db.session.add(mer)
+                db.session.flush()
+                db.session.add_all([Acupoint(meridian_id=mer.id, name=p) for p in points])
+            db.session.commit()
+        reload_catalog()
+
+
+def test_meridian_system_cloned_from_cached_templates():
+    ensure_meridian_templates()
+    templates = app_module.catalog.meridian_templates
+    assert templates and all(t.acupoints for t in templates)
+
+    client = app.test_client()
+    client.post('/register', json={'username': 'meridian_test', 'password': 'pw', 'email': 'meridian@example.com'})
+    token = client.post('/login', json={'username': 'meridian_test', 'password': 'pw'}).get_json()['token']
+    headers = {'Authorization': token}
+    client.post('/character', headers=headers, json={'name': '通脉', 'linggen': '水'})
+
+    resp = client.get('/meridian', headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert sorted(m['name'] for m in data) == sorted(t.name for t in templates)
+    by_name = {t.name: t for t in templates}
+    for m in data:
+        template = by_name[m['name']]
+        assert m['type'] == template.type and m['coefficient'] == template.coefficient
+        assert [a['name'] for a in m['acupoints']] == list(template.acupoints)
+        assert all(a['level'] == 0 for a in m['acupoints'])
+
+    # 再次查询不会重复复制
+    resp = client.get('/meridian', headers=headers)
+    assert len(resp.get_json()) == len(templates)
+    with app.app_context():
+        user = User.query.filter_by(username='meridian_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        assert Meridian.query.filter_by(character_id=char_id).count() == len(templates)
+
+
+def reset_meridians(char):
+    # 删除上次运行修炼过的经脉，查询时重新从模板复制
+    meridian_ids = [m.id for m in Meridian.query.filter_by(character_id=char.id)]
+    Acupoint.query.filter(Acupoint.meridian_id.in_(meridian_ids)).delete(synchronize_session=False)
+    Meridian.query.filter_by(character_id=char.id).delete()
+    char.realm = '筑基期'
+    char.experience = 10 ** 6
+    Resource.query.filter_by(character_id=char.id, type='灵石').first().amount = 10 ** 6
+
+
+def test_meridian_templates_reloaded_when_catalog_has_none(make_player):
+    ensure_meridian_templates()
+    # 模拟目录在写入模板之前加载
+    app_module.catalog.meridian_templates = ()
+
+    client = app.test_client()
+    headers, _ = make_player(client, 'meridian_late', '迟脉', linggen='火', cleanup=reset_meridians)
+    data = client.get('/meridian', headers=headers).get_json()
+    assert data and all(m['acupoints'] for m in data)
+    assert app_module.catalog.meridian_templates
+
+
+def test_acupoint_batch_levels_and_auto_cultivate(make_player):
+    ensure_meridian_templates()
+
+    client = app.test_client()
+    headers, char_id = make_player(client, 'acupoint_test', '修脉', linggen='土', cleanup=reset_meridians)
+    meridian = client.get('/meridian', headers=headers).get_json()[0]
+
+    assert client.post(f"/meridian/open/{meridian['id']}", headers=headers).status_code == 200
+
+    # 一次升三级，消耗为三级之和
+    first = meridian['acupoints'][0]
+    resp = client.post(f"/acupoint/open/{first['id']}?levels=3", headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['new_level'] == 3 and data['levels_gained'] == 3
+    assert (data['exp_cost'], data['lingshi_cost']) == acupoint_cost(0, 3, meridian['coefficient'])
+    assert data['attribute_bonus'] == calculate_acupoint_bonus(meridian['name'], 3)
+
+    # 自动修炼把整条经脉升满，一次扣费
+    with app.app_context():
+        exp_before = db.session.get(Character, char_id).experience
+    resp = client.post(f"/meridian/{meridian['id']}/auto_cultivate", headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    expected_exp = acupoint_cost(3, 7, meridian['coefficient'])[0] + \
+        acupoint_cost(0, 10, meridian['coefficient'])[0] * (len(meridian['acupoints']) - 1)
+    assert data['exp_cost'] == expected_exp
+    with app.app_context():
+        assert db.session.get(Character, char_id).experience == exp_before - expected_exp
+        assert all(a.level == 10 for a in Acupoint.query.filter_by(meridian_id=meridian['id']))
+
+    resp = client.post(f"/meridian/{meridian['id']}/auto_cultivate", headers=headers)
+    assert resp.status_code == 400
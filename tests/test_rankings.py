@@ -0,0 +1,84 @@
+from app import app, db, wealth_ranking_cache
+from models import User, Character, Ranking, Resource
+
+
+def _login(client, username):
+    client.post('/register', json={'username': username, 'password': 'pw', 'email': f'{username}@example.com'})
+    resp = client.post('/login', json={'username': username, 'password': 'pw'})
+    return {'Authorization': resp.get_json().get('token')}
+
+
+def test_battle_power_ranking_maintained_incrementally():
+    client = app.test_client()
+    headers = _login(client, 'rank_test')
+    client.post('/character', headers=headers, json={'name': '榜上', 'linggen': '金'})
+
+    with app.app_context():
+        user = User.query.filter_by(username='rank_test').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        before = Ranking.query.filter_by(character_id=char_id, type='battle_power').one().score
+
+    resp = client.get('/rankings/battle_power', headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data['my_rank']['value'] == before
+    with app.app_context():
+        higher = sum(1 for r in Ranking.query.filter_by(type='battle_power') if r.score > before)
+    assert data['my_rank']['rank'] == higher + 1
+    values = [r['value'] for r in data['rankings']]
+    assert values == sorted(values, reverse=True)
+
+    # 初始化装备栏后战力随之更新
+    client.get('/equipment', headers=headers)
+    with app.app_context():
+        rows = Ranking.query.filter_by(character_id=char_id, type='battle_power').all()
+        assert len(rows) == 1
+        assert rows[0].score >= before
+        equipped_score = rows[0].score
+
+    # 学习功法提高战力，删除功法后战力恢复
+    def score():
+        with app.app_context():
+            return Ranking.query.filter_by(character_id=char_id, type='battle_power').one().score
+
+    resp = client.post('/mantra/learn', headers=headers, json={'name': f'榜上心法{char_id}', 'quality': '天阶'})
+    assert resp.status_code == 201
+    assert score() > equipped_score
+    # 我的排名实时反映最新战力
+    assert client.get('/rankings/battle_power', headers=headers).get_json()['my_rank']['value'] == score()
+    assert client.delete(f"/mantra/delete/{resp.get_json()['mantra']['id']}", headers=headers).status_code == 200
+    assert score() == equipped_score
+
+
+def test_wealth_ranking_weights_resources_and_is_cached():
+    client = app.test_client()
+    headers = _login(client, 'wealth_test')
+    client.post('/character', headers=headers, json={'name': '富甲', 'linggen': '土'})
+    # 探索幽暗森林获得木材和灵植种子
+    client.post('/world/explore/2', headers=headers)
+    with app.app_context():
+        # 灵石足够多，保证进入榜单前列
+        user = User.query.filter_by(username='wealth_test').first()
+        char = Character.query.filter_by(user_id=user.id).first()
+        Resource.query.filter_by(character_id=char.id, type='灵石').update({'amount': 10 ** 9})
+        db.session.commit()
+
+    wealth_ranking_cache.invalidate()
+    resp = client.get('/rankings/wealth', headers=headers)
+    assert resp.status_code == 200
+    data = resp.get_json()['rankings']
+    values = [r['value'] for r in data]
+    assert values == sorted(values, reverse=True)
+
+    weights = app.config['WEALTH_WEIGHTS']
+    with app.app_context():
+        user = User.query.filter_by(username='wealth_test').first()
+        char = Character.query.filter_by(user_id=user.id).first()
+        name = char.name
+        expected = int(sum(r.amount * weights.get(r.type, 1) for r in Resource.query.filter_by(character_id=char.id)))
+    entry = next((r for r in data if r['name'] == name), None)
+    assert entry is not None
+    assert entry['value'] == expected
+
+    # 缓存期内直接返回同一份结果
+    assert client.get('/rankings/wealth', headers=headers).get_json()['rankings'] == data
@@ -0,0 +1,160 @@
+from app import app, db, run_sect_contribution_fold
+from models import Resource, Sect, SectMember, SectContribution, SectTask
+
+
+def reset_sect_member(lingshi=0):
+    def cleanup(char):
+        # 清理上次运行遗留的宗门成员记录
+        SectMember.query.filter_by(character_id=char.id).delete()
+        Resource.query.filter_by(character_id=char.id, type='灵石').first().amount = lingshi
+    return cleanup
+
+
+def test_sect_member_count_maintained_and_listing_paginated(make_player):
+    client = app.test_client()
+    master, _ = make_player(client, 'sect_master_test', '宗主', cleanup=reset_sect_member(20000))
+    disciple, disciple_id = make_player(client, 'sect_disciple_test', '弟子甲', cleanup=reset_sect_member())
+    leaver, _ = make_player(client, 'sect_leaver_test', '弟子乙', cleanup=reset_sect_member())
+
+    with app.app_context():
+        for old in Sect.query.filter_by(name='计数宗'):
+            old.name = f'计数宗#{old.id}'
+        db.session.commit()
+    resp = client.post('/sect', headers=master, json={'name': '计数宗'})
+    assert resp.status_code == 201
+    sect_id = resp.get_json()['sect']['id']
+
+    for headers in (disciple, leaver):
+        assert client.post(f'/sect/join/{sect_id}', headers=headers).status_code == 200
+
+    def member_count():
+        with app.app_context():
+            return db.session.get(Sect, sect_id).member_count
+
+    assert member_count() == 3
+
+    # 退出与踢出都会维护成员数；宗主不能退出，弟子不能踢人
+    assert client.post('/sect/leave', headers=master).status_code == 400
+    assert client.post('/sect/leave', headers=leaver).status_code == 200
+    assert client.post(f'/sect/kick/{disciple_id}', headers=leaver).status_code == 403
+    assert client.post(f'/sect/kick/{disciple_id}', headers=master).status_code == 200
+    assert member_count() == 1
+    with app.app_context():
+        assert SectMember.query.filter_by(sect_id=sect_id).count() == 1
+
+    # 分页与排序
+    resp = client.get('/sect?sort=power&per_page=1', headers=master)
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert len(data['sects']) == 1 and data['per_page'] == 1 and data['total'] >= 1
+    resp = client.get('/sect?per_page=100', headers=master)
+    listed = {s['id']: s for s in resp.get_json()['sects']}
+    if sect_id in listed:
+        assert listed[sect_id]['member_count'] == 1
+    assert client.get('/sect?sort=name', headers=master).status_code == 400
+
+
+def test_sect_detail_pages_members_by_contribution(make_player):
+    client = app.test_client()
+    master, master_id = make_player(client, 'sect_detail_master', '掌门', cleanup=reset_sect_member(20000))
+    with app.app_context():
+        for old in Sect.query.filter_by(name='分页宗'):
+            old.name = f'分页宗#{old.id}'
+        db.session.commit()
+    sect_id = client.post('/sect', headers=master, json={'name': '分页宗'}).get_json()['sect']['id']
+
+    member_ids = []
+    for i in range(4):
+        headers, char_id = make_player(client, f'sect_detail_member{i}', f'门人{i}', cleanup=reset_sect_member())
+        client.post(f'/sect/join/{sect_id}', headers=headers)
+        member_ids.append(char_id)
+    with app.app_context():
+        # 两名成员贡献相同，验证游标在并列时也不重不漏
+        for char_id, contribution in zip(member_ids, (500, 300, 300, 0)):
+            SectMember.query.filter_by(character_id=char_id).update({'contribution': contribution})
+        db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        url = f'/sect/{sect_id}?per_page=2' + (f'&cursor={cursor}' if cursor else '')
+        resp = client.get(url, headers=master)
+        assert resp.status_code == 200
+        data = resp.get_json()
+        assert len(data['members']) <= 2
+        seen.extend(data['members'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert len(seen) == 5 and len({m['id'] for m in seen}) == 5
+    contributions = [m['contribution'] for m in seen]
+    assert contributions == sorted(contributions, reverse=True)
+    assert seen[0]['character_id'] == master_id and seen[0]['character_name'] == '掌门'
+    assert all('character_realm' in m for m in seen)
+    assert data['sect']['member_count'] == 5
+
+    assert client.get(f'/sect/{sect_id}?cursor=bad', headers=master).status_code == 400
+
+    # 任务默认列出全部状态，按游标翻页不截断
+    with app.app_context():
+        db.session.add_all([SectTask(sect_id=sect_id, title=f'任务{i}', status=('进行中', '已完成', '已过期')[i % 3])
+                            for i in range(5)])
+        db.session.commit()
+    titles, task_cursor = [], None
+    while True:
+        url = f'/sect/{sect_id}?per_page=2' + (f'&task_cursor={task_cursor}' if task_cursor else '')
+        data = client.get(url, headers=master).get_json()
+        assert len(data['tasks']) <= 2
+        titles.extend(t['title'] for t in data['tasks'])
+        task_cursor = data['next_task_cursor']
+        if not task_cursor:
+            break
+    assert titles == [f'任务{i}' for i in range(5)]
+    data = client.get(f'/sect/{sect_id}?task_status=已完成', headers=master).get_json()
+    assert [t['title'] for t in data['tasks']] == ['任务1', '任务4']
+    assert client.get(f'/sect/{sect_id}?task_cursor=bad', headers=master).status_code == 400
+
+
+def test_sect_contributions_folded_from_ledger(make_player):
+    client = app.test_client()
+    master, master_id = make_player(client, 'sect_ledger_master', '司库', cleanup=reset_sect_member(30000))
+    with app.app_context():
+        for old in Sect.query.filter_by(name='流水宗'):
+            old.name = f'流水宗#{old.id}'
+        db.session.commit()
+    sect_id = client.post('/sect', headers=master, json={'name': '流水宗'}).get_json()['sect']['id']
+
+    for amount in (3000, 2250):
+        resp = client.post('/sect/contribute', headers=master, json={'amount': amount})
+        assert resp.status_code == 200
+    data = resp.get_json()
+    # 个人贡献即时准确，宗门计数在流水里等待汇总，但读取时已包含
+    assert data['personal_contribution'] == 1000 + 5250
+    assert data['sect_prosperity'] == 30 + 22
+    with app.app_context():
+        sect = db.session.get(Sect, sect_id)
+        assert sect.contribution == 0
+        assert SectContribution.query.filter_by(sect_id=sect_id, fold_batch=None).count() == 2
+    assert client.get('/sect/my', headers=master).get_json()['sect']['contribution'] == 5250
+    # 列表与详情页一致，也包含尚未汇总的流水（新建宗门 id 最大，在按 id 排序的最后一页）
+    total = client.get('/sect?per_page=1', headers=master).get_json()['total']
+    listed = client.get(f'/sect?per_page=1&page={total}', headers=master).get_json()['sects'][0]
+    assert listed['id'] == sect_id
+    assert (listed['prosperity'], listed['power']) == (52, 10 + 15 + 11)
+
+    with app.app_context():
+        assert run_sect_contribution_fold() >= 1
+        sect = db.session.get(Sect, sect_id)
+        assert (sect.contribution, sect.prosperity) == (5250, 52)
+        assert sect.power == 10 + 15 + 11
+        assert SectContribution.query.filter_by(sect_id=sect_id, fold_batch=None).count() == 0
+        # 再次汇总不会重复累加
+        run_sect_contribution_fold()
+        assert db.session.get(Sect, sect_id).contribution == 5250
+
+    # 升级前会先汇总该宗门的流水
+    client.post('/sect/contribute', headers=master, json={'amount': 100})
+    resp = client.post(f'/sect/upgrade/{sect_id}', headers=master)
+    assert resp.status_code == 200
+    with app.app_context():
+        assert db.session.get(Sect, sect_id).contribution == 5350 - 5000
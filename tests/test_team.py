@@ -0,0 +1,68 @@
+from app import app, db
+from models import Team, TeamMember
+from utils.teams import TeamRegistry, TeamEntry
+
+
+def clear_team_members(char):
+    # 清理上次运行遗留的队伍成员记录
+    TeamMember.query.filter_by(character_id=char.id).delete()
+
+
+def test_team_registry_finds_by_activity_and_level_band():
+    registry = TeamRegistry(band=10, max_level=100, ttl=60)
+    registry.refresh(lambda: [
+        TeamEntry(1, 'dungeon', 30, 45, 1, 5),
+        TeamEntry(2, 'dungeon', 1, 100, 2, 5),
+        TeamEntry(3, 'pvp', 30, 40, 1, 5),
+        TeamEntry(4, 'dungeon', 38, 60, 1, 5),
+        TeamEntry(5, 'dungeon', 30, 40, 5, 5),  # 已满员
+    ])
+    assert [t.id for t in registry.find('dungeon', 37, 10)] == [1, 2]
+    assert [t.id for t in registry.find('dungeon', 37, 1, after_id=1)] == [2]
+    assert [t.id for t in registry.find('dungeon', 100, 10)] == [2]
+
+    registry.put(TeamEntry(1, 'dungeon', 30, 45, 5, 5))
+    registry.put(TeamEntry(6, 'dungeon', 35, 39, 1, 2))
+    registry.discard(2)
+    assert [t.id for t in registry.find('dungeon', 37, 10)] == [6]
+
+
+def test_team_member_count_and_finder(make_player):
+    client = app.test_client()
+    leader, leader_id = make_player(client, 'team_leader_test', '队长', linggen='水', cleanup=clear_team_members)
+    first, first_id = make_player(client, 'team_first_test', '队员甲', linggen='水', cleanup=clear_team_members)
+    second, _ = make_player(client, 'team_second_test', '队员乙', linggen='水', cleanup=clear_team_members)
+
+    resp = client.post('/team/create', headers=leader, json={
+        'name': '试炼小队', 'activity_type': 'team_test', 'max_members': 3, 'min_level': 1, 'max_level': 50
+    })
+    assert resp.status_code == 201
+    team_id = resp.get_json()['team']['id']
+
+    def found(headers):
+        teams = client.get('/team/find?activity_type=team_test&per_page=100', headers=headers).get_json()['teams']
+        return [t['id'] for t in teams]
+
+    assert team_id in found(first)
+    assert client.post(f'/team/join/{team_id}', headers=first).status_code == 200
+    assert client.post(f'/team/join/{team_id}', headers=second).status_code == 200
+    assert team_id not in found(first)
+
+    info = client.get(f'/team/{team_id}', headers=first).get_json()
+    assert info['team']['status'] == 'full'
+    assert info['team']['member_count'] == info['member_count'] == 3
+    assert [m['role'] for m in info['members']] == ['leader', 'member', 'member']
+    assert info['members'][0]['character_name'] == '队长'
+
+    # 队长离开：转让给最早加入的成员，满员队伍恢复招募
+    assert client.post('/team/leave', headers=leader).status_code == 200
+    with app.app_context():
+        team = db.session.get(Team, team_id)
+        assert (team.member_count, team.status, team.leader_id) == (2, 'recruiting', first_id)
+    assert team_id in found(leader)
+
+    for headers in (first, second):
+        assert client.post('/team/leave', headers=headers).status_code == 200
+    with app.app_context():
+        assert db.session.get(Team, team_id) is None
+    assert team_id not in found(leader)
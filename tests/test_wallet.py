@@ -0,0 +1,93 @@
+from app import app, db, wallet_debit, wallet_credit, normalize_wallets
+from models import User, Character, Resource
+
+
+def reset_wallet(char):
+    # 清理上次运行遗留的余额和入账记录
+    Resource.query.filter_by(character_id=char.id, type='冰晶').delete()
+    Resource.query.filter_by(character_id=char.id, type='灵石').first().amount = 300
+
+
+def test_wallet_debit_is_conditional_and_credit_upserts(make_player):
+    client = app.test_client()
+    headers, char_id = make_player(client, 'wallet_test', '钱袋', linggen='土', cleanup=reset_wallet)
+
+    with app.app_context():
+        assert wallet_debit(char_id, 200) is True
+        # 余额不足时不扣款
+        assert wallet_debit(char_id, 200) is False
+        db.session.commit()
+        assert Resource.query.filter_by(character_id=char_id, type='灵石').first().amount == 100
+
+        # 门槛余额：持有不足 required 时不扣，足够时只扣 cost
+        assert wallet_debit(char_id, 50, required=150) is False
+        assert wallet_debit(char_id, 50, required=100) is True
+        wallet_credit(char_id, 50)
+        db.session.commit()
+        assert Resource.query.filter_by(character_id=char_id, type='灵石').first().amount == 100
+
+        # 没有该类资源时插入新行
+        wallet_credit(char_id, 7, '冰晶')
+        wallet_credit(char_id, 3, '冰晶')
+        db.session.commit()
+        rows = Resource.query.filter_by(character_id=char_id, type='冰晶').all()
+        assert len(rows) == 1 and rows[0].amount == 10
+
+    # 接口在余额不足时返回 400 且不改变余额
+    resp = client.post('/rune/forge', headers=headers, json={'name': '符'})
+    assert resp.status_code == 400
+    with app.app_context():
+        assert Resource.query.filter_by(character_id=char_id, type='灵石').first().amount == 100
+
+
+def test_normalize_wallets_merges_legacy_duplicate_rows():
+    client = app.test_client()
+    client.post('/register', json={'username': 'wallet_legacy', 'password': 'pw', 'email': 'wallet_legacy@example.com'})
+    token = client.post('/login', json={'username': 'wallet_legacy', 'password': 'pw'}).get_json()['token']
+    client.post('/character', headers={'Authorization': token}, json={'name': '旧钱袋', 'linggen': '金'})
+
+    with app.app_context():
+        user = User.query.filter_by(username='wallet_legacy').first()
+        char_id = Character.query.filter_by(user_id=user.id).first().id
+        Resource.query.filter_by(character_id=char_id, type='矿石').delete()
+        db.session.commit()
+        # 模拟唯一索引之前的旧数据：同类资源有多行
+        index = next(i for i in Resource.__table__.indexes if i.name == 'uq_resource_character_type')
+        index.drop(db.engine)
+        db.session.add_all([Resource(character_id=char_id, type='矿石', amount=amount) for amount in (5, 7, 11)])
+        db.session.commit()
+        keep_id = db.session.query(db.func.min(Resource.id)).filter_by(character_id=char_id, type='矿石').scalar()
+
+        normalize_wallets()
+        index.create(db.engine)
+        rows = Resource.query.filter_by(character_id=char_id, type='矿石').all()
+        assert [(r.id, r.amount) for r in rows] == [(keep_id, 23)]
+
+        # 唯一索引存在后，首次入账与已有行冲突时改为累加
+        wallet_credit(char_id, 2, '矿石')
+        db.session.commit()
+        assert Resource.query.filter_by(character_id=char_id, type='矿石').one().amount == 25
+
+
+def test_capture_debits_net_cost_once(make_player):
+    client = app.test_client()
+    headers, char_id = make_player(client, 'wallet_capture', '捕灵', linggen='木')
+
+    def set_lingshi(amount):
+        with app.app_context():
+            Resource.query.filter_by(character_id=char_id, type='灵石').update({'amount': amount})
+            db.session.commit()
+
+    def lingshi():
+        with app.app_context():
+            return Resource.query.filter_by(character_id=char_id, type='灵石').first().amount
+
+    # 不足全额时不扣款
+    set_lingshi(400)
+    assert client.post('/pet/capture', headers=headers, json={}).status_code == 400
+    assert lingshi() == 400
+
+    # 成功扣全额，失败只扣一半
+    set_lingshi(600)
+    resp = client.post('/pet/capture', headers=headers, json={})
+    assert lingshi() == (100 if resp.status_code == 201 else 350)
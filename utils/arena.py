@@ -0,0 +1,50 @@
+from collections import namedtuple
+
+
+# 排队中的人物（waited 为已等待秒数）
+QueueEntry = namedtuple('QueueEntry', ['character_id', 'rating', 'waited'])
+
+
+class ArenaMatchmaker:
+    """Rating-window policy for the ranked matchmaking queue.
+
+    A character accepts an opponent within `window(waited)` rating points, a window that
+    widens the longer they wait; a pair is acceptable when either side's window covers the
+    gap. The queue itself is a table indexed by (rating, character_id), so matching one
+    character only needs its rating neighbours: two index lookups plus the checks here.
+    """
+
+    def __init__(self, base_window: int = 50, growth: float = 10, max_window: int = 400):
+        self.base_window = base_window
+        self.growth = growth
+        self.max_window = max_window
+
+    def window(self, waited: float) -> int:
+        """Rating gap accepted after waiting `waited` seconds."""
+        return int(min(self.max_window, self.base_window + self.growth * max(0.0, waited)))
+
+    def acceptable(self, a, b) -> bool:
+        gap = abs(a.rating - b.rating)
+        return gap <= max(self.window(a.waited), self.window(b.waited))
+
+    def pick(self, entry, neighbours):
+        """The acceptable neighbour closest in rating to `entry`, or None."""
+        candidates = [n for n in neighbours if n is not None and self.acceptable(entry, n)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda n: (abs(n.rating - entry.rating), n.character_id))
+
+    def pair(self, entries) -> list:
+        """Pair acceptable runs of rating neighbours in one pass over `entries`.
+
+        `entries` must be sorted by (rating, character_id); returns (a, b) id pairs.
+        """
+        pairs = []
+        i = 0
+        while i + 1 < len(entries):
+            if self.acceptable(entries[i], entries[i + 1]):
+                pairs.append((entries[i].character_id, entries[i + 1].character_id))
+                i += 2
+            else:
+                i += 1
+        return pairs
@@ -0,0 +1,107 @@
+import json
+from collections import namedtuple
+from types import MappingProxyType
+
+
+# 静态数据条目（只读，字段与对应模型一致）
+MonsterEntry = namedtuple('MonsterEntry', [
+    'id', 'name', 'level', 'hp', 'attack', 'defense', 'speed', 'linggen',
+    'experience_reward', 'lingshi_reward', 'drop_items', 'description', 'ai_type'
+])
+DungeonEntry = namedtuple('DungeonEntry', [
+    'id', 'name', 'level_requirement', 'difficulty', 'monster_ids', 'rewards',
+    'description', 'completion_time_limit'
+])
+RealmEntry = namedtuple('RealmEntry', ['id', 'name', 'stage', 'coefficient'])
+MaterialEntry = namedtuple('MaterialEntry', [
+    'id', 'name', 'type', 'quality', 'rarity', 'description', 'base_value'
+])
+# 经脉模板：经脉定义及模板穴位名（按 id 顺序）
+MeridianTemplate = namedtuple('MeridianTemplate', ['name', 'type', 'coefficient', 'acupoints'])
+
+
+def parse_id_list(text) -> tuple:
+    """Parse a JSON id list such as '[1,2]' into a tuple of ints (empty on bad input)."""
+    if not text:
+        return ()
+    try:
+        return tuple(int(i) for i in json.loads(text))
+    except (TypeError, ValueError):
+        return ()
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _entry(entry_type, row, **overrides):
+    values = {field: getattr(row, field) for field in entry_type._fields}
+    values.update(overrides)
+    return entry_type(**values)
+
+
+class GameCatalog:
+    """Immutable snapshot of the static game tables, rebuilt as a whole on reload."""
+
+    __slots__ = ('version', 'monsters', 'dungeons', 'materials', 'realms', 'meridian_templates',
+                 'monster_list', 'dungeon_list', 'material_list', '_realm_index')
+
+    def __init__(self, monsters, dungeons, realms, materials, meridian_templates=(), version: int = 1):
+        self.version = version
+        self.meridian_templates = tuple(meridian_templates)
+        self.monster_list = tuple(sorted(monsters, key=lambda m: m.id))
+        self.dungeon_list = tuple(sorted(dungeons, key=lambda d: d.id))
+        self.material_list = tuple(sorted(materials, key=lambda m: m.id))
+        self.monsters = MappingProxyType({m.id: m for m in self.monster_list})
+        self.dungeons = MappingProxyType({d.id: d for d in self.dungeon_list})
+        self.materials = MappingProxyType({m.id: m for m in self.material_list})
+        # 境界按阶段排序，下一境界即下一个下标
+        self.realms = tuple(sorted(realms, key=lambda r: r.stage))
+        self._realm_index = MappingProxyType({r.name: i for i, r in enumerate(self.realms)})
+
+    @classmethod
+    def from_rows(cls, monsters, dungeons, realms, materials, meridian_templates=(), version: int = 1):
+        """Build a catalog from ORM rows, pre-parsing dungeon wave lists."""
+        return cls(
+            [_entry(MonsterEntry, m) for m in monsters],
+            [_entry(DungeonEntry, d, monster_ids=parse_id_list(d.monster_ids)) for d in dungeons],
+            [_entry(RealmEntry, r) for r in realms],
+            [_entry(MaterialEntry, m) for m in materials],
+            meridian_templates=meridian_templates,
+            version=version,
+        )
+
+    def monster(self, monster_id):
+        return self.monsters.get(_as_id(monster_id))
+
+    def dungeon(self, dungeon_id):
+        return self.dungeons.get(_as_id(dungeon_id))
+
+    def material(self, material_id):
+        return self.materials.get(_as_id(material_id))
+
+    def realm(self, name):
+        index = self._realm_index.get(name)
+        return self.realms[index] if index is not None else None
+
+    def next_realm(self, name):
+        index = self._realm_index.get(name)
+        if index is None or index + 1 >= len(self.realms):
+            return None
+        return self.realms[index + 1]
+
+    def dungeon_waves(self, dungeon_id) -> tuple:
+        """Monsters of a dungeon in wave order; waves stop at the first unknown monster id."""
+        dungeon = self.dungeon(dungeon_id)
+        if not dungeon:
+            return ()
+        waves = []
+        for monster_id in dungeon.monster_ids:
+            monster = self.monsters.get(monster_id)
+            if monster is None:
+                break
+            waves.append(monster)
+        return tuple(waves)
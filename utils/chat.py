@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import deque
+
+
+class ChatHub:
+    """Per-process cache of recent chat messages per channel key, with blocking waits.
+
+    The database stays the source of truth: other processes write messages this one never
+    sees published. A key's buffer holds every message with floor < id <= synced, and is
+    topped up through `loader(after_id)` (messages newer than after_id, oldest first; the
+    newest page when after_id is None) at most once per `max_age` seconds, so concurrent
+    readers of a key share one query.
+
+    Message ids are shared across channels, so coverage is tracked by the ids actually
+    loaded rather than inferred from gaps. A local publish only wakes waiters and marks the
+    key stale; its message is served once a sync reads it back, so readers never step past
+    messages another process committed with a lower id.
+    """
+
+    def __init__(self, size: int = 200, max_age: float = 1.0):
+        self.size = size
+        self.max_age = max_age
+        self._buffers = {}
+        self._floor = {}
+        self._synced = {}
+        self._synced_at = {}
+        self._cond = threading.Condition()
+
+    def refresh(self, key, loader):
+        """Load messages newer than the last sync of `key` unless it synced within max_age."""
+        with self._cond:
+            now = time.monotonic()
+            if now - self._synced_at.get(key, float('-inf')) < self.max_age:
+                return
+            # 其他线程在本次查询期间直接读缓冲区，不重复查询
+            self._synced_at[key] = now
+            synced = self._synced.get(key)
+        try:
+            loaded = loader(synced)
+        except Exception:
+            with self._cond:
+                self._synced_at.pop(key, None)
+            raise
+        with self._cond:
+            self._merge(key, synced, loaded)
+            self._cond.notify_all()
+
+    def _merge(self, key, synced, loaded):
+        if key not in self._synced:
+            # 首次加载的是最新一页，不满一页说明频道里没有更早的消息
+            self._floor[key] = loaded[0]['id'] - 1 if len(loaded) >= self.size else 0
+        merged = {m['id']: m for m in self._buffers.get(key, ())}
+        merged.update((m['id'], m) for m in loaded)
+        ordered = sorted(merged.values(), key=lambda m: m['id'])
+        if len(ordered) > self.size:
+            evicted, ordered = ordered[:-self.size], ordered[-self.size:]
+            self._floor[key] = max(self._floor[key], evicted[-1]['id'])
+        self._buffers[key] = deque(ordered, maxlen=self.size)
+        self._synced[key] = max([self._synced.get(key) or 0] + [m['id'] for m in loaded])
+
+    def publish(self, key):
+        """A message on `key` was committed by this process: wake waiters and re-sync on next read."""
+        with self._cond:
+            self._synced_at.pop(key, None)
+            self._cond.notify_all()
+
+    def recent(self, key, limit: int) -> list:
+        with self._cond:
+            buffer = self._buffers.get(key, ())
+            return list(buffer)[-limit:] if limit > 0 else []
+
+    def since(self, key, after_id: int):
+        """Buffered messages newer than after_id, and whether the buffer covers everything after it."""
+        with self._cond:
+            return self._since(key, after_id)
+
+    def _since(self, key, after_id):
+        floor = self._floor.get(key)
+        if floor is None or after_id < floor:
+            return [], False
+        return [m for m in self._buffers[key] if m['id'] > after_id], True
+
+    def wait(self, key, after_id: int, timeout: float, loader):
+        """Block up to `timeout` seconds until messages newer than after_id arrive; same result as since().
+
+        Wakes on local publishes and re-syncs through `loader` every max_age seconds, which
+        is how messages from other processes arrive.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh(key, loader)
+            with self._cond:
+                messages, complete = self._since(key, after_id)
+                remaining = deadline - time.monotonic()
+                if messages or not complete or remaining <= 0:
+                    return messages, complete
+                self._cond.wait(min(remaining, self.max_age))
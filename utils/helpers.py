@@ -1,5 +1,11 @@
+import datetime
 import math
-import math
+import random
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
 
 
 def exp_for_level(level: int) -> int:
@@ -7,6 +13,41 @@ def exp_for_level(level: int) -> int:
     return int(500 * (level ** 2) * math.exp(0.05 * (level - 1)))
 
 
+MAX_LEVEL = 100
+
+# 经验表：EXP_TABLE[l] 为 l 级升到 l+1 级所需经验；EXP_PREFIX[l] 为 1..l 级所需经验之和
+EXP_TABLE = (0,) + tuple(exp_for_level(l) for l in range(1, MAX_LEVEL + 1))
+EXP_PREFIX = tuple(accumulate(EXP_TABLE))
+
+
+def exp_needed(level: int) -> int:
+    """Experience required at `level`, read from the precomputed table when possible."""
+    if 1 <= level <= MAX_LEVEL:
+        return EXP_TABLE[level]
+    return exp_for_level(level)
+
+
+def exp_cost(level: int, levels: int) -> int:
+    """Total experience to advance `levels` consecutive levels starting at `level`.
+
+    Ranges inside the table are a prefix-sum difference; anything past MAX_LEVEL falls
+    back to the formula.
+    """
+    end = level + levels
+    if 1 <= level and end <= MAX_LEVEL + 1:
+        return EXP_PREFIX[end - 1] - EXP_PREFIX[level - 1]
+    return sum(exp_needed(l) for l in range(level, end))
+
+
+def affordable_levels(level: int, experience: int, max_levels: int = None) -> int:
+    """How many consecutive levels `experience` pays for from `level` (binary search on prefix sums)."""
+    if level < 1 or level > MAX_LEVEL:
+        return 0
+    hi = MAX_LEVEL + 1 if max_levels is None else min(MAX_LEVEL + 1, level + max_levels)
+    target = EXP_PREFIX[level - 1] + experience
+    return bisect_right(EXP_PREFIX, target, level - 1, hi) - level
+
+
 def realm_coefficient_map():
     return {
         '凡人期': 0.0,
@@ -49,15 +90,15 @@ def compute_battle_power(attr, equipments=None, mantras=None, treasures=None,
     return int(power)
 
 
-def apply_level_up(character, attributes, realm_coeff: float):
-    """Apply level-up increments to character attributes in-place."""
-    character.level = (character.level or 1) + 1
+def apply_level_up(character, attributes, realm_coeff: float, levels: int = 1):
+    """Apply `levels` level-ups to character attributes in-place as one bulk increment."""
+    character.level = (character.level or 1) + levels
 
     # 增量设计：基础增长 + 境界系数放大
-    atk_inc = int(10 + realm_coeff * 2)
-    def_inc = int(10 + realm_coeff * 2)
-    hp_inc = int(100 + realm_coeff * 20)
-    spd_inc = int(5 + realm_coeff)
+    atk_inc = int(10 + realm_coeff * 2) * levels
+    def_inc = int(10 + realm_coeff * 2) * levels
+    hp_inc = int(100 + realm_coeff * 20) * levels
+    spd_inc = int(5 + realm_coeff) * levels
 
     attributes.attack = (getattr(attributes, 'attack', 0) or 0) + atk_inc
     attributes.defense = (getattr(attributes, 'defense', 0) or 0) + def_inc
@@ -84,6 +125,166 @@ def calc_strengthen_success(strengthen_times: int, material_quality_factor: floa
     return float(success)
 
 
+def batch_uniforms(n: int) -> list:
+    """Draw n uniform floats in [0, 1) from a single getrandbits call (same resolution as random.random)."""
+    if n <= 0:
+        return []
+    bits = random.getrandbits(53 * n)
+    mask = (1 << 53) - 1
+    return [((bits >> (53 * i)) & mask) / 9007199254740992.0 for i in range(n)]
+
+
+def binomial_sample(n: int, p: float) -> int:
+    """Number of successes in n Bernoulli(p) trials, in O(1) expected time for large n.
+
+    Exact inversion when the expected count of the rarer outcome is small,
+    normal approximation with continuity correction otherwise.
+    """
+    if n <= 0 or p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if p > 0.5:
+        return n - binomial_sample(n, 1 - p)
+
+    if n * p < 30:
+        # 逆变换法：按概率质量函数顺序累加
+        q = 1 - p
+        s = p / q
+        a = (n + 1) * s
+        r = q ** n
+        u = random.random()
+        x = 0
+        while u > r and x < n:
+            u -= r
+            x += 1
+            r *= a / x - s
+        return x
+
+    mean = n * p
+    std = math.sqrt(mean * (1 - p))
+    return int(clamp(math.floor(random.gauss(mean, std) + 0.5), 0, n))
+
+
+GUARANTEED_DROP_THRESHOLD = 100
+
+
+def guaranteed_drop_rate(attempts: int, guaranteed: bool = False,
+                         base: float = 0.01, step: float = 0.005, cap: float = 0.5) -> float:
+    """Drop chance of the `attempts`-th attempt since the last drop (1.0 once pity is reached)."""
+    if guaranteed:
+        return 1.0
+    return min(cap, base + attempts * step)
+
+
+def simulate_guaranteed_drops(attempts: int, guaranteed: bool, rolls, threshold: int = GUARANTEED_DROP_THRESHOLD):
+    """Run sequential pity attempts, one per uniform roll, exactly as single attempts would.
+
+    Each attempt bumps the counter, turns on pity at `threshold`, and drops when the roll is
+    below the current rate; a drop resets the counter and pity.
+    Returns (drops, attempts, guaranteed, last_rate) where drops lists (index, rate) of dropping attempts.
+    """
+    drops = []
+    rate = 0.0
+    for index, roll in enumerate(rolls):
+        attempts += 1
+        if attempts >= threshold:
+            guaranteed = True
+        rate = guaranteed_drop_rate(attempts, guaranteed)
+        if roll < rate:
+            drops.append((index, rate))
+            attempts = 0
+            guaranteed = False
+    return drops, attempts, guaranteed, rate
+
+
+def skill_level_progress(level: int, experience: int, per_level: int = 100):
+    """Closed form of `while exp >= level * per_level: exp -= level * per_level; level += 1`.
+
+    Returns the new (level, experience).
+    """
+    def cost(k):
+        return per_level * (k * level + k * (k - 1) // 2)
+
+    b = 2 * level - 1
+    k = max(0, int((-b + math.sqrt(b * b + 8 * experience / per_level)) / 2))
+    # 修正浮点误差
+    while k > 0 and cost(k) > experience:
+        k -= 1
+    while cost(k + 1) <= experience:
+        k += 1
+    return level + k, experience - cost(k)
+
+
+def acupoint_cost(level: int, levels: int, coefficient: float, base: int = 50):
+    """Summed (exp, lingshi) to raise an acupoint `levels` times starting at `level`.
+
+    Level k costs exp_k = int(base * k * coefficient) and lingshi_k = exp_k // 2; the sums
+    are closed form when coefficient is a multiple of 0.5 (every meridian is 1.5 or 2.5), where the
+    float products are exact; other coefficients fall back to summing the per-level formula.
+    """
+    if levels <= 0:
+        return 0, 0
+    first, last = level + 1, level + levels
+    unit = base * coefficient
+    if coefficient * 2 != int(coefficient * 2) or unit != int(unit):
+        costs = [int(base * k * coefficient) for k in range(first, last + 1)]
+        return sum(costs), sum(c // 2 for c in costs)
+
+    unit = int(unit)
+    exp = unit * (first + last) * levels // 2
+    # exp_k 为奇数时向下取整少半个灵石：只有 unit 为奇数且 k 为奇数时发生
+    odd_terms = (last + 1) // 2 - first // 2 if unit % 2 else 0
+    return exp, (exp - odd_terms) // 2
+
+
+def affordable_acupoint_levels(level: int, max_level: int, coefficient: float,
+                               experience: int, lingshi: int) -> int:
+    """Most levels (up to max_level) whose summed acupoint_cost fits both budgets, by binary search."""
+    lo, hi = 0, max(0, max_level - level)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        exp, stones = acupoint_cost(level, mid, coefficient)
+        if exp <= experience and stones <= lingshi:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+# 灵植生长阶段（按生长进度均分，进度满即成熟）
+LINGZHI_STAGES = ('种子', '发芽', '生长', '开花', '结果', '成熟')
+
+
+def lingzhi_growth(planted_at, max_growth_time: int, now):
+    """Growth state derived purely from timestamps.
+
+    Returns (stage, progress, elapsed_minutes); progress is a percentage capped at 100
+    and the stage is '成熟' exactly when progress reaches 100.
+    """
+    elapsed = max(0.0, (now - planted_at).total_seconds() / 60) if planted_at else 0.0
+    if not max_growth_time or max_growth_time <= 0:
+        progress = 100.0
+    else:
+        progress = min(100.0, elapsed / max_growth_time * 100)
+    if progress >= 100:
+        return LINGZHI_STAGES[-1], progress, elapsed
+    step = 100.0 / (len(LINGZHI_STAGES) - 1)
+    return LINGZHI_STAGES[int(progress // step)], progress, elapsed
+
+
+def lingzhi_stage_cutoffs(max_growth_time: int, now) -> list:
+    """(stage, planted_at cutoff) pairs, most advanced first, with the same boundaries as lingzhi_growth.
+
+    A plant planted at or before a cutoff has reached that stage; later plants are still seeds.
+    """
+    last = len(LINGZHI_STAGES) - 1
+    if not max_growth_time or max_growth_time <= 0:
+        return [(LINGZHI_STAGES[-1], now)]
+    return [(LINGZHI_STAGES[i], now - datetime.timedelta(minutes=max_growth_time * i / last))
+            for i in range(last, 0, -1)]
+
+
 def calc_forge_success(material_quality_factor: float = 1.0, luck_factor: float = 1.0,
                        base_success: float = 0.6, success_cap: float = 0.95, success_floor: float = 0.01):
     """Calculate forge/recast success probability."""
@@ -234,6 +435,12 @@ def shentong_trigger_rate(proficiency: int) -> float:
     return min(0.3, base_rate + proficiency_bonus)
 
 
+def elo_rating_change(winner_rating: int, loser_rating: int, k: int = 32) -> int:
+    """Points the winner gains (and the loser drops) under the Elo formula; at least 1."""
+    expected = 1.0 / (1.0 + 10 ** ((loser_rating - winner_rating) / 400.0))
+    return max(1, int(round(k * (1.0 - expected))))
+
+
 def update_mantra_proficiency(proficiency: str, proficiency_exp: int, proficiency_max: int) -> str:
     """Update mantra proficiency level based on experience."""
     proficiency_levels = ['入门', '小成', '大成', '圆满']
@@ -246,3 +453,106 @@ def update_mantra_proficiency(proficiency: str, proficiency_exp: int, proficienc
         proficiency_max = int(proficiency_max * 1.5)  # 下一级要求更高
 
     return proficiency_levels[current_index]
+
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def get_or_set(self, key, factory):
+        """Return the cached value, computing it at most once per TTL even under concurrent callers."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            value = factory()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+
+class LRUCache:
+    """Small thread-safe cache that keeps the `maxsize` most recently used entries.
+
+    With `ttl` set, entries also expire that many seconds after being stored, which
+    bounds how long a change made by another process can stay invisible here.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._generation = 0  # 每次失效加一，用于丢弃失效前开始计算的结果
+
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _store(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            return default if entry is None else entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_set(self, key, factory):
+        """Return the cached value or compute it outside the lock.
+
+        A result is not stored if an invalidation happened while it was being computed.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry[1]
+            generation = self._generation
+        value = factory()
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
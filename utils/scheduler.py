@@ -0,0 +1,69 @@
+import threading
+import time
+import traceback
+
+
+class PeriodicScheduler:
+    """Runs registered jobs at fixed intervals, either in a daemon thread or from a worker loop."""
+
+    def __init__(self, tick: float = 1.0):
+        self.tick = tick
+        self.jobs = {}
+        self._next_run = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, name: str, interval: float, func):
+        """Register (or replace) a job; it first runs one interval after registration."""
+        with self._lock:
+            self.jobs[name] = (interval, func)
+            self._next_run[name] = time.monotonic() + interval
+
+    def job(self, name: str, interval: float):
+        """Decorator form of register()."""
+        def decorator(func):
+            self.register(name, interval, func)
+            return func
+        return decorator
+
+    def run_job(self, name: str):
+        """Run one job immediately; exceptions are printed and do not stop the scheduler."""
+        interval, func = self.jobs[name]
+        try:
+            return func()
+        except Exception:
+            traceback.print_exc()
+            return None
+        finally:
+            with self._lock:
+                self._next_run[name] = time.monotonic() + interval
+
+    def run_pending(self) -> list:
+        """Run every job whose interval has elapsed; returns the names that ran."""
+        now = time.monotonic()
+        with self._lock:
+            due = [name for name, at in self._next_run.items() if at <= now]
+        for name in due:
+            self.run_job(name)
+        return due
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            self.run_pending()
+            self._stop.wait(self.tick)
+
+    def start(self):
+        """Start the daemon thread (no-op if already running)."""
+        if self._thread and self._thread.is_alive():
+            return self._thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name='periodic-scheduler', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
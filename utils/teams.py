@@ -0,0 +1,97 @@
+import bisect
+import threading
+import time
+from collections import namedtuple
+
+
+# 招募中队伍的索引条目（字段与 Team 模型一致）
+TeamEntry = namedtuple('TeamEntry', [
+    'id', 'activity_type', 'min_level', 'max_level', 'member_count', 'max_members'
+])
+
+
+class TeamRegistry:
+    """In-memory index of recruiting teams keyed by (activity_type, level band).
+
+    A team is listed under every band its level range overlaps, so the teams open to a
+    given level are one dict lookup plus a bisect into that band's sorted id list. The
+    index is a cache of the database: it is rebuilt from `loader()` once older than `ttl`
+    seconds, and updated in place for changes made by this process.
+    """
+
+    def __init__(self, band: int = 10, max_level: int = 100, ttl: float = 30):
+        self.band = band
+        self.max_level = max_level
+        self.ttl = ttl
+        self._teams = {}
+        self._bands = {}
+        self._loaded_at = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def _band_keys(self, entry):
+        low = max(entry.min_level, 1) // self.band
+        high = min(entry.max_level, self.max_level) // self.band
+        return [(entry.activity_type, b) for b in range(low, high + 1)]
+
+    def _remove(self, team_id):
+        entry = self._teams.pop(team_id, None)
+        if entry is None:
+            return
+        for key in self._band_keys(entry):
+            ids = self._bands.get(key)
+            i = bisect.bisect_left(ids, team_id) if ids else 0
+            if ids and i < len(ids) and ids[i] == team_id:
+                del ids[i]
+                if not ids:
+                    del self._bands[key]
+
+    def _insert(self, entry):
+        self._teams[entry.id] = entry
+        for key in self._band_keys(entry):
+            bisect.insort(self._bands.setdefault(key, []), entry.id)
+
+    def refresh(self, loader, force: bool = False):
+        """Rebuild from `loader()` (all recruiting teams) when the index is older than ttl."""
+        with self._lock:
+            if not force and self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            version = self._version
+        entries = loader()
+        with self._lock:
+            # 加载期间本进程有改动时放弃这次结果，下次再重建
+            if version != self._version:
+                return
+            self._teams = {}
+            self._bands = {}
+            for entry in entries:
+                if entry.member_count < entry.max_members:
+                    self._insert(entry)
+            self._loaded_at = time.monotonic()
+
+    def put(self, entry):
+        """Add or update a recruiting team; teams without a free slot are dropped."""
+        with self._lock:
+            self._version += 1
+            self._remove(entry.id)
+            if entry.member_count < entry.max_members:
+                self._insert(entry)
+
+    def discard(self, team_id):
+        with self._lock:
+            self._version += 1
+            self._remove(team_id)
+
+    def find(self, activity_type, level: int, limit: int, after_id: int = 0) -> list:
+        """Recruiting teams of `activity_type` open to `level`, by ascending id after `after_id`."""
+        key = (activity_type, min(max(level, 1), self.max_level) // self.band)
+        with self._lock:
+            ids = self._bands.get(key, ())
+            found = []
+            for i in range(bisect.bisect_right(ids, after_id), len(ids)):
+                entry = self._teams[ids[i]]
+                if entry.min_level <= level <= entry.max_level:
+                    found.append(entry)
+                    if len(found) >= limit:
+                        break
+            return found